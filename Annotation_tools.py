@@ -1,49 +1,350 @@
 import pandas as pd
+import numpy as np
+import csv
 import json
 import os
+import re
 import sys
+from collections import OrderedDict
+from multiprocessing import Pool
 script_path = os.path.dirname(os.path.realpath(__file__)).split('GeneTools')[0]
 sys.path.append(script_path)
 import GeneTools as GT
 
-class Organism:
+class Organism(object):
+    '''Genome sequence and annotation for an organism. The sequence and annotation are only read
+    the first time they are accessed. Use get_organism or autoload_organism to share one instance
+    across many Intron and Transcript objects.'''
     def __init__(self, name, fasta_file, gff3):
         self.name = name
         self.fasta_file = fasta_file
         self.gff3 = gff3
-        if fasta_file.endswith('.json'):
-            with open(fasta_file) as f: fa = json.load(f)
+        self._sequence = None
+        self._chromosome_lengths = None
+        self._annotation = None
+        self._composition = {}
+        self._aliases = None
+        self._bam_contigs = {}
+        self._transcript_index = None
+        self._feature_index = {}
+        self._intron_df = None
+    
+    def __reduce__(self):
+        # Pickle by name and files only - unpickling shares or reloads the organism with get_organism
+        return (get_organism, (self.name, self.fasta_file, self.gff3))
+    
+    @property
+    def sequence(self):
+        if self._sequence is None:
+            self._sequence = GT.load_genome(self.fasta_file)
+        return self._sequence
+    
+    @sequence.setter
+    def sequence(self, fa):
+        self._sequence = fa
+        self._chromosome_lengths = None
+        self._composition = {}
+    
+    @property
+    def chromosome_lengths(self):
+        if self._chromosome_lengths is None:
+            self._chromosome_lengths = {k:len(v) for k,v in self.sequence.items()}
+        return self._chromosome_lengths
+    
+    @chromosome_lengths.setter
+    def chromosome_lengths(self, lengths):
+        self._chromosome_lengths = lengths
+    
+    @property
+    def annotation(self):
+        if self._annotation is None:
+            self._annotation = read_gff3(self.gff3)
+        return self._annotation
+    
+    @annotation.setter
+    def annotation(self, ann_df):
+        self._annotation = ann_df
+        self._aliases = None
+        self._bam_contigs = {}
+        self._transcript_index = None
+        self._feature_index = {}
+        self._intron_df = None
+    
+    @property
+    def transcript_index(self):
+        '''IntervalIndex of transcripts (mRNA, or transcript for S. pombe) by chromosome and strand. 
+        Names are the transcript IDs.'''
+        if self._transcript_index is None:
+            ann_df = self.annotation
+            if self.name == 'Schizosaccharomyces pombe':
+                transcripts = ann_df[ann_df['type'] == 'transcript']
+            else:
+                transcripts = ann_df[ann_df['type'] == 'mRNA']
+            names = normalize_transcript_ids(transcripts['ID']).values
+            self._transcript_index = GT.IntervalIndex(transcripts['chromosome'].values, transcripts['start'].values,
+                                                      transcripts['end'].values, strands=transcripts['strand'].values,
+                                                      names=names)
+        return self._transcript_index
+    
+    def feature_index(self, feature_type='CDS'):
+        '''GroupedIntervals of the CDS, exon or intron coordinates of each transcript, keyed by transcript ID
+        (see normalize_transcript_ids). Built the first time each feature type is used.
+        Introns are from intron_df (annotated introns, or the gaps between exons).'''
+        if feature_type not in self._feature_index:
+            if feature_type == 'intron':
+                features = self.intron_df()
+                keys = features['transcript'].values
+            else:
+                ann_df = self.annotation
+                features = ann_df[ann_df['type'] == feature_type]
+                keys = normalize_transcript_ids(features['Parent']).values
+            self._feature_index[feature_type] = GT.GroupedIntervals(keys, features['start'].values, features['end'].values)
+        return self._feature_index[feature_type]
+    
+    def intron_df(self, transcript_list=None):
+        '''Introns of each transcript (see build_intron_df). Derived from the annotation the first time it is used.'''
+        if self._intron_df is None:
+            self._intron_df = GT.build_intron_df(self.gff3, ann_df=self.annotation)
+        if transcript_list is None:
+            return self._intron_df
+        return self._intron_df[self._intron_df['transcript'].isin(transcript_list)]
+    
+    @property
+    def aliases(self):
+        '''ContigAliases built once from the fasta contigs (packed genome header or .fai index, see 
+        genome_contigs) and the gff3 seqids, without loading the sequence or annotation. Contig ids follow 
+        the fasta order. Use bam_contigs for the names in a bam header.'''
+        if self._aliases is None:
+            if self._sequence is not None:
+                aliases = ContigAliases(self._sequence.keys())
+            else:
+                aliases = ContigAliases(GT.genome_contigs(self.fasta_file))
+            if self._annotation is not None:
+                aliases.add_names(pd.unique(self._annotation['chromosome'].astype(str)))
+            else:
+                aliases.add_names(gff3_seqids(self.gff3))
+            self._aliases = aliases
+        return self._aliases
+    
+    def bam_contigs(self, bam):
+        '''Dictionary of contig id (see aliases) to the name used in a bam file header. Built once per bam 
+        file - contigs only in the bam are left out and the organism's aliases are not changed.'''
+        bam = GT.open_bam(bam)
+        if bam.filename not in self._bam_contigs:
+            self._bam_contigs[bam.filename] = self.aliases.translate(bam.references)
+        return self._bam_contigs[bam.filename]
+    
+    def contig_id(self, chrom):
+        '''Integer id of a contig from any of its names (e.g. chr1, I, 1)'''
+        return self.aliases.id(chrom)
+    
+    def composition(self, k=1, window=None, frequencies=False):
+        '''Base/k-mer composition of the genome (see FastaTools.sequence_composition). 
+        Results are cached on the organism.'''
+        key = (k, window, frequencies)
+        if key not in self._composition:
+            self._composition[key] = GT.sequence_composition(self.sequence, k=k, window=window, frequencies=frequencies)
+        return self._composition[key]
+
+#####################################################
+## Chromosome names from different sources         ##
+#####################################################
+
+_MITO_NAMES = set(['m','mt','mito','mitochondria','mitochondrion','mitochondrial'])
+_ROMAN = {'i':1,'v':5,'x':10,'l':50}
+
+def _roman_to_int(numeral):
+    total = 0
+    for n, c in enumerate(numeral):
+        value = _ROMAN[c]
+        if n+1 < len(numeral) and _ROMAN[numeral[n+1]] > value:
+            total -= value
         else:
-            fa = make_fasta_json(f)    
-        self.sequence = fa
-        self.chromosome_lengths = {k:len(v) for k,v in fa.items()}
-        self.annotation = read_gff3(gff3)
+            total += value
+    return total
+
+def contig_alias_keys(name):
+    '''Normalized forms of a contig name, from strictest to loosest:
+    exact, lower case, without chr/chromosome prefix, roman or arabic number (mitochondria -> m)
+    e.g. chrIII -> ['chrIII', 'chriii', 'iii', '3']'''
+    name = str(name).strip()
+    low = name.lower()
+    stripped = re.sub(r'^(chromosome|chrom|chr)[_\s]?', '', low)
+    if stripped in _MITO_NAMES:
+        number = 'm'
+    elif re.match(r'^[ivxl]+$', stripped):
+        number = str(_roman_to_int(stripped))
+    elif stripped.isdigit():
+        number = str(int(stripped))
+    else:
+        number = stripped
+    return [name, low, stripped, number]
+
+class ContigAliases(object):
+    '''Maps any name of a contig (chr1, I, 1, chrI...) to an integer contig id and back. 
+    The first name added for a contig is its canonical name. A normalized key that would match more
+    than one contig is dropped so lookups are never ambiguous.
+    
+    Examples
+    --------
+    >>> aliases = ContigAliases(['chr1','chr2','chr3','MT'])
+    >>> aliases.id('II')
+        1
+    >>> aliases.resolve('mito')
+        'MT'
+    '''
+    def __init__(self, names=None):
+        self.names = []
+        self._tiers = [{} for n in range(4)]
+        self._ambiguous = [set() for n in range(4)]
+        if names is not None:
+            self.add_names(names)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def __contains__(self, name):
+        return self.get_id(name) is not None
+    
+    def __repr__(self):
+        return '<ContigAliases: {0} contigs>'.format(len(self.names))
+    
+    def get_id(self, name, default=None):
+        if name in self._tiers[0]:
+            return self._tiers[0][name]
+        for tier, key in zip(self._tiers, contig_alias_keys(name)):
+            if key in tier:
+                return tier[key]
+        return default
+    
+    def id(self, name):
+        contig_id = self.get_id(name)
+        if contig_id is None:
+            raise KeyError(name)
+        return contig_id
+    
+    def resolve(self, name, default=None):
+        '''Canonical name for any name of a contig'''
+        contig_id = self.get_id(name)
+        if contig_id is None:
+            return default
+        return self.names[contig_id]
+    
+    def add(self, name, contig_id=None):
+        '''Add a name - as an alias of contig_id, of a contig it already matches, or as a new contig.
+        Returns the contig id.'''
+        if contig_id is None:
+            contig_id = self.get_id(name)
+        if contig_id is None:
+            contig_id = len(self.names)
+            self.names.append(str(name))
+        for tier, ambiguous, key in zip(self._tiers, self._ambiguous, contig_alias_keys(name)):
+            if key in ambiguous:
+                continue
+            if tier.get(key, contig_id) != contig_id:
+                del tier[key]
+                ambiguous.add(key)
+            else:
+                tier[key] = contig_id
+        return contig_id
+    
+    def add_names(self, names):
+        '''Add many names (e.g. fasta contigs, gff3 seqids or bam.references). Returns their contig ids.'''
+        names = [str(x) for x in names]
+        ids = [self.get_id(x) for x in names]
+        # New contigs first so that names within this set do not merge on loose keys
+        for n, name in enumerate(names):
+            if ids[n] is None:
+                ids[n] = len(self.names)
+                self.names.append(name)
+                for tier, key in zip(self._tiers, contig_alias_keys(name)):
+                    tier.setdefault(key, ids[n])
+        for name, contig_id in zip(names, ids):
+            self.add(name, contig_id)
+        return ids
+    
+    def translate(self, names):
+        '''Dictionary of contig id to the name used in another naming scheme (e.g. bam.references)'''
+        id_dict = {}
+        for name in names:
+            contig_id = self.get_id(name)
+            if contig_id is not None and contig_id not in id_dict:
+                id_dict[contig_id] = name
+        return id_dict
 
-class Transcript:
+# S. pombe contig names used by the genome and bams (chr1, chr2, chr3, MT) - the gff3 uses I, II, III and MT.
+# For parsing the gff3 alone, where no Organism is loaded; otherwise use Organism.aliases.
+pombe_aliases = ContigAliases(['chr1','chr2','chr3','MT'])
+
+#####################################################
+## Compact Transcript records and transcript sets  ##
+#####################################################
+
+# Contig names of features without an organism (exact names only - no aliases)
+_contig_names = []
+_contig_numbers = {}
+
+def feature_contig_id(chrom, organism=None):
+    '''Integer contig id stored by Intron, Transcript and feature sets. With an organism this is the organism's 
+    alias id (Organism.contig_id) - names in neither the fasta nor the gff3 are added to its aliases. Features 
+    without an organism use a process wide table of exact names instead.'''
+    if organism is None:
+        chrom = str(chrom)
+        if chrom not in _contig_numbers:
+            _contig_numbers[chrom] = len(_contig_names)
+            _contig_names.append(chrom)
+        return _contig_numbers[chrom]
+    contig_id = organism.aliases.get_id(chrom)
+    if contig_id is None:
+        contig_id = organism.aliases.add(chrom)
+    return contig_id
+
+def feature_contig_names(organism=None):
+    '''Contig names indexed by feature_contig_id - the canonical alias names of the organism'''
+    if organism is None:
+        return _contig_names
+    return organism.aliases.names
+
+class Transcript(object):
+    '''Transcript location and the organism it belongs to. Uses __slots__ and an integer contig id 
+    (see feature_contig_id) so that many thousands of transcripts take little memory - all transcripts 
+    from populate_transcripts share one Organism. For genome wide work use TranscriptSet.'''
+    __slots__ = ('name', 'contig_id', 'start', 'end', 'strand', 'organism')
+    
     def __init__(transcript, name, chromosome, start, end, strand, organism='crypto'):
         transcript.name = name
-        transcript.chromosome = chromosome
-        transcript.start = start
-        transcript.end = end
-        transcript.strand = strand
-        transcript.length = end-start
         if type(organism) == str:
             organism = autoload_organism(organism)
+        # Contig ids belong to the organism - set it first
         transcript.organism = organism
+        transcript.chromosome = chromosome
+        transcript.start = int(start)
+        transcript.end = int(end)
+        transcript.strand = strand
+    
+    @property
+    def chromosome(transcript):
+        return feature_contig_names(transcript.organism)[transcript.contig_id]
+    
+    @chromosome.setter
+    def chromosome(transcript, chrom):
+        transcript.contig_id = feature_contig_id(chrom, transcript.organism)
+    
+    @property
+    def length(transcript):
+        return transcript.end-transcript.start
+    
+    def __getstate__(transcript):
+        # Contig ids are only valid in this process - pickle the contig name
+        return (transcript.name, transcript.chromosome, transcript.start, transcript.end, transcript.strand, 
+                transcript.organism)
+    
+    def __setstate__(transcript, state):
+        transcript.name, chromosome, transcript.start, transcript.end, transcript.strand, transcript.organism = state
+        transcript.chromosome = chromosome
         
     def CDS(transcript):
-        df = transcript.organism.annotation
-        CDS_df = df[df['type'] == 'CDS']
-        CDS_df.loc[:,'transcript'] = CDS_df['ID'].str.split('Parent=').str[1].str.split(';').str[0]
-        if transcript.organism.name == 'Schizosaccharomyces pombe':
-            CDS_df.loc[:,'transcript'] = CDS_df['transcript'].str.split('transcript:').str[-1]
-        elif transcript.organism.name == 'Saccharomyces cerevisiae S288C':
-            CDS_df.loc[:,'transcript'] = CDS_df['transcript'].str.split('_mRNA').str[0]
-       
-        tx_CDS = CDS_df[CDS_df['transcript'] == transcript.name]
-        CDS_start = min(tx_CDS['start'])
-        CDS_end = max(tx_CDS['end'])
-        
+        CDS_start, CDS_end = transcript.organism.feature_index('CDS').span(transcript.name)
         return CDS_start, CDS_end
     
     def UTR_5prime(transcript):
@@ -62,10 +363,7 @@ class Transcript:
         
     def sequence(transcript, seq_range=(0,0)):
         fa_dict = transcript.organism.sequence
-        seq = fa_dict[transcript.chromosome][transcript.start+seq_range[0]:transcript.end+seq_range[1]]
-        if transcript.strand == '-':
-            seq = GT.reverse_complement(seq)
-        return seq
+        return GT.seq_simple(transcript.chromosome, transcript.start+seq_range[0], transcript.end+seq_range[1]-1, transcript.strand, fa_dict)
         
     def transcript_count_reads(transcript, bams, library_direction='reverse'):
         counts = GT.simple_read_counter(bams, transcript.chromosome, transcript.start, transcript.end, transcript.strand, library_direction=library_direction)
@@ -77,18 +375,281 @@ class Transcript:
         return counts
     
 
+class FeatureSet(object):
+    '''Columnar collection of stranded features (base class of TranscriptSet and IntronSet). Contig ids index 
+    into contigs, and starts, ends and strands are numpy arrays, so a genome wide set is a few arrays rather than 
+    one object per feature. set[n] returns one feature (a (chromosome, start, end, strand) tuple, or a Transcript 
+    or Intron for the subclasses); set[mask], set[array] and set[a:b] return a new set.
+    Methods that retrieve sequences or count reads work on every feature at once and return arrays or 
+    DataFrames in the same order as the set.
+    
+    Contig ids are the same as those of the feature objects (see feature_contig_id) - the organism's alias ids, 
+    so set.contigs are the canonical contig names.
+    
+    Parameters
+    ----------
+    contigs : list
+        Contig names - contig_ids index into this list
+    contig_ids, starts, ends, strands : array-like
+        One entry per feature
+    organism : GT.Organism, default `None`
+    '''
+    def __init__(self, contigs, contig_ids, starts, ends, strands, organism=None):
+        # Renumber from the contigs given to the organism's contig ids
+        ids = np.array([feature_contig_id(x, organism) for x in contigs], dtype=np.int32)
+        self.contigs = list(feature_contig_names(organism))
+        self.contig_ids = ids[np.asarray(contig_ids, dtype=np.int64)]
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.strands = np.asarray(strands, dtype='S1')
+        self.organism = organism
+    
+    def __len__(self):
+        return len(self.starts)
+    
+    def __repr__(self):
+        return '<{0}: {1} features on {2} contigs>'.format(self.__class__.__name__, len(self), len(self.contigs))
+    
+    def __getitem__(self, n):
+        if isinstance(n, (int, long, np.integer)):
+            return self.record(n)
+        return self.take(n)
+    
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.record(n)
+    
+    @property
+    def chromosomes(self):
+        return np.asarray(self.contigs, dtype=object)[self.contig_ids]
+    
+    @property
+    def lengths(self):
+        return np.abs(self.ends-self.starts)
+    
+    def take(self, ix):
+        '''New set with the rows in ix (mask, positions or slice)'''
+        return self.__class__(self.contigs, self.contig_ids[ix], self.starts[ix], self.ends[ix], self.strands[ix],
+                              organism=self.organism)
+    
+    def record(self, n):
+        '''Feature n as a (chromosome, start, end, strand) tuple - subclasses return their feature objects'''
+        return (self.contigs[self.contig_ids[n]], int(self.starts[n]), int(self.ends[n]), self.strands[n])
+    
+    def labels(self):
+        '''Row labels for count tables - chrom:start-end,strand'''
+        return ['{0}:{1}-{2},{3}'.format(chrom, start, end, strand) 
+                for chrom, start, end, strand in zip(self.chromosomes, self.starts, self.ends, self.strands)]
+    
+    def _fetch(self, starts, ends):
+        # Sequences of 0 based, end exclusive intervals on the strand of each feature
+        return GT.fetch_sequences(pd.DataFrame({'chromosome':self.chromosomes, 'start':starts, 'end':ends, 
+                                                'strand':self.strands.astype(str)}), self.organism.sequence)
+    
+    def _count(self, bams, starts, ends, library_direction='reverse', max_cigar_ops=None):
+        # Count table (features x bams) for 0 based, end exclusive regions on the strand of each feature
+        regions = pd.DataFrame({'chromosome':self.chromosomes, 'start':starts, 'end':ends, 
+                                'strand':self.strands.astype(str)})
+        counts = GT.count_reads_in_regions(bams, regions, library_direction=library_direction, 
+                                           max_cigar_ops=max_cigar_ops).astype(float)
+        counts.index = self.labels()
+        return counts
+    
+    def _rpkm(self, counts, lengths):
+        # Reads per kb of feature per million aligned reads (see simple_read_counter)
+        totals = np.array([GT.count_aligned_reads(bam) for bam in counts.columns])
+        return counts.div(totals, axis=1).div(np.asarray(lengths)/1000., axis=0)
+
+class TranscriptSet(FeatureSet):
+    '''Transcripts stored as arrays (see FeatureSet) with the same methods as Transcript applied to every 
+    transcript at once. set[n] is a Transcript.
+    
+    Examples
+    --------
+    >>> transcripts = TranscriptSet.from_organism(crypto)
+    >>> seqs = transcripts.sequence()
+    >>> counts = transcripts.transcript_count_reads(['WT.bam','mut.bam'])
+    '''
+    def __init__(self, names, contigs, contig_ids, starts, ends, strands, organism=None):
+        FeatureSet.__init__(self, contigs, contig_ids, starts, ends, strands, organism=organism)
+        self.names = np.asarray(names, dtype=object)
+    
+    @classmethod
+    def from_df(cls, tx_df, organism=None, name_column='transcript'):
+        '''Set from a dataframe with transcript name, chromosome, start, end and strand columns 
+        (e.g. populate_transcript_df)'''
+        contig_ids, contigs = pd.factorize(np.asarray(tx_df['chromosome'], dtype=object).astype(str), sort=True)
+        return cls(tx_df[name_column].values, contigs, contig_ids, tx_df['start'].values, tx_df['end'].values,
+                   np.asarray(tx_df['strand'], dtype=object).astype(str), organism=organism)
+    
+    @classmethod
+    def from_organism(cls, organism, transcript_list=None):
+        '''Transcripts (mRNA, or transcript for S. pombe) in the organism annotation'''
+        if type(organism) == str:
+            organism = autoload_organism(organism)
+        ann_df = organism.annotation
+        if organism.name == 'Schizosaccharomyces pombe':
+            tx_df = ann_df[ann_df['type'] == 'transcript']
+        else:
+            tx_df = ann_df[ann_df['type'] == 'mRNA']
+        tx_df = pd.DataFrame({'transcript':normalize_transcript_ids(tx_df['ID']).values, 
+                              'chromosome':tx_df['chromosome'].values, 'start':tx_df['start'].values, 
+                              'end':tx_df['end'].values, 'strand':tx_df['strand'].values})
+        if transcript_list is not None:
+            tx_df = tx_df[tx_df['transcript'].isin(transcript_list)]
+        return cls.from_df(tx_df, organism=organism)
+    
+    @classmethod
+    def from_transcripts(cls, transcripts):
+        '''Set from a list or dictionary (see populate_transcripts) of Transcript objects'''
+        if isinstance(transcripts, dict):
+            transcripts = transcripts.values()
+        organism = transcripts[0].organism if len(transcripts) > 0 else None
+        return cls.from_df(pd.DataFrame({'transcript':[tx.name for tx in transcripts], 
+                                         'chromosome':[tx.chromosome for tx in transcripts],
+                                         'start':[tx.start for tx in transcripts], 'end':[tx.end for tx in transcripts], 
+                                         'strand':[tx.strand for tx in transcripts]}), organism=organism)
+    
+    def take(self, ix):
+        return self.__class__(self.names[ix], self.contigs, self.contig_ids[ix], self.starts[ix], self.ends[ix], 
+                              self.strands[ix], organism=self.organism)
+    
+    def record(self, n):
+        return Transcript(self.names[n], self.contigs[self.contig_ids[n]], int(self.starts[n]), int(self.ends[n]),
+                          self.strands[n], organism=self.organism)
+    
+    def labels(self):
+        return list(self.names)
+    
+    def CDS(self):
+        '''(CDS starts, CDS ends) of every transcript (see Transcript.CDS). Transcripts without a CDS are -1.'''
+        return self.organism.feature_index('CDS').spans(self.names)
+    
+    def _coding_CDS(self):
+        # CDS starts and ends as floats with NaN for transcripts without a CDS
+        CDS_starts, CDS_ends = self.CDS()
+        noncoding = CDS_starts < 0
+        CDS_starts = np.where(noncoding, np.nan, CDS_starts)
+        CDS_ends = np.where(noncoding, np.nan, CDS_ends)
+        return CDS_starts, CDS_ends, noncoding
+    
+    def UTR_5prime(self):
+        '''(starts, ends) of the 5 prime UTRs (see Transcript.UTR_5prime). Transcripts without a CDS are NaN.'''
+        CDS_starts, CDS_ends, noncoding = self._coding_CDS()
+        minus = self.strands == '-'
+        starts = np.where(noncoding, np.nan, np.where(minus, CDS_ends, self.starts))
+        ends = np.where(noncoding, np.nan, np.where(minus, self.ends, CDS_starts))
+        return starts, ends
+    
+    def UTR_3prime(self):
+        '''(starts, ends) of the 3 prime UTRs (see Transcript.UTR_3prime). Transcripts without a CDS are NaN.'''
+        CDS_starts, CDS_ends, noncoding = self._coding_CDS()
+        minus = self.strands == '-'
+        starts = np.where(noncoding, np.nan, np.where(minus, self.starts, CDS_ends))
+        ends = np.where(noncoding, np.nan, np.where(minus, CDS_starts, self.ends))
+        return starts, ends
+    
+    def sequence(self, seq_range=(0,0)):
+        '''Sequence of every transcript (see Transcript.sequence), retrieved in one batch'''
+        return self._fetch(self.starts+seq_range[0], self.ends+seq_range[1])
+    
+    def transcript_count_reads(self, bams, library_direction='reverse'):
+        '''Reads in each transcript (see Transcript.transcript_count_reads). Returns a DataFrame of transcripts x bams.'''
+        return self._count(bams, self.starts-1, self.ends+1, library_direction=library_direction)
+    
+    def UTR_5prime_count_reads(self, bams, rpkm=False, library_direction='reverse'):
+        '''Reads in each 5 prime UTR (see Transcript.UTR_5prime_count_reads). Returns a DataFrame of transcripts x bams.
+        Transcripts without a CDS are NaN.'''
+        UTR_starts, UTR_ends = self.UTR_5prime()
+        coding = ~np.isnan(UTR_starts)
+        coding_counts = self.take(coding)._count(bams, UTR_starts[coding].astype(np.int64)-1, 
+                                                 UTR_ends[coding].astype(np.int64)+1, library_direction=library_direction)
+        counts = pd.DataFrame(np.nan, index=self.labels(), columns=coding_counts.columns)
+        counts.iloc[np.where(coding)[0]] = coding_counts.values
+        if rpkm:
+            counts = self._rpkm(counts, UTR_ends-UTR_starts)
+        return counts
+    
+
 #####################################################
 ## Tools for reading annotation files and creating ##
 ## instances of Transcript and Organism            ##
 #####################################################
 
-def read_gff3(gff3):
-    names = ['chromosome','source','type','start','end','x','strand','y','ID']
-    ann_df = pd.read_csv(gff3, sep='\t', names=names)
+GFF3_COLUMNS = ['chromosome','source','type','start','end','x','strand','y','attributes']
+_gff3_dtypes = {'chromosome':'category', 'source':'category', 'type':'category', 'start':np.int32, 'end':np.int32,
+                'x':'category', 'strand':'category', 'y':'category', 'attributes':object}
+
+def _gff3_feature_rows(gff3):
+    '''Line numbers of comment lines and the number of feature lines before the ##FASTA section'''
+    skip = []
+    n_features = 0
+    with open(gff3) as f:
+        for n, line in enumerate(f):
+            if line.startswith('#'):
+                if line.startswith('##FASTA'):
+                    break
+                skip.append(n)
+            elif line.strip():
+                n_features += 1
+    return skip, n_features
+
+def gff3_seqids(gff3):
+    '''Sequence ids (column 1 and ##sequence-region pragmas) in a gff3 file, in the order first seen, 
+    without parsing the features'''
+    seqids = OrderedDict()
+    with open(gff3) as f:
+        for line in f:
+            if line.startswith('#'):
+                if line.startswith('##FASTA'):
+                    break
+                if line.startswith('##sequence-region'):
+                    fields = line.split()
+                    if len(fields) > 1:
+                        seqids[fields[1]] = None
+            elif line.strip():
+                seqids[line.split('\t', 1)[0]] = None
+    return seqids.keys()
+
+def read_gff3(gff3, attributes=('ID','Parent','Name'), keep_attributes=False):
+    '''Read the features in a gff3 file into a dataframe. Comment lines and any ##FASTA section are skipped.
+    chromosome, source, type, strand, x (score) and y (phase) are categorical and start and end are int32.
+    
+    Parameters
+    ----------
+    gff3 : str
+        gff3 file
+    attributes : tuple, default ('ID','Parent','Name')
+        Attributes to extract from column 9 into their own columns (NaN if a feature does not have it)
+    keep_attributes : bool, default `False`
+        Also keep the full column 9 string as 'attributes'
+    
+    Returns
+    -------
+    ann_df : pandas.DataFrame
+    '''
+    skip, n_features = _gff3_feature_rows(gff3)
+    if n_features == 0:
+        ann_df = pd.DataFrame(columns=GFF3_COLUMNS)
+    else:
+        ann_df = pd.read_csv(gff3, sep='\t', names=GFF3_COLUMNS, dtype=_gff3_dtypes, skiprows=skip, nrows=n_features,
+                             quoting=csv.QUOTE_NONE, na_filter=False)
+    for attribute in attributes:
+        pattern = r'(?:^|;)\s*'+re.escape(attribute)+r'=([^;]*)'
+        ann_df.loc[:,attribute] = ann_df['attributes'].str.extract(pattern, expand=False)
+    if not keep_attributes:
+        ann_df = ann_df.drop('attributes', axis=1)
     return ann_df
 
+def normalize_transcript_ids(ids):
+    '''Transcript IDs from a gff3 ID or Parent column in the form used for transcript names:
+    strips the transcript: prefix (S. pombe, Ensembl) and the _mRNA suffix (S. cerevisiae)'''
+    ids = pd.Series(ids)
+    return ids.str.replace(r'^transcript:', '').str.replace(r'_mRNA$', '')
+
 def make_fasta_json(fa, write=True):
-    '''Convert fasta file to a dictionary stored in json format
+    '''Convert fasta file to a dictionary stored in json format.
+    Also writes a samtools style .fai index next to the fasta file if there is not one already.
     
     Parameters
     ----------
@@ -97,14 +658,7 @@ def make_fasta_json(fa, write=True):
         write the json file - if False will just return the dictionary
     '''
     
-    fa_dict = {}
-    with open(fasta_file) as f:
-        for line in f:
-            if line.startswith('>'):
-                contig = line.lstrip('>').strip()
-                fa_dict[contig] = ''
-            else:
-                fa_dict[contig] = fa_dict[contig] + line.strip()
+    fa_dict = GT.read_fasta_dict(fa)
     if write:
         fa_name = fa.split('.fa')[0]+'_fa.json'
         with open(fa_name, 'w') as fout: json.dump(fa_dict, fout)
@@ -119,49 +673,87 @@ def populate_transcript_df(gff3, gff3_class='mRNA', organism='crypto'):
         print "gff3_class not found in gff3 file!"
         return None
             
-    transcripts.loc[:,'transcript'] =transcripts['ID'].str.split('ID=').str[1].str.split(';').str[0]
     transcripts = transcripts.reset_index(drop=True)
-    if '_mRNA' in transcripts.loc[0,'transcript']:
-        transcripts.loc[:,'transcript'] =transcripts.loc['transcript'].str.split('_mRNA').str[0]
-    if 'transcript:' in transcripts.loc[0,'transcript']:
-        transcripts.loc[:,'transcript'] =transcripts['transcript'].str.split('transcript:').str[1]
+    transcripts.loc[:,'transcript'] = normalize_transcript_ids(transcripts['ID'])
     return transcripts
 
-def populate_transcripts(gff3, gff3_class='mRNA', organism='crypto'):
+def populate_transcripts(gff3, gff3_class='mRNA', organism='crypto', as_set=False):
+    '''Dictionary of Transcript objects keyed by transcript ID, or a TranscriptSet if as_set is True'''
     ann_df = GT.read_gff3(gff3)
     transcripts = ann_df[ann_df['type'] == gff3_class]
     if len(transcripts) == 0:
         print "gff3_class not found in gff3 file!"
         return None
 
-    transcripts.loc[:,'transcript'] =transcripts['ID'].str.split('ID=').str[1].str.split(';').str[0]
     transcripts = transcripts.reset_index(drop=True)
-    if '_mRNA' in transcripts.loc[0,'transcript']:
-        transcripts.loc[:,'transcript'] =transcripts.loc['transcript'].str.split('_mRNA').str[0]
-    if 'transcript:' in transcripts.loc[0,'transcript']:
-        transcripts.loc[:,'transcript'] =transcripts['transcript'].str.split('transcript:').str[1]
+    transcripts.loc[:,'transcript'] = normalize_transcript_ids(transcripts['ID'])
 
+    if type(organism) == str:
+        organism = autoload_organism(organism)
+    if as_set:
+        return TranscriptSet.from_df(transcripts, organism=organism)
     tx_dict = {}
     for ix, r in transcripts.iterrows():
         tx_dict[r['transcript']] = GT.Transcript(r['transcript'], r['chromosome'], r['start'], r['end'], r['strand'], organism=organism)
 
     return tx_dict
 
+_organism_cache = {}
+
+def _file_key(path):
+    path = os.path.realpath(path)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    return path, mtime
+
+def get_organism(name, fasta_file, gff3):
+    '''Return a shared Organism instance for this genome and annotation. Instances are cached for the
+    life of the process, keyed by the fasta and gff3 paths and modification times, so the sequence and
+    annotation are only read once no matter how many Intron or Transcript objects use them.
+    
+    Parameters
+    ----------
+    name : str
+        Organism name
+    fasta_file : str
+        .json dictionary of chromosome sequences, fasta file or packed genome (.gt2bit)
+    gff3 : str
+        gff3 file for the organism
+    
+    Returns
+    -------
+    org_obj : Organism
+    '''
+    key = (name, _file_key(fasta_file), _file_key(gff3))
+    if key not in _organism_cache:
+        _organism_cache[key] = Organism(name, fasta_file, gff3)
+    return _organism_cache[key]
+
+def clear_organism_cache():
+    '''Drop all cached Organism instances (e.g. to free memory)'''
+    _organism_cache.clear()
+
 def autoload_organism(organism):
+    entry = find_genome_manifest_entry(organism)
+    if entry is not None:
+        return get_organism(entry['name'], entry['packed_genome'], entry['gff3'])
+    
     if 'crypto' in organism.lower() or 'neoformans' in organism.lower() :
-        org_obj = Organism('Cryptococcus neoformans H99', 
+        org_obj = get_organism('Cryptococcus neoformans H99', 
                            '/home/jordan/GENOMES/H99_fa.json', 
                            '/home/jordan/GENOMES/CNA3_FINAL_CALLGENES_1_gobs.gff3')
     elif 'pombe' in organism.lower():
-        org_obj = Organism('Schizosaccharomyces pombe',
+        org_obj = get_organism('Schizosaccharomyces pombe',
                            '/home/jordan/GENOMES/POMBE/Sp_fasta_dict.json',
                            '/home/jordan/GENOMES/POMBE/schizosaccharomyces_pombe.chr.gff3')
     elif 'cerev' in organism.lower() or 'S288C' in organism:
-        org_obj = Organism('Saccharomyces cerevisiae S288C',
+        org_obj = get_organism('Saccharomyces cerevisiae S288C',
                            '/home/jordan/GENOMES/S288C/S288C_fasta_dict.json',
                            '/home/jordan/GENOMES/S288C/saccharomyces_cerevisiae_R64-2-1_20150113.gff3')
     elif 'candida' in organism.lower() or 'albicans' in organism.lower():
-        org_obj = Organism('Candida albicans',
+        org_obj = get_organism('Candida albicans',
                            '/home/jordan/GENOMES/C_albicans_fa.json',
                            '/home/jordan/GENOMES/C_albicans_SC5314_version_A21-s02-m09-r10_features.gff')
     else:
@@ -170,6 +762,190 @@ def autoload_organism(organism):
     return org_obj
                            
 
+#####################################################
+## Preparing genomes and the genome manifest       ##
+#####################################################
+
+GENOME_MANIFEST = 'genetools_manifest.json'
+
+def genome_directory():
+    '''Directory holding prepared genomes and the manifest - $GENETOOLS_GENOMES if set, otherwise GENOMES/ 
+    next to the GeneTools directory'''
+    genome_dir = os.environ.get('GENETOOLS_GENOMES', script_path+'GENOMES/')
+    if not genome_dir.endswith('/'):
+        genome_dir = genome_dir+'/'
+    return genome_dir
+
+_manifest_cache = {}
+
+def read_genome_manifest(genome_dir=None):
+    '''Read the manifest written by prepare_genome. Returns an empty dictionary if there is no manifest.
+    The parsed manifest is kept for the life of the process, keyed by its path and modification time, and is 
+    shared between callers - copy it before making changes.'''
+    if genome_dir is None:
+        genome_dir = genome_directory()
+    try:
+        key = (genome_dir, os.stat(genome_dir+GENOME_MANIFEST).st_mtime)
+    except OSError:
+        key = (genome_dir, None)
+    if key not in _manifest_cache:
+        try:
+            with open(genome_dir+GENOME_MANIFEST) as f:
+                manifest = json.load(f)
+        except IOError:
+            manifest = {}
+        _manifest_cache[key] = manifest
+    return _manifest_cache[key]
+
+def find_genome_manifest_entry(organism, genome_dir=None):
+    '''Find the manifest entry for an organism name (e.g. 'crypto', 'pombe'). Matches the entry key or any of
+    its aliases as a case insensitive substring, the same way as autoload_organism. Returns `None` if not found.'''
+    manifest = read_genome_manifest(genome_dir=genome_dir)
+    for key, entry in manifest.iteritems():
+        for alias in [key]+entry.get('aliases', []):
+            if alias.lower() in organism.lower():
+                return entry
+    return None
+
+def _write_genome_manifest(genome_dir, key, entry):
+    manifest = dict(read_genome_manifest(genome_dir=genome_dir))
+    manifest[key] = entry
+    tmp_name = '{0}{1}.tmp{2}'.format(genome_dir, GENOME_MANIFEST, os.getpid())
+    with open(tmp_name, 'w') as fout:
+        json.dump(manifest, fout, indent=2, sort_keys=True)
+    os.rename(tmp_name, genome_dir+GENOME_MANIFEST)
+    # A rewrite within the file system's mtime resolution would otherwise keep the old manifest
+    _manifest_cache.clear()
+
+def _read_centromeres(centromeres):
+    '''Centromere locations {chrom:[start, end]} from a json file or a gff3 file of features where centromere
+    IDs start with cen'''
+    if isinstance(centromeres, dict):
+        return centromeres
+    if centromeres.endswith('.json'):
+        with open(centromeres) as f:
+            return json.load(f)
+    cen_dict = {}
+    for ix, r in read_gff3(centromeres).iterrows():
+        name = str(r['ID'])
+        if name.lower().startswith('cen'):
+            cen_dict[r['chromosome']] = [int(r['start']), int(r['end'])]
+    return cen_dict
+
+def _prepare_genome_task(args):
+    task, files = args
+    if task == 'packed_genome':
+        GT.make_packed_genome(files['fasta'], files['packed_genome'])
+    
+    elif task == 'sizes':
+        lengths = OrderedDict()
+        for contig, seq in GT.iter_fasta(files['fasta']):
+            lengths[contig.split()[0]] = len(seq)
+        with open(files['genome_sizes'], 'w') as fout:
+            for contig, length in lengths.iteritems():
+                fout.write(contig+'\t'+str(length)+'\n')
+        with open(files['chrom_lengths'], 'w') as fout:
+            json.dump(lengths, fout)
+    
+    elif task == 'annotation_cache':
+        GT.load_transcript_arrays(files['gff3'], organism=files['organism_flag'])
+    
+    elif task == 'introns':
+        intron_df = GT.build_intron_df(files['gff3'])
+        intron_df.to_csv(files['introns'])
+    
+    elif task == 'centromeres':
+        with open(files['centromeres'], 'w') as fout:
+            json.dump(_read_centromeres(files['centromere_source']), fout)
+    
+    elif task == 'pssm_5prime' or task == 'pssm_3prime':
+        org_obj = Organism(files['name'], files['packed_genome'], files['gff3'])
+        position = ('5prime',-2,6) if task == 'pssm_5prime' else ('3prime',-6,2)
+        GT.build_consensus_matrix(org_obj, files['gff3'], files['packed_genome'], files[task], position=position)
+    return task
+
+def prepare_genome(name, fasta_file, gff3, key=None, aliases=None, organism_flag=None, centromeres=None,
+                   bowtie_index=None, genome_dir=None, threads=1):
+    '''Build all derived genome files from a fasta and gff3 pair and register them in the genome manifest,
+    which is read by autoload_organism and find_organism_files. Independent steps run in parallel.
+    
+    Outputs (in genome_dir, named from the key):
+        key.gt2bit - packed genome (see load_genome)
+        key_for_bedgraph.genome - contig sizes for bedtools
+        key_chrom_lengths.json - contig sizes
+        key_centromeres.json - centromere locations (if centromeres provided)
+        key_introns.csv - intron table from build_intron_df
+        key_5prime_PSSM.txt and key_3prime_PSSM.txt - splice site PSSMs from build_consensus_matrix
+        The annotation cache for build_transcript_dict is written next to the gff3 file.
+    
+    Parameters
+    ----------
+    name : str
+        Organism name (e.g. 'Cryptococcus neoformans H99')
+    fasta_file : str
+        Genome fasta file
+    gff3 : str
+        gff3 file for the organism
+    key : str, default `None`
+        Short name used for the output files and manifest entry (e.g. 'crypto'). Defaults to the fasta file name.
+    aliases : list, default `None`
+        Other names that should find this organism (e.g. ['neoformans', 'H99'])
+    organism_flag : str, default `None`
+        organism argument for build_transcript_dict ('pombe' for S. pombe style gff3 files)
+    centromeres : str or dict, default `None`
+        json file or gff3 file (IDs starting with cen) with centromere locations
+    bowtie_index : str, default `None`
+        Bowtie index prefix to record in the manifest
+    genome_dir : str, default `None`
+        Output directory. Defaults to genome_directory().
+    threads : int, default 1
+        Number of processes
+    
+    Returns
+    -------
+    entry : dict
+        The manifest entry for the organism
+    '''
+    if genome_dir is None:
+        genome_dir = genome_directory()
+    if not genome_dir.endswith('/'):
+        genome_dir = genome_dir+'/'
+    if not os.path.exists(genome_dir):
+        os.makedirs(genome_dir)
+    if key is None:
+        key = os.path.basename(fasta_file).split('.')[0]
+    
+    prefix = os.path.abspath(genome_dir+key)
+    files = {'name':name, 'fasta':os.path.abspath(fasta_file), 'gff3':os.path.abspath(gff3),
+             'organism_flag':organism_flag, 'packed_genome':prefix+GT.PACKED_GENOME_EXT,
+             'genome_sizes':prefix+'_for_bedgraph.genome', 'chrom_lengths':prefix+'_chrom_lengths.json',
+             'annotation_cache':GT.transcript_cache_name(os.path.abspath(gff3), organism=organism_flag),
+             'introns':prefix+'_introns.csv', 'pssm_5prime':prefix+'_5prime_PSSM.txt', 
+             'pssm_3prime':prefix+'_3prime_PSSM.txt'}
+    
+    tasks = ['packed_genome', 'sizes', 'annotation_cache', 'introns']
+    if centromeres is not None:
+        files['centromere_source'] = centromeres
+        files['centromeres'] = prefix+'_centromeres.json'
+        tasks.append('centromeres')
+    
+    # PSSMs read the packed genome so are run once it is finished
+    p = Pool(max(min(threads, len(tasks)), 1))
+    for task in p.imap_unordered(_prepare_genome_task, [(task, files) for task in tasks]):
+        print "Finished "+task
+        if task == 'packed_genome':
+            pssm_results = p.map_async(_prepare_genome_task, [(task, files) for task in ['pssm_5prime','pssm_3prime']])
+    for task in pssm_results.get():
+        print "Finished "+task
+    p.close()
+    p.join()
+    
+    entry = {k:v for k, v in files.iteritems() if k != 'centromere_source'}
+    entry['aliases'] = list(aliases) if aliases is not None else []
+    entry['bowtie_index'] = bowtie_index
+    _write_genome_manifest(genome_dir, key, entry)
+    return entry
+
 #############################################################
 ## Tools for adding homologs and orthologs to spreadsheets ##
 #############################################################
@@ -8,15 +8,18 @@ import math
 import numpy as np
 import pandas as pd
 from collections import OrderedDict
+import collections
 import csv
+import re
+from datetime import datetime
 
 script_path = os.path.dirname(os.path.realpath(__file__))+'/'
 sys.path.append(script_path)
+sys.path.append(script_path.split('GeneTools')[0])
+import GeneTools as GT
 
 def count_aligned_reads_bedgraph(bam):
-    command = 'samtools view -F 0x904 -c {0}'.format(bam)
-    aligned_reads = check_output(command.split(), shell=False)
-    aligned_reads = float(aligned_reads)/1000000
+    aligned_reads = float(GT.library_size(bam, exclude_flags=0x904))/1000000
     print '\n'+bam
     print "{0} million reads".format("%.2f" % aligned_reads)
     return {bam:1/aligned_reads}
@@ -28,7 +31,10 @@ def run_genomeCoverageBed(command):
     return ret_code
 
 def generate_scaled_bedgraphs2(directory, untagged, organism='crypto', start_only=False, stranded=False, threads=1, expand=False, bam_list=None):
-    if 'crypto' in organism.lower():
+    entry = GT.find_genome_manifest_entry(organism)
+    if entry is not None:
+        genome = entry['genome_sizes']
+    elif 'crypto' in organism.lower():
         genome = script_path+'GENOMES/crypto_for_bedgraph.genome'
     elif 'cerev' in organism.lower():
         genome = script_path+'GENOMES/S288C/S288C_for_bedgraph.genome'
@@ -130,8 +136,7 @@ def generate_scaled_bedgraphs(directory, organism='crypto', start_only=False, st
     total_aligned = []
     for bam in bam_list:
         print bam
-        command = 'samtools view -F 0x904 -c {0}'.format(bam)
-        aligned_reads = check_output(command.split(), shell=False)
+        aligned_reads = GT.library_size(bam, exclude_flags=0x904)
         total_aligned.append(aligned_reads)
         print "Total aligned reads in "+bam
         print aligned_reads
@@ -201,31 +206,30 @@ def build_bedgraph_dict(transcript_dict, bedgraph_file):
     print datetime.now()
     bedgraph_dict = {}
     transcript_by_chr = {}
+    aliases = GT.ContigAliases()
     for transcript, coords in transcript_dict.iteritems():
-        chromosome = coords[3]
+        contig_id = aliases.add(coords[3].strip())
         bedgraph_dict[transcript] = [[],[]]
-        if chromosome in transcript_by_chr:
-            transcript_by_chr[chromosome].append(transcript)
+        if contig_id in transcript_by_chr:
+            transcript_by_chr[contig_id].append(transcript)
         else:
-            transcript_by_chr[chromosome] = []
-            transcript_by_chr[chromosome].append(transcript)
+            transcript_by_chr[contig_id] = []
+            transcript_by_chr[contig_id].append(transcript)
     
     with open(bedgraph_file, "r") as bedgraph:
         for line in bedgraph:
             columns = re.split(r'\t', line)
-            bed_chr = columns[0].strip()
-            rom_lat = {'I':'chr1','II':'chr2','III':'chr3','MT':'MT'}
-            if bed_chr in rom_lat:
-                bed_chr = rom_lat[bed_chr]
+            contig_id = aliases.get_id(columns[0].strip())
+            if contig_id not in transcript_by_chr:
+                continue
             bed_position = int(columns[1])
             bed_peak = float(columns[3])
             
-            if bed_chr in transcript_by_chr:
-                transcript_list = transcript_by_chr[bed_chr]
+            transcript_list = transcript_by_chr[contig_id]
             for transcript in transcript_list:  
                 
                 #Dictionary for bedgraph. Values will be [list of genomic positions][reads starting at that position]
-                if bed_chr == transcript_dict[transcript][3].strip() and bed_position > transcript_dict[transcript][0] and bed_position < transcript_dict[transcript][1]:
+                if bed_position > transcript_dict[transcript][0] and bed_position < transcript_dict[transcript][1]:
                     bedgraph_dict[transcript][0].append(bed_position)
                     bedgraph_dict[transcript][1].append(bed_peak)
    
@@ -202,23 +202,15 @@ def make_name(string):
     name = string.split('/')[-1].split('_sorted')[0]
     return name
 
-def count_reads_in_ChIP(prom_dict, bam_file):
-    bam = pysam.Samfile(bam_file)
+def count_reads_in_ChIP(prom_dict, bam_file, threads=1):
     total = GT.count_aligned_reads(bam_file)
     print total
 
-    rpkm_s = pd.Series(index=prom_dict.keys())
-    for tx, info in prom_dict.iteritems():
-        read_count = 0
-        if info[1]-info[0] <= 0:
-            pass
-        else:
-            read_count += GT.count_reads_in_window(bam, info[3], info[0], info[1], '+')
-            read_count += GT.count_reads_in_window(bam, info[3], info[0], info[1], '-')
-            length = (info[1]-info[0])/1000.
-            rpkm = read_count/length/total
-            rpkm_s[tx] = rpkm
-    rpkm_s = rpkm_s.dropna()
+    regions = pd.DataFrame([(tx, info[3], info[0], info[1]) for tx, info in prom_dict.iteritems() if info[1]-info[0] > 0],
+                           columns=['transcript','chromosome','start','end'])
+    read_counts = GT.count_reads_in_regions(bam_file, regions, library_direction='unstranded', threads=threads).values[:,0]
+    length = (regions['end']-regions['start']).values/1000.
+    rpkm_s = pd.Series(read_counts/length/total, index=regions['transcript'].values)
     return rpkm_s
 
 
@@ -448,37 +440,162 @@ def ChIP_rpkm_scatter(WCE_bam, WT1_bam, WT2_bam, Mut1_bam, Mut2_bam, gff3, plot_
 ## Functions for analyzing peaks called by MACS ##
 ##################################################
 
+def peak_overlaps(df_a, df_b, chrom_column='chr', summit_column='abs_summit'):
+    '''Find every overlapping pair of peaks between two peak tables. Peaks are treated as half open [start, end)
+    and pairs are found with an IntervalIndex sweep per chromosome instead of comparing every base.
+    
+    Parameters
+    ----------
+    df_a : pandas.DataFrame
+            Peaks, e.g. from MACS xls output
+    df_b : pandas.DataFrame
+            Peaks to compare against
+    chrom_column : str, default 'chr'
+            Column with the chromosome in both tables
+    summit_column : str, default 'abs_summit'
+            Column with the summit position in both tables
+    
+    Returns
+    -------
+    pairs : pandas.DataFrame
+            One row per overlapping pair, sorted by a then b, with columns a and b (row positions in df_a and df_b),
+            overlap (bp), fraction_a and fraction_b (overlap / peak length), summit_distance and the contracted 
+            region start and end
+    '''
+    a_starts = df_a['start'].values.astype(np.int64)
+    a_ends = df_a['end'].values.astype(np.int64)
+    b_starts = df_b['start'].values.astype(np.int64)
+    b_ends = df_b['end'].values.astype(np.int64)
+    
+    index = GT.IntervalIndex(df_b[chrom_column].values, b_starts, b_ends)
+    a, b = index.overlap_pairs(df_a[chrom_column].values, a_starts, a_ends)
+    
+    start = np.maximum(a_starts[a], b_starts[b])
+    end = np.minimum(a_ends[a], b_ends[b])
+    overlap = end-start
+    pairs = pd.DataFrame({'a':a, 'b':b, 'overlap':overlap,
+                          'fraction_a':overlap/(a_ends[a]-a_starts[a]).astype(float),
+                          'fraction_b':overlap/(b_ends[b]-b_starts[b]).astype(float),
+                          'start':start, 'end':end},
+                         columns=['a','b','overlap','fraction_a','fraction_b','summit_distance','start','end'])
+    if summit_column in df_a.columns and summit_column in df_b.columns:
+        pairs.loc[:,'summit_distance'] = np.abs(df_a[summit_column].values[a]-df_b[summit_column].values[b])
+    return pairs
+
+def match_peaks(df_a, df_b, min_overlap=0.5, strict=True, nearest_summit=True, chrom_column='chr', summit_column='abs_summit'):
+    '''Match each peak in df_a to one peak in df_b that covers enough of it.
+    
+    Parameters
+    ----------
+    df_a : pandas.DataFrame
+            Peaks to match
+    df_b : pandas.DataFrame
+            Peaks to match against
+    min_overlap : float, default 0.5
+            Minimum fraction of the df_a peak covered by the df_b peak
+    strict : bool, default `True`
+            If True the fraction must be greater than min_overlap, otherwise greater than or equal
+    nearest_summit : bool, default `True`
+            If True pick the match with the nearest summit, otherwise the first match in df_b order. 
+            Ties go to the first match in df_b order.
+    chrom_column : str, default 'chr'
+    summit_column : str, default 'abs_summit'
+    
+    Returns
+    -------
+    matches : pandas.DataFrame
+            Indexed like df_a with columns match (row position in df_b, -1 if none), fraction (of the df_a peak)
+            and the contracted region start and end (the df_a peak if there is no match)
+    '''
+    pairs = peak_overlaps(df_a, df_b, chrom_column=chrom_column, summit_column=summit_column)
+    if strict:
+        pairs = pairs[pairs['fraction_a'] > min_overlap]
+    else:
+        pairs = pairs[pairs['fraction_a'] >= min_overlap]
+    if nearest_summit:
+        pairs = pairs.sort_values(['a','summit_distance','b'], kind='mergesort')
+    pairs = pairs.drop_duplicates(subset=['a'])
+    
+    match = np.zeros(len(df_a), dtype=np.int64)-1
+    fraction = np.zeros(len(df_a))
+    starts = df_a['start'].values.copy()
+    ends = df_a['end'].values.copy()
+    a = pairs['a'].values
+    match[a] = pairs['b'].values
+    fraction[a] = pairs['fraction_a'].values
+    starts[a] = pairs['start'].values
+    ends[a] = pairs['end'].values
+    
+    matches = pd.DataFrame({'match':match, 'fraction':fraction, 'start':starts, 'end':ends}, index=df_a.index,
+                           columns=['match','fraction','start','end'])
+    return matches
+
+def assign_peaks_to_transcripts(peak_df, tx_dict, windows=(500,1000), chrom_column='chr', summit_column='abs_summit'):
+    '''Assign peak summits to transcripts. A summit is assigned to a transcript if it is within the transcript or
+    within window bp upstream of it. Windows are tried in order and a peak is only tested with the next window
+    if nothing was found with the previous one. All peaks are assigned at once with an IntervalIndex per window.
+    
+    Parameters
+    ----------
+    peak_df : pandas.DataFrame
+            Peaks, e.g. from MACS xls output
+    tx_dict : dict
+            Generated by build_transcript_dict
+    windows : tuple, default (500, 1000)
+            Upstream distances to try in order
+    chrom_column : str, default 'chr'
+            Column in peak_df with the chromosome
+    summit_column : str, default 'abs_summit'
+            Column in peak_df with the summit position
+    
+    Returns
+    -------
+    mapping : pandas.DataFrame
+            One row per peak-transcript pair with columns peak (index of peak_df), transcript and window
+    '''
+    names = np.array(tx_dict.keys(), dtype=object)
+    info = tx_dict.values()
+    chroms = np.array([x[3] for x in info], dtype=object)
+    starts = np.array([x[0] for x in info], dtype=np.int64)
+    ends = np.array([x[1] for x in info], dtype=np.int64)
+    plus = np.array([x[2] == '+' for x in info], dtype=bool)
+    minus = np.array([x[2] == '-' for x in info], dtype=bool)
+    order = np.lexsort((names, starts))
+    
+    summits = peak_df[summit_column].values.astype(np.int64)
+    peak_chroms = peak_df[chrom_column].values
+    unassigned = np.arange(len(peak_df))
+    peak_rows = []
+    tx_rows = []
+    tx_windows = []
+    for window in windows:
+        # Strand specific windows: [start-window, end) for + and [start, end+window) for -
+        keep = order[plus[order] | minus[order]]
+        index = GT.IntervalIndex(chroms[keep], np.where(plus[keep], starts[keep]-window, starts[keep]),
+                                 np.where(plus[keep], ends[keep], ends[keep]+window))
+        q, t = index.overlap_pairs(peak_chroms[unassigned], summits[unassigned], summits[unassigned]+1)
+        peak_rows.append(unassigned[q])
+        tx_rows.append(keep[t])
+        tx_windows.append(np.zeros(len(q), dtype=int)+window)
+        unassigned = np.setdiff1d(unassigned, unassigned[q])
+    
+    peak_rows = np.concatenate(peak_rows)
+    tx_rows = np.concatenate(tx_rows)
+    sort = np.argsort(peak_rows, kind='mergesort')
+    mapping = pd.DataFrame({'peak':peak_df.index.values[peak_rows[sort]], 'transcript':names[tx_rows[sort]], 
+                            'window':np.concatenate(tx_windows)[sort]}, columns=['peak','transcript','window'])
+    return mapping
+
 def add_transcript(df, gff3, organism=None):
     ''' Used by MACS_peak_RPKM_scatters'''
     tx_dict = GT.build_transcript_dict(gff3, organism=organism)
-    transcripts = set()
-    transcripts_for_df = []
-    for ix, r in df.iterrows():
-        r_tx = ''
-        chrom_tx = {k:v for k, v in tx_dict.items() if v[3] == r['chr']}
-        for tx, info in chrom_tx.iteritems():
-            if tx[:-2] not in r_tx:
-                if info[2] == '+':
-                    if r['abs_summit'] in range(info[0]-500,info[1]):
-                        r_tx = r_tx+tx[:-2]+','
-                        transcripts.add(tx[:-2])
-                if info[2] == '-':
-                    if r['abs_summit'] in range(info[0],info[1]+500):
-                        r_tx = r_tx+tx[:-2]+','
-                        transcripts.add(tx[:-2])
-        if r_tx == '':
-            for tx, info in chrom_tx.iteritems():
-                if tx[:-2] not in r_tx:
-                    if info[2] == '+':
-                        if r['abs_summit'] in range(info[0]-1000,info[1]):
-                            r_tx = r_tx+tx[:-2]+','
-                            transcripts.add(tx[:-2])
-                    if info[2] == '-':
-                        if r['abs_summit'] in range(info[0],info[1]+1000):
-                            r_tx = r_tx+tx[:-2]+','
-                            transcripts.add(tx[:-2])
-        transcripts_for_df.append(r_tx)
-    df.loc[:,'transcript'] = transcripts_for_df
+    mapping = assign_peaks_to_transcripts(df.reset_index(drop=True), tx_dict)
+    mapping.loc[:,'gene'] = mapping['transcript'].str[:-2]
+    mapping = mapping.drop_duplicates(subset=['peak','gene'])
+    transcripts = set(mapping['gene'])
+    
+    joined = mapping.groupby('peak')['gene'].apply(lambda x: ''.join([gene+',' for gene in x]))
+    df.loc[:,'transcript'] = [joined.get(n, '') for n in range(len(df))]
     return df, transcripts
         
 def compare_MACS_output(rep1_xls, rep2_xls, untagged_xls, organism, return_df=False, min_overlap=0.5, cutoff=2):
@@ -500,59 +617,24 @@ def compare_MACS_output(rep1_xls, rep2_xls, untagged_xls, organism, return_df=Fa
     df2 = df2[df2['fold_enrichment'] >= cutoff]
     df_un = pd.read_csv(untagged_xls, sep='\t', skiprows=28, header=0)
     
-    # Determine if peak is in each replicate
-    rep = []
-    enrich2 = []
-    starts = []
-    ends = []
-    for ix, r in df1.iterrows():
-        r_rep = False
-        peak = range(r['start'],r['end'])
-        
-        # Check if there are peaks in the second replicate with the minimum overlap
-        rep2_df = df2[df2['chr'] == r['chr']]
-        rep2_matches = []
-        for ix2, r2 in rep2_df.iterrows():
-            peak_overlap = len(set(peak).intersection(range(r2['start'],r2['end'])))
-            if peak_overlap/float(len(peak)) > min_overlap:
-                rep2_matches.append(ix2)
-        
-        
-        rep2_matches = rep2_df[rep2_df.index.isin(rep2_matches)]
-        if len(rep2_matches) > 0:
-            rep.append(True)
-            r_rep = True
-            
-            # Determine the nearest absolute summit and record fold enrichment in replicate
-            s = (rep2_matches['abs_summit']-r['abs_summit']).apply(abs)
-            min_dist = s[s == min(s)].index[0]
-            enrich2.append(rep2_matches.loc[min_dist,'fold_enrichment'])
-            
-            # Contract peak window to the reproducible region
-            new_start = max(rep2_matches.loc[min_dist,'start'], r['start'])
-            new_end = min(rep2_matches.loc[min_dist,'end'], r['end'])
-            starts.append(new_start)
-            ends.append(new_end)
-        else:
-            rep.append(False)
-            enrich2.append(np.NaN)
-            starts.append(r['start'])
-            ends.append(r['end'])
-            
-    df1.loc[:,'In replicate'] = rep
+    # Determine if peak is in each replicate, record fold enrichment of the match with the nearest summit
+    # and contract the peak window to the reproducible region
+    matches = match_peaks(df1, df2, min_overlap=min_overlap, strict=True, nearest_summit=True)
+    matched = matches['match'].values >= 0
+    enrich2 = np.zeros(len(df1))+np.NaN
+    enrich2[matched] = df2['fold_enrichment'].values[matches['match'].values[matched]]
+    
+    df1.loc[:,'In replicate'] = matched
     df1.loc[:,'fold_enrichment2'] = enrich2
-    df1.loc[:,'start'] = starts
-    df1.loc[:,'end'] = ends
-    
-    # Determine if peak is in untagged
-    un = []
-    for ix, r in df1.iterrows():
-        peak = range(r['start'],r['end'])
-        un_matches = df_un[(df_un['chr'] == r['chr']) & (df_un['abs_summit'].isin(peak))]
-        if len(un_matches) > 0:
-            un.append(True)
-        else:
-            un.append(False)
+    df1.loc[:,'start'] = matches['start'].values
+    df1.loc[:,'end'] = matches['end'].values
+    
+    # Determine if peak is in untagged (untagged summit within the peak)
+    un_summits = df_un['abs_summit'].values.astype(np.int64)
+    un_index = GT.IntervalIndex(df_un['chr'].values, un_summits, un_summits+1)
+    q, u = un_index.overlap_pairs(df1['chr'].values, df1['start'].values, df1['end'].values)
+    un = np.zeros(len(df1), dtype=bool)
+    un[q] = True
     df1.loc[:,'In untagged'] = un
     
     # Filter based on reproducibility and untagged
@@ -589,43 +671,34 @@ def compare_MACS_output(rep1_xls, rep2_xls, untagged_xls, organism, return_df=Fa
 
 def wt_v_mut_MACS(df1, df2, min_overlap=0.5):
     ''' Used by MACS_peak_RPKM_scatters'''
-    enrich_mut1 = []
-    enrich_mut2 = []
-    for ix, r in df1.iterrows():
-        match = False
-        chrom_df = df2[df2['chr'] == r['chr']]
-        range1 = set(range(r['start'],r['end']))
-        for ix2, r2 in chrom_df.iterrows():
-            range2 = range(r2['start'],r2['end'])
-            if len(range1.intersection(range2))/float(len(range1)) >= min_overlap:
-                enrich_mut1.append(r2['fold_enrichment'])
-                enrich_mut2.append(r2['fold_enrichment2'])
-                match = True
-                break
-        if not match:
-            enrich_mut1.append(np.NaN)
-            enrich_mut2.append(np.NaN)
-    
+    # First peak in df2 covering enough of each df1 peak
+    matches = match_peaks(df1, df2, min_overlap=min_overlap, strict=False, nearest_summit=False)
+    matched = matches['match'].values >= 0
+    rows = matches['match'].values[matched]
+    enrich_mut1 = np.zeros(len(df1))+np.NaN
+    enrich_mut2 = np.zeros(len(df1))+np.NaN
+    enrich_mut1[matched] = df2['fold_enrichment'].values[rows]
+    enrich_mut2[matched] = df2['fold_enrichment2'].values[rows]
     df1.loc[:,'fold_enrichment mut1'] = enrich_mut1
     df1.loc[:,'fold_enrichment mut2'] = enrich_mut2
     
     print len(df1)
-    counter = 0
-    for ix, r in df2.iterrows():
-        match = False
-        chrom_df = df1[df1['chr'] == r['chr']]
-        range1 = set(range(r['start'],r['end']))
-        for ix2 in chrom_df.index:
-            range2 = range(chrom_df.loc[ix2,'start'], chrom_df.loc[ix2,'end'])
-            if len(range1.intersection(range2))/float(len(range1)) >= min_overlap:
-                match = True
-                break
-        if not match:
-            new_row = df2.loc[ix,:]
-            new_row = new_row.rename({'fold_enrichment': 'fold_enrichment mut1', 'fold_enrichment2': 'fold_enrichment mut2'})
-            df1 = df1.append(new_row)
-            df1 = df1.reset_index(drop=True)
-            counter += 1
+    # Add df2 peaks not covered by a df1 peak. A df2 peak covered by a df2 peak that was already added is 
+    # also skipped, so each new row is checked against the earlier added rows.
+    unmatched = match_peaks(df2, df1, min_overlap=min_overlap, strict=False)['match'].values < 0
+    candidates = np.where(unmatched)[0]
+    pairs = peak_overlaps(df2.iloc[candidates], df2.iloc[candidates])
+    pairs = pairs[(pairs['fraction_a'] >= min_overlap) & (pairs['b'] < pairs['a'])]
+    covered_by = pairs.groupby('a')['b'].apply(list).to_dict()
+    added = np.zeros(len(candidates), dtype=bool)
+    for n in range(len(candidates)):
+        added[n] = not any(added[m] for m in covered_by.get(n, []))
+    
+    new_rows = df2.iloc[candidates[added]].rename(columns={'fold_enrichment': 'fold_enrichment mut1', 
+                                                           'fold_enrichment2': 'fold_enrichment mut2'})
+    counter = len(new_rows)
+    if counter > 0:
+        df1 = pd.concat([df1, new_rows]).reset_index(drop=True)
     print counter
     print len(df1)
     
@@ -683,32 +756,14 @@ def MACS_scatter_plots(df, xls_pair1, xls_pair2):
 
 def genome_tiles(chromosome_sizes, tile_size=1000):
     ''' Used by MACS_peak_RPKM_scatters'''
-    names = []
-    chroms = []
-    start = []
-    end = []
+    lengths = []
     with open(chromosome_sizes) as f:
         for line in f:
-            chrom = line.split('\t')[0]
-            size = int(line.split('\t')[1].strip())
-            n = 0
-            while n*tile_size < size-tile_size:
-                chroms.append(chrom)
-                names.append(chrom+'-'+str(n))
-                start.append(n*tile_size)
-                end.append(n*tile_size+tile_size)
-                n += 1
-            chroms.append(chrom)
-            names.append(chrom+'-'+str(n))
-            start.append(n*tile_size)
-            end.append(size)
-    df = pd.DataFrame(index=names)
-    df.loc[:,'chromosome'] = chroms
-    df.loc[:,'start'] = start
-    df.loc[:,'end'] = end
+            lengths.append((line.split('\t')[0], int(line.split('\t')[1].strip())))
+    df = GT.Tiles.fixed(lengths, tile_size).to_df()
     return df
 
-def count_reads_in_tiles(bam_list, WCE, chromosome_sizes, tile_size=1000):
+def count_reads_in_tiles(bam_list, WCE, chromosome_sizes, tile_size=1000, threads=1):
     ''' Used by MACS_peak_RPKM_scatters'''
     df = genome_tiles(chromosome_sizes)
     
@@ -720,17 +775,12 @@ def count_reads_in_tiles(bam_list, WCE, chromosome_sizes, tile_size=1000):
             WCE_name = bam_name
         else:
             names.append(bam_name)
-        open_bam = pysam.Samfile(bam)
-
-        read_dens = []
-        for ix, r in df.iterrows():
-            read_counter = 0
-            try:
-                for read in open_bam.fetch(r['chromosome'],r['start'],r['end']):
-                    read_counter += 1
-                read_dens.append(read_counter/((r['end']-r['start'])/1000.))
-            except ValueError:
-                read_dens.append(np.NaN)
+        
+        # Tiles on chromosomes that are not in the bam file are NaN
+        in_bam = df['chromosome'].isin(GT.open_bam(bam).references).values
+        read_dens = np.zeros(len(df))+np.NaN
+        counts = GT.count_reads_in_regions(bam, df[in_bam], library_direction='unstranded', threads=threads).values[:,0]
+        read_dens[in_bam] = counts/((df['end'].values[in_bam]-df['start'].values[in_bam])/1000.)
         
         df.loc[:,bam_name] = read_dens
         df.loc[:,bam_name] = df[bam_name].divide(sum(df[bam_name].dropna())/1000000.)
@@ -1095,16 +1145,17 @@ def get_peak_sequence2(csv, gene_list=None, fa_dict_loc=script_path+'GENOMES/H99
                 holder.append(line.strip())
         gene_list = holder
     
-    with open(fa_dict_loc) as f: fa_dict = json.load(f)
+    fa_dict = GT.load_genome(fa_dict_loc)
     df = pd.read_csv(csv, index_col=0)
     
+    coords = df.index.to_series().str.extract(r'^(.+):(\d+)-(\d+)$', expand=True)
+    intervals = pd.DataFrame({'chromosome':coords[0].values, 'start':coords[1].astype(int).values, 
+                              'end':coords[2].astype(int).values+1})
+    seqs = GT.fetch_sequences(intervals, fa_dict)
+    
     seq_list = []
     seq_list2 = []
-    for ix, r in df.iterrows():
-        chrom = ix.split(':')[0]
-        start = int(ix.split(':')[1].split('-')[0])
-        end = int(ix.split(':')[1].split('-')[1])
-        seq = GT.seq_simple(chrom, start, end, '+', fa_dict)
+    for (ix, r), seq in zip(df.iterrows(), seqs):
         try:
             transcripts = [x for x in r['transcript'].split(',') if '_1' not in x]
         except AttributeError:
@@ -1133,11 +1184,9 @@ def get_peak_sequence2(csv, gene_list=None, fa_dict_loc=script_path+'GENOMES/H99
                 fout.write(seq+'\n')
                 
 def plot_peaks(bam_list, peak_csv, organism='crypto', colors=None, save_dir=None, log_scale=False, same_yaxis=True, rpm=True):
+    org_obj = GT.autoload_organism(organism)
     organism, gff3, fa_dict, bowtie_index = GT.find_organism_files(organism)
     tx_dict = GT.build_transcript_dict(gff3, organism=organism)
-    fix_info = {'I':'chr1','II':'chr2','III':'chr3','chr1':'I','chr2':'II','chr4':'IV','chr5':'V','chr6':'VI',
-                'chr7':'VII','chr8':'VIII','chr9':'IX','chr10':'X','chr11':'XI','chr12':'XII','chr13':'XIII',
-                'chr14':'XIV','chr15':'XV','chr16':'XVI','-':'+','+':'-','chr1':'I','chr2':'II','chr3':'III'}
     if organism == 'pombe':
         tx_suffix = '.1'
     else:
@@ -1148,9 +1197,11 @@ def plot_peaks(bam_list, peak_csv, organism='crypto', colors=None, save_dir=None
         for n in range(len(bam_list)): colors.append('k')
     
     open_bams = {}
+    bam_contigs = {}
     totals = {}
     for bam in bam_list:
-        open_bams[bam] = pysam.Samfile(bam)
+        open_bams[bam] = GT.open_bam(bam)
+        bam_contigs[bam] = org_obj.bam_contigs(bam)
         if rpm:
             totals[bam] = GT.count_aligned_reads(bam)
         else:
@@ -1170,11 +1221,8 @@ def plot_peaks(bam_list, peak_csv, organism='crypto', colors=None, save_dir=None
         max_y = 0
         junc_ymax = 0
         for n, bam in enumerate(bam_list):
-            try:
-                bam_iter = open_bams[bam].fetch(chrom, start, end)
-            except ValueError:
-                chrom = fix_info[chrom]
-                bam_iter = open_bams[bam].fetch(chrom, start, end)
+            chrom = bam_contigs[bam].get(org_obj.aliases.get_id(chrom), chrom)
+            bam_iter = open_bams[bam].fetch(chrom, start, end)
             s = GT.generate_read_series(bam_iter, chrom, start, end, '+')
             s.add(GT.generate_read_series(bam_iter, chrom, start, end, '-'))
             s = s.replace([np.NaN],0)
@@ -1256,17 +1304,9 @@ def read_feature_gff3(gff3):
     return feature_dict
 
 def read_fa(fa):
-    fa_dict = {}
-    with open(fa) as f:
-        for line in f:
-            if line.startswith('>'):
-                contig = line.lstrip('>').strip()
-                fa_dict[contig] = ''
-            else:
-                fa_dict[contig] = fa_dict[contig]+line.strip()
-    return fa_dict
+    return GT.read_fasta_dict(fa)
                 
-def make_tile_df(directory, tile_size=5000, organism='crypto', gff3=None, fa=None):
+def make_tile_df(directory, tile_size=5000, organism='crypto', gff3=None, fa=None, threads=1):
     '''Creates a spreadsheet that contains RPKM values for tiles across the entire genome from bam files. Can also
     classify each tile based on a gff3 file if desired (e.g. centromeres and telomeres).
     
@@ -1280,6 +1320,8 @@ def make_tile_df(directory, tile_size=5000, organism='crypto', gff3=None, fa=Non
             'crypto' or 'pombe' 
     gff3 : str, default `None`
             gff3 format file containing features. Tiles will be classified based on the boundaries described in this file
+    threads : int, default 1
+            Number of processes for counting reads (see count_reads_in_regions)
             
     Returns
     ------
@@ -1296,17 +1338,17 @@ def make_tile_df(directory, tile_size=5000, organism='crypto', gff3=None, fa=Non
     # Load in tiles from dictionary
     if 'crypto' in organism.lower():
         if fa is None:
-            with open(script_path+'GENOMES/H99_fa.json') as f: fa_dict = json.load(f)
+            fa_dict = GT.load_genome(script_path+'GENOMES/H99_fa.json')
         else:
-            fa_dict = read_fa(fa)
+            fa_dict = GT.load_genome(fa)
         length_dict = {}
         for chrom, seq in fa_dict.iteritems():
             length_dict[chrom] = len(seq)
     elif 'pombe' in organism.lower():
         if fa is None:
-            with open(script_path+'GENOMES/POMBE/Sp_fasta_dict.json') as f: fa_dict = json.load(f)
+            fa_dict = GT.load_genome(script_path+'GENOMES/POMBE/Sp_fasta_dict.json')
         else:
-            fa_dict = read_fa(fa)
+            fa_dict = GT.load_genome(fa)
         length_dict = {}
         for chrom, seq in fa_dict.iteritems():
             length_dict[chrom] = len(seq)
@@ -1314,62 +1356,29 @@ def make_tile_df(directory, tile_size=5000, organism='crypto', gff3=None, fa=Non
         print "Organism not supported at this time"
         return None
     
-    frag_list = []
-    for chrom, length in length_dict.iteritems():
-        n=0
-        counter = 1
-        while n < length-tile_size:
-            frag_list.append([chrom+'-'+str(counter),n,n+tile_size-1,'+',chrom])
-            n += tile_size
-            counter += 1
-        frag_list.append([chrom+'-'+str(counter),n,length,'+',chrom])
-    
-    all_df = pd.DataFrame(index=[x[0] for x in frag_list])
-    all_df.loc[:,'chrom'] = [x[4] for x in frag_list]
-    all_df.loc[:,'start'] = [x[1] for x in frag_list]
-    all_df.loc[:,'end'] = [x[2] for x in frag_list]
-    
-    # Label categories
+    # Tiles end 1 bp before the next tile starts, except the last tile on each chromosome
+    tiles = GT.Tiles.fixed(length_dict, tile_size)
+    last = tiles.numbers == tiles.tiles_per_contig()[tiles.contig_ids]-1
+    tiles.ends = np.where(last, tiles.ends, tiles.ends-1)
+    all_df = tiles.to_df(first=1, chrom_column='chrom')
+    
+    # Label categories - tiles that start or end within a feature
     if gff3 is not None:
         feature_dict = read_feature_gff3(gff3)
-        
-        features =[]
-        for ix, r in all_df.iterrows():
-            match = False
-            for feat, info in feature_dict.iteritems():
-                if r['chrom'] == info[0]:
-                    if r['start'] in range(info[1],info[2]) or r['end'] in range(info[1],info[2]):
-                        features.append(feat)
-                        match = True
-                        break
-            if not match:
-                features.append('')
-        all_df.loc[:,'Feature'] = features
-    
-    
-    # Open bam files for counting
-    open_bams = {}
-    for bam in bam_list:
-        open_bams[bam] = pysam.Samfile(bam)
-
-    fix_strand = {'+':'-','-':'+'}
-
-    # Count reads in each tile
+        info = feature_dict.values()
+        feature_index = GT.IntervalIndex([x[0] for x in info], [x[1] for x in info], [x[2] for x in info], 
+                                         names=feature_dict.keys())
+        all_df.loc[:,'Feature'] = tiles.label(feature_index, endpoints=True)
+    
+    
+    # Count reads in each tile on both strands and divide by tile size in kb
+    counts = GT.count_reads_in_regions(bam_list, all_df, library_direction='unstranded', threads=threads)
+    tile_kb = (all_df['end'].values-all_df['start'].values)/1000.
     count_dict = {}
-    col_dict = {'name':[],'chrom':[],'start':[],'end':[]}
     for bam in bam_list:
         name = bam.split('/')[-1].split('_sorted')[0]
         print name
-        count_dict[name] = []
-        for frag, start, end, strand, chrom in frag_list:
-            
-            # Count reads on both strands
-            count = GT.count_reads_in_window(open_bams[bam], chrom, start, end, strand)
-            count += GT.count_reads_in_window(open_bams[bam], chrom, start, end, fix_strand[strand])
-            
-            # Divide by tile size in kb
-            count = count/((end-start)/1000.)
-            count_dict[name].append(count)
+        count_dict[name] = list(counts[bam].values/tile_kb)
 
     # Populate dataframe
             
@@ -1567,7 +1576,7 @@ def compile_cen_tel_series((bam, cen_tel_gff3, cen_tel_len, cen_or_tel)):
     print bam
     cen_tel = pd.read_csv(cen_tel_gff3, sep='\t', header=None, 
                           names=['chromosome','name','type','start','end','x','strand','y','ID']).dropna()
-    open_bam = pysam.Samfile(bam)
+    open_bam = GT.open_bam(bam)
     s_dict = {}
     for ix, r in cen_tel.iterrows():
         if cen_or_tel == "telomere" and r['name'].lower().startswith('tel'):
@@ -1580,29 +1589,33 @@ def compile_cen_tel_series((bam, cen_tel_gff3, cen_tel_len, cen_or_tel)):
     return (bam, s_dict)
 
 def cen_tel_bins(sample, chip_dict, wce_dict, cen_tel_len=60000, bin_size=5000, cen_or_tel='telomere'):
-    bin_df = pd.DataFrame(columns=['name','sample','bin','RPKM'])
-
-    bins = []
     if cen_or_tel == 'telomere':
-        n=0
+        start = 0
     elif cen_or_tel == 'centromere':
-        n=cen_tel_len*-1
-        
-    while n <= cen_tel_len-bin_size:
-        bins.append(np.arange(n,n+bin_size-1))
-        n += bin_size
-    if cen_tel_len-n >= 100:
-        bins.append(np.arange(n,cen_tel_len))
-    
-    for reg, s in chip_dict.items():
-        if reg != 'total aligned reads':
-            for n, b in enumerate(bins):
-                bin_s_chip = s[s.index.isin(b)]
-                wce_s = wce_dict[reg]
-                bin_s_wce = wce_s[wce_s.index.isin(b)]
-                RPKM = sum(bin_s_chip)/(chip_dict['total aligned reads']) / sum(bin_s_wce)/(wce_dict['total aligned reads'])
-                new_row = pd.Series([reg, sample, n, RPKM], index=['name','sample','bin','RPKM'], name=n)
-                bin_df = bin_df.append(new_row)
+        start = cen_tel_len*-1
+    
+    # Full bins leave out their last position, a last partial bin is kept if it is at least 100 bp
+    bin_starts, bin_ends = GT.bin_offsets(start, cen_tel_len, bin_size, min_size=100)
+    bin_ends = np.where(bin_ends-bin_starts == bin_size, bin_ends-1, bin_ends)
+    
+    def bin_sums(s):
+        # Sum of the series over each bin from cumulative sums
+        s = s.sort_index()
+        cumulative = np.concatenate([[0], np.cumsum(s.values)])
+        return (cumulative[np.searchsorted(s.index.values, bin_ends)] - 
+                cumulative[np.searchsorted(s.index.values, bin_starts)])
+    
+    regions = [reg for reg in chip_dict if reg != 'total aligned reads']
+    rpkm = []
+    for reg in regions:
+        chip_sums = bin_sums(chip_dict[reg])
+        wce_sums = bin_sums(wce_dict[reg])
+        rpkm.append(chip_sums/(chip_dict['total aligned reads']) / wce_sums/(wce_dict['total aligned reads']))
+    
+    bins = np.tile(np.arange(len(bin_starts)), len(regions))
+    bin_df = pd.DataFrame({'name':np.repeat(regions, len(bin_starts)), 'sample':sample, 'bin':bins,
+                           'RPKM':np.concatenate(rpkm) if len(rpkm) > 0 else []},
+                          index=bins, columns=['name','sample','bin','RPKM'])
     return bin_df
 
 def create_meta_cen_tel(chip_dict, wce_dict, chip_name, cen_tel_len=60000, cen_or_tel='telomere'):
@@ -2,6 +2,7 @@ import sys
 import os
 from subprocess import check_output
 import math
+import json
 import numpy as np
 import pandas as pd
 script_path = os.path.dirname(os.path.realpath(__file__)).split('GeneTools')[0]
@@ -10,8 +11,88 @@ import GeneTools as GT
 from collections import OrderedDict
 import csv
 import pysam
+from multiprocessing import Pool
 from matplotlib import pyplot as plt
 
+class BamPool(object):
+    '''Open bam files (pysam.AlignmentFile) kept for reuse, keyed by path. The least recently used file is 
+    dropped from the pool when more than max_open files are open - it is not closed, so a caller still holding 
+    it can finish, and it closes once no longer referenced. Files from the pool share one read position, so 
+    anything that reads a whole file or walks two iterators at once should open its own. A pool copied into a new process (e.g. a multiprocessing 
+    worker) forgets the files opened by the parent and opens its own.
+    
+    Parameters
+    ----------
+    max_open : int, default 64
+        Maximum number of open bam files
+    
+    Examples
+    --------
+    >>> pool = BamPool(max_open=8)
+    >>> bam = pool.get('WT_sorted.bam')
+    >>> bam is pool.get('WT_sorted.bam')
+        True
+    '''
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._pid = os.getpid()
+        self._handles = OrderedDict()
+    
+    def __len__(self):
+        self._check_process()
+        return len(self._handles)
+    
+    def __contains__(self, bam):
+        self._check_process()
+        return os.path.realpath(bam) in self._handles
+    
+    def __repr__(self):
+        return '<BamPool: {0} of {1} open>'.format(len(self), self.max_open)
+    
+    def _check_process(self):
+        # File handles are shared with the parent after a fork - leave them to the parent
+        if os.getpid() != self._pid:
+            self._handles = OrderedDict()
+            self._pid = os.getpid()
+    
+    def get(self, bam):
+        '''Open bam file for a path. Open files (pysam.AlignmentFile) are returned unchanged.'''
+        if isinstance(bam, pysam.AlignmentFile):
+            return bam
+        self._check_process()
+        path = os.path.realpath(bam)
+        if path in self._handles:
+            handle = self._handles.pop(path)
+        else:
+            handle = pysam.Samfile(bam)
+            while len(self._handles) >= self.max_open:
+                self._handles.popitem(last=False)
+        self._handles[path] = handle
+        return handle
+    
+    def close(self, bam=None):
+        '''Close one bam file (path) or all of them'''
+        self._check_process()
+        if bam is None:
+            for handle in self._handles.itervalues():
+                handle.close()
+            self._handles.clear()
+        elif os.path.realpath(bam) in self._handles:
+            self._handles.pop(os.path.realpath(bam)).close()
+
+bam_pool = BamPool()
+
+def open_bam(bam):
+    '''Open bam file from the shared BamPool (bam_pool). Accepts a path or an open pysam.AlignmentFile.
+    Change the number of files kept open with bam_pool.max_open.'''
+    return bam_pool.get(bam)
+
+def bam_name(bam):
+    '''Path of a bam file given as a path or an open pysam.AlignmentFile'''
+    if isinstance(bam, pysam.AlignmentFile):
+        return bam.filename
+    return bam
+
 def count_reads_in_window(bam, chrom, start, end, strand):
     '''Counts reads in a given window on one strand - assumes reads are from cDNA
     
@@ -33,19 +114,381 @@ def count_reads_in_window(bam, chrom, start, end, strand):
     read_count : int
          number of reads aligned to window'''
     
-    if type(bam) == str:
-        bam = pysam.Samfile(bam)
-    bam_iter = bam.fetch(chrom, start, end)
-    read_count = 0
-    for read in bam_iter:
-        if strand == "+":
-            if read.is_reverse:
-                read_count += 1
-        elif strand == "-":
-            if not read.is_reverse:
-                read_count +=1
+    regions = pd.DataFrame({'chromosome':[chrom], 'start':[start], 'end':[end], 'strand':[strand]})
+    read_count = count_reads_in_regions(bam, regions).values[0,0]
     return read_count
 
+def _region_columns(regions):
+    # chromosome, start, end and strand arrays of a region table
+    chrom_col = 'chromosome' if 'chromosome' in regions.columns else 'chrom'
+    chroms = np.asarray(regions[chrom_col], dtype=object).astype(str)
+    starts = np.asarray(regions['start'], dtype=np.int64)
+    ends = np.asarray(regions['end'], dtype=np.int64)
+    if 'strand' in regions.columns:
+        strands = np.asarray(regions['strand'], dtype=object).astype(str)
+    else:
+        strands = np.array(['.']*len(regions), dtype=object)
+    return chroms, starts, ends, strands
+
+def _read_ends(open_bam, chrom, start, end, max_cigar_ops=None):
+    # Start, end, orientation and whether the read has one junction (M N M) for each aligned read overlapping chrom:start-end
+    read_starts = []
+    read_ends = []
+    reverse = []
+    junction = []
+    for read in open_bam.fetch(chrom, start, end):
+        if read.reference_end is None:
+            continue
+        cigar = read.cigartuples
+        if max_cigar_ops is not None and len(cigar) >= max_cigar_ops:
+            continue
+        read_starts.append(read.reference_start)
+        read_ends.append(read.reference_end)
+        reverse.append(read.is_reverse)
+        junction.append(len(cigar) == 3 and cigar[1][0] == 3)
+    return (np.array(read_starts, dtype=np.int64), np.array(read_ends, dtype=np.int64), 
+            np.array(reverse, dtype=bool), np.array(junction, dtype=bool))
+
+def _overlap_counts(read_starts, read_ends, starts, ends):
+    # Reads with read_start < end and read_end > start for each region. A read ending at or before the region
+    # start also starts before the region end, so the count is (reads starting before end)-(reads ending by start).
+    return (np.searchsorted(np.sort(read_starts), ends, side='left')-
+            np.searchsorted(np.sort(read_ends), starts, side='right'))
+
+def _spanning_counts(read_starts, read_ends, starts, ends):
+    # Reads with read_start <= start and read_end >= end for each region. Only reads starting less than the 
+    # longest read before the region end can reach it, so each region checks a short slice of the reads.
+    if len(read_starts) == 0:
+        return np.zeros(len(starts), dtype=np.int64)
+    order = np.argsort(read_starts, kind='mergesort')
+    read_starts = read_starts[order]
+    read_ends = read_ends[order]
+    first = np.searchsorted(read_starts, ends-(read_ends-read_starts).max(), side='left')
+    last = np.searchsorted(read_starts, starts, side='right')
+    return np.array([np.count_nonzero(read_ends[f:l] >= end) for f, l, end in zip(first, last, ends)], dtype=np.int64)
+
+def _count_chromosome(bam, chrom, starts, ends, strands, library_direction='reverse', max_cigar_ops=None, 
+                      spanning_junctions=True):
+    # Counts for regions on one chromosome of one bam file (see count_reads_in_regions)
+    read_starts, read_ends, reverse, junction = _read_ends(open_bam(bam), chrom, max(starts.min()-1, 0), ends.max()+1, 
+                                                           max_cigar_ops=max_cigar_ops)
+    if library_direction == 'unstranded':
+        groups = [(np.arange(len(starts)), np.ones(len(read_starts), dtype=bool))]
+    else:
+        # Reverse libraries: reads from + strand transcripts align to the - strand
+        groups = [(np.where(strands == strand)[0], reverse if (strand == '+') == (library_direction == 'reverse') else ~reverse)
+                  for strand in ('+','-')]
+    
+    counts = np.zeros(len(starts), dtype=np.int64)
+    for ix, keep in groups:
+        if len(ix) == 0:
+            continue
+        counts[ix] = _overlap_counts(read_starts[keep], read_ends[keep], starts[ix], ends[ix])
+        if not spanning_junctions:
+            keep = keep & junction
+            counts[ix] -= _spanning_counts(read_starts[keep], read_ends[keep], starts[ix], ends[ix])
+    return counts
+
+def _count_unit(args):
+    # One (bam, chromosome, regions) work unit of count_reads_in_regions
+    n, ix, bam, chrom, starts, ends, strands, options = args
+    return n, ix, _count_chromosome(bam, chrom, starts, ends, strands, **options)
+
+def count_reads_in_regions(bams, regions, library_direction='reverse', max_cigar_ops=None, spanning_junctions=True, 
+                           threads=1):
+    '''Count the reads overlapping many regions in each bam file. Each bam file is read once per chromosome 
+    (from the first to the last region on it) and every read is assigned to all the regions it overlaps, 
+    so the cost does not grow with the number of regions. With threads > 1, the work is split into 
+    (bam, chromosome, block of regions) units that are counted in a process pool and merged.
+    
+    Parameters
+    ----------
+    bams : str, pysam.AlignmentFile or list
+            Sorted, indexed bam files (paths or open files)
+    regions : pandas.DataFrame
+            chromosome (or chrom), start and end columns and optionally strand. Coordinates are 0 based and 
+            end exclusive - a read is counted if it starts before the region end and ends after the region start.
+            Regions do not need to be sorted. Use start == end to count reads spanning a position. Regions 
+            that end before they start raise a ValueError.
+    library_direction : str, default reverse
+            Direction of first read relative to genome - reverse, forward or unstranded.
+            Stranded libraries only count reads on the region strand (no reads for regions without a strand).
+    max_cigar_ops : int, default `None`
+            Only count reads with fewer CIGAR operations (e.g. 3 to skip spliced reads, see span_read_counter)
+    spanning_junctions : bool, default `True`
+            If False, reads with one junction (M N M) that start at or before the region start and end at or
+            after the region end are not counted (i.e. reads spliced across an intron, see count_PE_reads)
+    threads : int, default 1
+            Number of processes
+    
+    Returns
+    -------
+    counts : pandas.DataFrame
+            Read counts with the index of regions and a column for each bam file
+    '''
+    if library_direction not in ('reverse', 'forward', 'unstranded'):
+        raise ValueError('Unknown library direction')
+    if type(bams) == str or isinstance(bams, pysam.AlignmentFile):
+        bams = [bams]
+    names = [bam_name(bam) for bam in bams]
+    chroms, starts, ends, strands = _region_columns(regions)
+    if (ends < starts).any():
+        bad = np.where(ends < starts)[0][0]
+        raise ValueError('Region end before start: {0}:{1}-{2}'.format(chroms[bad], starts[bad], ends[bad]))
+    options = {'library_direction':library_direction, 'max_cigar_ops':max_cigar_ops, 
+               'spanning_junctions':spanning_junctions}
+    
+    # Split chromosomes into blocks of neighbouring regions so there are a few units per process
+    chrom_list = pd.unique(chroms)
+    blocks = 1
+    if threads > 1 and len(chrom_list) > 0:
+        blocks = int(math.ceil(4.*threads/(len(chrom_list)*len(bams))))
+    units = []
+    for chrom in chrom_list:
+        ix = np.where(chroms == chrom)[0]
+        ix = ix[np.argsort(starts[ix], kind='mergesort')]
+        for block in np.array_split(ix, min(blocks, len(ix))):
+            for n, bam in enumerate(bams):
+                # Open files cannot be sent to other processes - workers open the path
+                unit_bam = names[n] if threads > 1 else bam
+                units.append((n, block, unit_bam, chrom, starts[block], ends[block], strands[block], options))
+    
+    counts = np.zeros((len(regions), len(bams)), dtype=np.int64)
+    if threads > 1 and len(units) > 1:
+        # Longest units first
+        units.sort(key=lambda unit: unit[5].max()-unit[4].min(), reverse=True)
+        p = Pool(min(threads, len(units)))
+        for n, ix, unit_counts in p.imap_unordered(_count_unit, units):
+            counts[ix,n] = unit_counts
+        p.close()
+        p.join()
+    else:
+        for unit in units:
+            n, ix, unit_counts = _count_unit(unit)
+            counts[ix,n] = unit_counts
+    return pd.DataFrame(counts, index=regions.index, columns=names)
+
+JUNCTION_COLUMNS = ['chromosome','start','end','strand','count','max_overhang']
+JUNCTION_SUFFIX = '.gt_SJ.tab'
+# Bump when the table contents change (2: read 2 strands are no longer flipped) so old tables are rebuilt
+JUNCTION_VERSION = 2
+_junction_indexes = {}
+
+def _read_junctions(cigar, position):
+    # (first intron base, last intron base, overhang) for each N operation - 1 based like STAR's SJ.out.tab.
+    # The overhang is the smaller of the aligned blocks on either side of the junction.
+    junctions = []
+    blocks = []
+    block = 0
+    for op, length in cigar:
+        if op == 3:
+            junctions.append((position+1, position+length))
+            blocks.append(block)
+            block = 0
+        elif op == 0 or op == 7 or op == 8:
+            block += length
+        if op == 0 or op == 2 or op == 3 or op == 7 or op == 8:
+            position += length
+    blocks.append(block)
+    return [(start, end, min(blocks[n], blocks[n+1])) for n, (start, end) in enumerate(junctions)]
+
+def _transcript_strand(read, library_direction):
+    # Strand of the transcript a read came from - the same rule as count_reads_in_regions (read.is_reverse, 
+    # whether or not the read is read 2 of a pair)
+    if library_direction == 'unstranded':
+        return '.'
+    if (library_direction == 'reverse') == read.is_reverse:
+        return '+'
+    return '-'
+
+def _chromosome_junctions(args):
+    # Junction table rows for one chromosome of one bam file (see extract_junctions)
+    bam, chrom, library_direction = args
+    junctions = {}
+    for read in open_bam(bam).fetch(chrom):
+        cigar = read.cigartuples
+        if read.is_unmapped or cigar is None or len(cigar) < 3:
+            continue
+        read_junctions = _read_junctions(cigar, read.reference_start)
+        if len(read_junctions) == 0:
+            continue
+        strand = _transcript_strand(read, library_direction)
+        for start, end, overhang in read_junctions:
+            key = (start, end, strand)
+            if key in junctions:
+                junctions[key][0] += 1
+                junctions[key][1] = max(junctions[key][1], overhang)
+            else:
+                junctions[key] = [1, overhang]
+    return [(chrom, start, end, strand, count, overhang) for (start, end, strand), (count, overhang) in sorted(junctions.items())]
+
+def extract_junctions(bam, library_direction='reverse', threads=1):
+    '''Find every junction (N operation in the CIGAR string, any number per read) in a bam file, reading it once.
+    
+    Parameters
+    ----------
+    bam : str or pysam.AlignmentFile
+            Sorted, indexed bam file
+    library_direction : str, default reverse
+            Direction of first read relative to genome - reverse, forward or unstranded. 
+            Sets the strand of each junction ('.' if unstranded).
+    threads : int, default 1
+            Number of processes (chromosomes are read in parallel)
+    
+    Returns
+    -------
+    junctions : pandas.DataFrame
+            chromosome, start, end, strand, count and max_overhang - one row per junction, like STAR's SJ.out.tab.
+            Start and end are the first and last intron bases (1 based, as used by Intron).
+    '''
+    if library_direction not in ('reverse', 'forward', 'unstranded'):
+        raise ValueError('Unknown library direction')
+    references = open_bam(bam).references
+    if threads > 1:
+        p = Pool(min(threads, len(references)))
+        chrom_rows = p.map(_chromosome_junctions, [(bam_name(bam), chrom, library_direction) for chrom in references])
+        p.close()
+        p.join()
+    else:
+        chrom_rows = [_chromosome_junctions((bam, chrom, library_direction)) for chrom in references]
+    return pd.DataFrame([row for rows in chrom_rows for row in rows], columns=JUNCTION_COLUMNS)
+
+def orient_junctions(junctions, library_direction):
+    '''Junction table from extract_junctions (library_direction reverse) as it would be for another library direction'''
+    junctions = junctions.copy()
+    if library_direction == 'forward':
+        junctions['strand'] = junctions['strand'].map({'+':'-', '-':'+', '.':'.'})
+    elif library_direction == 'unstranded':
+        junctions['strand'] = '.'
+        junctions = junctions.groupby(['chromosome','start','end','strand'], sort=False).agg({'count':'sum', 'max_overhang':'max'})
+        junctions = junctions.reset_index()[JUNCTION_COLUMNS]
+    return junctions
+
+class JunctionIndex(object):
+    '''Junction read counts from a junction table (see extract_junctions) for constant time lookups by intron.
+    
+    Parameters
+    ----------
+    junctions : pandas.DataFrame
+            chromosome, start, end, strand, count and max_overhang columns
+    stranded : bool, default `True`
+            If False, lookups ignore the strand
+    
+    Examples
+    --------
+    >>> index = JunctionIndex.from_bam('WT_sorted.bam')
+    >>> index.write('WT.SJ.tab')
+    >>> index.count('chr1', 611500, 611563, '+')
+        42
+    '''
+    def __init__(self, junctions, stranded=True):
+        self.junctions = junctions.reset_index(drop=True)
+        self.stranded = stranded
+        keys = zip(self.junctions['chromosome'].astype(str), self.junctions['start'], self.junctions['end'])
+        counts = self.junctions['count'].values
+        self._counts = dict(((chrom, start, end, strand), count) for (chrom, start, end), strand, count 
+                            in zip(keys, self.junctions['strand'], counts))
+        self._totals = {}
+        for key, count in zip(keys, counts):
+            self._totals[key] = self._totals.get(key, 0)+count
+    
+    def __len__(self):
+        return len(self.junctions)
+    
+    def __repr__(self):
+        return '<JunctionIndex: {0} junctions, {1} reads>'.format(len(self), self.junctions['count'].sum())
+    
+    @classmethod
+    def from_bam(cls, bam, library_direction='reverse', threads=1):
+        return cls(extract_junctions(bam, library_direction=library_direction, threads=threads), 
+                   stranded=library_direction != 'unstranded')
+    
+    def count(self, chromosome, start, end, strand=None):
+        '''Reads with a junction from start to end (first and last intron bases). 
+        Counts both strands if strand is None or the index is not stranded.'''
+        if strand is None or not self.stranded:
+            return self._totals.get((chromosome, start, end), 0)
+        return self._counts.get((chromosome, start, end, strand), 0)
+    
+    def counts(self, chromosomes, starts, ends, strands=None):
+        '''Array of counts for many introns'''
+        if strands is None:
+            strands = [None]*len(starts)
+        return np.array([self.count(chrom, int(start), int(end), strand) 
+                         for chrom, start, end, strand in zip(chromosomes, starts, ends, strands)], dtype=np.int64)
+    
+    def write(self, file_name, header=None):
+        '''Tab separated junction table (columns as JUNCTION_COLUMNS, no header row). 
+        header is written as a comment line. The table is written to a temporary file and renamed, so readers 
+        never see a partial table.'''
+        tmp_name = file_name+'.tmp{0}'.format(os.getpid())
+        try:
+            with open(tmp_name, 'w') as fout:
+                if header is not None:
+                    fout.write('#'+header+'\n')
+                self.junctions.to_csv(fout, sep='\t', header=False, index=False)
+            os.rename(tmp_name, file_name)
+        except (IOError, OSError):
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        return file_name
+    
+    @classmethod
+    def read(cls, file_name, stranded=True):
+        junctions = pd.read_csv(file_name, sep='\t', header=None, names=JUNCTION_COLUMNS, comment='#', 
+                                dtype={'chromosome':str})
+        return cls(junctions, stranded=stranded)
+
+def junction_index(bam, library_direction='reverse', threads=1, cache=True):
+    '''JunctionIndex for a bam file. The junctions are extracted once and kept for the life of the process and 
+    in a table next to the bam file (bam+'.gt_SJ.tab'), keyed by the table format (JUNCTION_VERSION) and the bam 
+    path, size and modification time.
+    
+    Parameters
+    ----------
+    bam : str or pysam.AlignmentFile
+            Sorted, indexed bam file
+    library_direction : str, default reverse
+            Direction of first read relative to genome - reverse, forward or unstranded
+    threads : int, default 1
+            Number of processes used if the junctions need to be extracted
+    cache : bool, default `True`
+            Read and write the .gt_SJ.tab file
+    
+    Returns
+    -------
+    index : JunctionIndex
+    '''
+    if library_direction not in ('reverse', 'forward', 'unstranded'):
+        raise ValueError('Unknown library direction')
+    path = bam_name(bam)
+    key = _bam_file_key(path)
+    if key not in _junction_indexes:
+        # Tables are stored for reverse libraries - other directions only change the strands
+        table = path+JUNCTION_SUFFIX
+        header = 'gt_SJ v%d\t%s\t%d\t%r' % ((JUNCTION_VERSION,)+key)
+        junctions = None
+        if cache and os.path.exists(table):
+            with open(table) as f:
+                if f.readline().rstrip('\n') == '#'+header:
+                    junctions = JunctionIndex.read(table).junctions
+        if junctions is None:
+            junctions = extract_junctions(bam, library_direction='reverse', threads=threads)
+            if cache:
+                try:
+                    JunctionIndex(junctions).write(table, header=header)
+                except (IOError, OSError):
+                    pass
+        _junction_indexes[key] = {}
+        _junction_indexes[key]['reverse'] = JunctionIndex(junctions)
+    
+    indexes = _junction_indexes[key]
+    if library_direction not in indexes:
+        indexes[library_direction] = JunctionIndex(orient_junctions(indexes['reverse'].junctions, library_direction), 
+                                                   stranded=library_direction != 'unstranded')
+    return indexes[library_direction]
+
 def tx_info(tx, tx_dict):
     '''Retrieves information on a given transcript from tx_dict generated by GeneTools.build_transcript_dict
     
@@ -90,8 +533,85 @@ def tx_info(tx, tx_dict):
         
     return start, end, chrom, strand, CDS_start, CDS_end, exons
 
+_splice_site_tables = {}
+
+def splice_site_table(gff3_file, organism=None):
+    '''Table of annotated introns with one row per intron, built from the exon features grouped by transcript 
+    (or from intron features if the gff3 has them, e.g. S. cerevisiae). Tables are cached per gff3 file.
+    
+    Splice site coordinates follow list_splice_sites:
+        from exons - 5' site is intron start-2 and 3' site is intron end-1 on the + strand, 
+                     intron end and intron start-1 on the - strand
+        from introns - 5' site is intron start-1 and 3' site is intron end on the + strand,
+                       intron end and intron start-1 on the - strand
+    
+    Parameters
+    ----------
+    gff3_file : str
+                location and name of gff3 file
+    organism : str, default ``None``
+                only necessary for S. pombe - then use 'pombe'
+    
+    Returns
+    --------
+    table : pandas.DataFrame
+            columns transcript, gene (Parent of the transcript), chromosome, strand, five and three
+    intron flag : bool
+            True if introns rather than exons are defined in the gff3 file.
+    '''
+    cache_key = (os.path.realpath(gff3_file), os.path.getmtime(gff3_file), organism)
+    if cache_key in _splice_site_tables:
+        return _splice_site_tables[cache_key]
+    
+    ann_df = GT.read_gff3(gff3_file)
+    intron_flag = organism != 'pombe' and 'intron' in set(ann_df['type'])
+    features = ann_df[(ann_df['type'] == ('intron' if intron_flag else 'exon')) & ann_df['Parent'].notnull()]
+    features = features[features['strand'].isin(['+','-'])]
+    
+    transcripts = GT.normalize_transcript_ids(features['Parent'])
+    if organism != 'pombe':
+        # Same transcript names as build_transcript_dict
+        transcripts = transcripts.where(transcripts.str[-2] == 'T', transcripts+'T0')
+    
+    # Gene is the Parent of the transcript feature
+    parents = ann_df[ann_df['ID'].notnull() & ann_df['Parent'].notnull()]
+    parents = pd.Series(parents['Parent'].values, index=parents['ID'].values)
+    parents = parents[~parents.index.duplicated()]
+    genes = features['Parent'].map(parents).str.replace(r'^gene:', '')
+    genes = genes.where(genes.notnull(), transcripts.str[:-2].values)
+    
+    chroms = features['chromosome'].astype(str)
+    if organism == 'pombe':
+        chroms = chroms.map(lambda x: GT.pombe_aliases.resolve(x, x))
+    
+    df = pd.DataFrame({'transcript':transcripts.values, 'gene':genes.values, 'chromosome':chroms.values, 
+                       'strand':features['strand'].astype(str).values,
+                       'start':features['start'].values.astype(int), 'end':features['end'].values.astype(int)})
+    plus = (df['strand'] == '+').values
+    if intron_flag:
+        table = df[['transcript','gene','chromosome','strand']].copy()
+        table.loc[:,'five'] = np.where(plus, df['start']-1, df['end'])
+        table.loc[:,'three'] = np.where(plus, df['end'], df['start']-1)
+    else:
+        # Exon starts sorted within each transcript without the first, ends without the last
+        by_start = df.sort_values(['transcript','start'])
+        by_start = by_start[by_start['transcript'].duplicated(keep='first')]
+        by_end = df.sort_values(['transcript','end'])
+        by_end = by_end[by_end['transcript'].duplicated(keep='last')]
+        
+        table = by_start[['transcript','gene','chromosome','strand']].reset_index(drop=True)
+        plus = (table['strand'] == '+').values
+        starts = by_start['start'].values
+        ends = by_end['end'].values
+        table.loc[:,'five'] = np.where(plus, ends-1, starts-1)
+        table.loc[:,'three'] = np.where(plus, starts-2, ends)
+    
+    table = table[['transcript','gene','chromosome','strand','five','three']]
+    _splice_site_tables[cache_key] = (table, intron_flag)
+    return table, intron_flag
+
 def list_splice_sites(gff3_file, chromosome="All", gene_list=None, organism=None):
-    '''Function to build dictionary of splice sites in each transcript.
+    '''Function to build dictionary of splice sites in each transcript (see splice_site_table).
     Parameters
     ----------
     gff3_file : str
@@ -111,123 +631,33 @@ def list_splice_sites(gff3_file, chromosome="All", gene_list=None, organism=None
     intron flag : bool
                     True if introns rather than exons are defined in the gff3 file.
                     '''
-        
-    transcript_dict = build_transcript_dict(gff3_file, organism=organism)
-    
-    splice_site_dict = {}
-    n = 1
-    with open(gff3_file,"r") as fin:
-        for line in fin:
-            columns = re.split(r'\t+', line.strip())
-
-            if organism == 'pombe' and len(columns)>1:
-                intron_flag = False
-                if columns[2] == 'exon':
-                    chr_rom = columns[0]
-                    rom_lat = {'I':'chr1','II':'chr2','III':'chr3','MT':'MT'}
-                    chrom = rom_lat[chr_rom]
-                    transcript = columns[8].split(':')[0].split('=')[1]
-
-                    if transcript not in splice_site_dict:
-                        splice_site_dict[transcript] = [[],[],chrom]
-                    if columns[6] == "+":
-                        splice_site_dict[transcript][0].append(int(columns[4])-1)
-                        splice_site_dict[transcript][1].append(int(columns[3])-2)
-                    elif columns[6] == "-":
-                        splice_site_dict[transcript][0].append(int(columns[3])-1)
-                        splice_site_dict[transcript][1].append(int(columns[4]))
-
-            if len(columns) > 1 and organism is None:
-                if columns[2] == "mRNA" or columns[2] == "snoRNA_gene" or columns[2] == "tRNA_gene":
-                    transcript = columns[8].strip()
-                    transcript = transcript.split("=")[1]
-                    transcript = transcript.split(";")[0]
-                    if transcript.endswith("mRNA"):
-                        transcript = transcript.split("_")[0]
-                    if transcript[-2] != 'T':
-                        transcript = transcript+'T0'
-                    if transcript not in splice_site_dict:
-                        splice_site_dict[transcript] = [[],[],columns[0]]
-
-                elif columns[2] == "exon":
-                    intron_flag=False
-                    transcript = columns[8].strip()
-                    transcript = transcript[-12:]
-                    if transcript[-2] != 'T':
-                        transcript = transcript+'T0'
-                    if gene_list is None:
-                        if columns[6] == "+":
-                            splice_site_dict[transcript][0].append(int(columns[4])-1)
-                            splice_site_dict[transcript][1].append(int(columns[3])-2)
-                        if columns[6] == "-":
-                            splice_site_dict[transcript][0].append(int(columns[3])-1)
-                            splice_site_dict[transcript][1].append(int(columns[4]))
-                    else:
-                        if transcript in gene_list:
-                            if columns[6] == "+":
-                                splice_site_dict[transcript][0].append(int(columns[4])-1)
-                                splice_site_dict[transcript][1].append(int(columns[3])-2)
-                            if columns[6] == "-":
-                                splice_site_dict[transcript][0].append(int(columns[3])-1)
-                                splice_site_dict[transcript][1].append(int(columns[4]))
-
-                #For organisms where introns are annotated instead of exons (e.g. S. cerevisiae)
-                elif "intron" in columns[2]: 
-                    intron_flag=True
-                    transcript = columns[8].strip()
-                    transcript = transcript.split("=")[1]
-                    transcript = transcript.split(";")[0]
-                    if transcript.endswith("mRNA"):
-                        transcript = transcript.split("_")[0]
-                    if transcript[-2] != 'T':
-                        transcript = transcript+'T0'
-                    if transcript not in splice_site_dict:
-                        splice_site_dict[transcript] = [[],[],columns[0]]
-                    if gene_list is None:
-                        if columns[6] == "+":
-                            splice_site_dict[transcript][0].append(int(columns[3])-1)
-                            splice_site_dict[transcript][1].append(int(columns[4]))
-                        elif columns[6] == "-":
-                            splice_site_dict[transcript][0].append(int(columns[4]))
-                            splice_site_dict[transcript][1].append(int(columns[3])-1)
-                    else:
-                        if transcript in gene_list:
-                            if columns[6] == "+":
-                                splice_site_dict[transcript][0].append(int(columns[3])-2)
-                                splice_site_dict[transcript][1].append(int(columns[4])-1)
-                            elif columns[6] == "-":
-                                splice_site_dict[transcript][0].append(int(columns[4]))
-                                splice_site_dict[transcript][1].append(int(columns[3])-1)
-    
-    
-    #Trim to entries in gene list
+    table, intron_flag = splice_site_table(gff3_file, organism=organism)
     if gene_list is not None:
-        splice_site_dict = {transcript: splice_site_dict[transcript] for transcript in gene_list}
-        
+        table = table[table['transcript'].isin(gene_list)]
     if chromosome != "All":
-        splice_site_dict = dict([(transcript, coords) for transcript, coords in splice_site_dict.iteritems() if coords[2] == chromosome])
-    
-    if intron_flag is False:
-        for transcript, sites in splice_site_dict.iteritems():
-            sites5 = sorted(sites[0])
-            sites3 = sorted(sites[1])
-            if transcript_dict[transcript][2] == "+":
-                sites5 = sites5[:-1]
-                sites3 = sites3[1:]
-            elif transcript_dict[transcript][2] == "-":
-                sites5 = sites5[1:]
-                sites3 = sites3[:-1]
-            splice_site_dict[transcript] = [sites5, sites3]
+        table = table[table['chromosome'] == chromosome]
+    
+    five = table['five'].values
+    three = table['three'].values
+    chroms = table['chromosome'].values
+    splice_site_dict = {}
+    for transcript, rows in table.groupby('transcript', sort=False).indices.iteritems():
+        splice_site_dict[transcript] = [five[rows].tolist(), three[rows].tolist()]
+        if intron_flag:
+            splice_site_dict[transcript].append(chroms[rows[0]])
         
     return (splice_site_dict, intron_flag)    
 
-def collapse_ss_dict(splice_site_dict):
+def collapse_ss_dict(splice_site_dict, gene_map=None):
     '''Function to list introns by gene rather than isoform - removes redundant introns
     
     Parameters
     ----------
     splice_site_dict : dict
                 splice site dictionary generated by list_splice_sites
+    gene_map : dict, default ``None``
+                gene of each transcript (e.g. from the gene column of splice_site_table).
+                If None, the gene is the transcript name without the last 2 characters ("T0" or ".1")
                 
     Returns
     --------
@@ -235,21 +665,99 @@ def collapse_ss_dict(splice_site_dict):
                     Dictionary where gene names (no "T0" or ".1" at the end) are keys and values are set as follows:
                     ([intron starts], [intron stops])
                     '''
-    ss_by_gene = {}
-    transcripts = splice_site_dict.keys()
-    transcripts = [x[:-2] for x in transcripts]
-    genes = list(set(transcripts))
-    for gene in genes:
-        for transcript, sites in splice_site_dict.iteritems():
-            if gene in transcript:
-                if gene not in ss_by_gene:
-                    ss_by_gene[gene] = set()
-                ss_by_gene[gene].update(set(zip(sites[0],sites[1])))
+    genes = {}
+    for transcript in splice_site_dict:
+        if gene_map is None:
+            genes[transcript] = transcript[:-2]
+        else:
+            genes[transcript] = gene_map.get(transcript, transcript[:-2])
+    
+    gene_column = []
+    five = []
+    three = []
+    for transcript, sites in splice_site_dict.iteritems():
+        gene_column.extend([genes[transcript]]*len(sites[0]))
+        five.extend(sites[0])
+        three.extend(sites[1])
+    df = pd.DataFrame({'gene':gene_column, 'five':five, 'three':three})
+    
+    ss_by_gene = dict((gene, set()) for gene in genes.itervalues())
+    for gene, rows in df.groupby('gene').indices.iteritems():
+        ss_by_gene[gene] = set(zip(df['five'].values[rows].tolist(), df['three'].values[rows].tolist()))
     return ss_by_gene
 
 
+LIBSIZE_SUFFIX = '.gt_libsize'
+_library_sizes = {}
+
+def _bam_file_key(bam_file):
+    path = os.path.realpath(bam_file)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime
+
+def library_size(bam_file, exclude_flags=0x4, cache=True):
+    '''Number of reads in a bam file without any of the exclude_flags (like samtools view -F exclude_flags -c).
+    Mapped reads (the default) are read from the bam index statistics (.bai) when there is an index, 
+    otherwise the bam file is read once. Counts are kept for the life of the process and saved next to the 
+    bam file (bam_file+'.gt_libsize'), keyed by the bam path, size and modification time, so they are 
+    only counted again if the bam file changes.
+    
+    Parameters
+    ----------
+    bam_file : str
+            bam file from Bowtie or STAR
+    exclude_flags : int, default 0x4
+            Skip reads with any of these flags (0x4 - unmapped, 0x904 - also secondary and supplementary)
+    cache : bool, default `True`
+            Read and write the .gt_libsize file
+    
+    Returns
+    -------
+    total : int
+         Number of reads
+    '''
+    key = _bam_file_key(bam_file)
+    if (key, exclude_flags) in _library_sizes:
+        return _library_sizes[(key, exclude_flags)]
+    
+    sidecar = bam_file+LIBSIZE_SUFFIX
+    counts = {}
+    if cache and os.path.exists(sidecar):
+        try:
+            with open(sidecar) as f:
+                saved = json.load(f)
+            if (saved['path'], saved['size'], saved['mtime']) == key:
+                counts = saved['counts']
+        except (ValueError, KeyError):
+            counts = {}
+    
+    flag_key = str(exclude_flags)
+    if flag_key not in counts:
+        # Private file - a pooled one may be part way through another fetch
+        bam = pysam.AlignmentFile(bam_file)
+        total = None
+        if exclude_flags == 0x4:
+            try:
+                total = bam.mapped
+            except ValueError:
+                # No index statistics
+                total = None
+        if total is None:
+            total = sum(1 for read in bam.fetch(until_eof=True) if not read.flag & exclude_flags)
+        bam.close()
+        counts[flag_key] = int(total)
+        if cache:
+            try:
+                with open(sidecar, 'w') as fout:
+                    json.dump({'path':key[0], 'size':key[1], 'mtime':key[2], 'counts':counts}, fout)
+            except IOError:
+                pass
+    
+    _library_sizes[(key, exclude_flags)] = counts[flag_key]
+    return counts[flag_key]
+
 def count_aligned_reads(bam_file):
-    '''Counts aligned reads in bam file reads using Samtools
+    '''Counts aligned reads in bam file (see library_size - counts are cached)
     
     Parameters
     ----------
@@ -261,7 +769,7 @@ def count_aligned_reads(bam_file):
     total : float
          Million aligned reads'''
     
-    total = check_output(['samtools','view','-F 0x04','-c',bam_file]).strip()
+    total = library_size(bam_file)
     total = float(total)/1000000.
     return total
 
@@ -315,7 +823,7 @@ def map_all_transcripts(gff3, bam_file):
         organism = 'pombe'
     tx_dict = GT.build_transcript_dict(gff3, organism=organism)
     
-    bam = pysam.Samfile(bam_file)
+    bam = open_bam(bam_file)
     series_dict = {}
     for tx in tx_dict:
         start, end, chrom, strand, CDS_start, CDS_end, exons = tx_info(tx, tx_dict)
@@ -335,47 +843,15 @@ def plot_transcripts(series_dict, tx_list):
         plt.clf()
     
 def count_PE_reads(open_bam, chrom, start, end, strand, both_strands=False, count_junctions=False):
-    if type(open_bam) != pysam.libcsamfile.Samfile:
-        open_bam = pysam.Samfile(open_bam)
-    
-    iterator = open_bam.fetch(chrom, start-150, end+150)
-    
-    count = 0
-    for read in iterator:
-        if both_strands is False:
-            # For reads that start or end in the intron
-            if read.reference_start in range(start, end) or read.reference_end in range(start, end):
-                if not read.is_reverse and strand == '+': count += 1
-                elif read.is_reverse and strand == '-': count += 1
-
-            # For reads that span the intron
-            elif read.reference_start <= start and read.reference_end >= end:
-                intron = False
-                if count_junctions is False:
-                    # Check to see if the read contains a junction
-                    if len(read.cigartuples) == 3 and read.cigartuples[1][0] == 3:
-                        intron = True
-
-                if intron is False:
-                    if not read.is_reverse and strand == '+': count += 1
-                    elif read.is_reverse and strand == '-': count += 1
-                            
-        else:
-            # Don't need to worry about strand or read1 vs. read2, otherwise same as above
-            if read.reference_start in range(start, end) or read.reference_end in range(start, end):
-                count += 1
-            elif read.reference_start <= start and read.reference_end >= end:
-                intron = False
-                if count_junctions is False:
-                    # Check to see if the read contains a junction
-                    if len(read.cigartuples) == 3 and read.cigartuples[1][0] == 3:
-                        intron = True
-                if intron is False:
-                    count += 1
-                    
+    '''Count reads that start or end between start and end or span the region, with the first read on the region 
+    strand (either strand if both_strands). Reads spliced across the region are only counted if count_junctions.'''
+    regions = pd.DataFrame({'chromosome':[chrom], 'start':[start-1], 'end':[end], 'strand':[strand]})
+    library_direction = 'unstranded' if both_strands else 'forward'
+    count = count_reads_in_regions(open_bam, regions, library_direction=library_direction, 
+                                   spanning_junctions=count_junctions).values[0,0]
     return count
 
-def PE_intron_retention_from_annotation(bam_list, organism, both_strands=False, count_junctions=False):
+def PE_intron_retention_from_annotation(bam_list, organism, both_strands=False, count_junctions=False, threads=1):
     if 'crypto' in organism.lower():
         gff3 = '/home/jordan/GENOMES/CNA3_all_transcripts.gff3'
         organism=None
@@ -388,32 +864,26 @@ def PE_intron_retention_from_annotation(bam_list, organism, both_strands=False,
         
     tx_dict = GT.build_transcript_dict(gff3, organism=organism)
     ss_dict, flag = list_splice_sites(gff3, organism=organism)
-    ss_dict = collapse_ss_dict(ss_dict)
+    ss_table, flag = splice_site_table(gff3, organism=organism)
+    ss_dict = collapse_ss_dict(ss_dict, gene_map=dict(zip(ss_table['transcript'], ss_table['gene'])))
     #ss_dict = {k:v for k, v in ss_dict.items() if k in ss_dict.keys()[:100]}
     
-    open_bams = {}
     data_dict = {}
     for bam in bam_list:
-        open_bams[bam] = pysam.Samfile(bam)
         name = bam.split('/')[-1].split('_sorted.bam')[0]
         print name
         data_dict[bam] = {bam:name, 'reads in transcript':[], 'reads in intron':[]}
         
     column_dict = {'transcript':[],'intron start':[],'intron end':[],'transcript size':[],'chromosome':[],'strand':[]}
-    
+    tx_regions = []
+    intron_regions = []
     for tx, splice_sites in ss_dict.iteritems():
-        print tx
         # Get information for overall transcript
         if organism == 'pombe': iso = tx+'.1'
         else: iso = tx+'T0'
         start, end, chrom, strand, CDS_start, CDS_end, exons = GT.tx_info(iso, tx_dict)
-
-        tx_counts = {}
-        for bam, open_bam in open_bams.iteritems():
-            # Count reads in transcript
-            tx_counts[bam] = count_PE_reads(open_bam, chrom, start, end, strand, both_strands=both_strands, count_junctions=True)
         
-        # Iterate over all annotated introns in transcript
+        # All annotated introns in transcript
         for five, three in splice_sites:
             column_dict['transcript'].append(tx)
             column_dict['intron start'].append(five)
@@ -422,14 +892,23 @@ def PE_intron_retention_from_annotation(bam_list, organism, both_strands=False,
             column_dict['chromosome'].append(chrom)
             column_dict['strand'].append(strand)
             
-            for bam, open_bam in open_bams.iteritems():
-                if strand == '+':
-                    intron_counts = count_PE_reads(open_bam, chrom, five, three, strand, both_strands=both_strands, count_junctions=count_junctions)
-                if strand == '-':
-                    intron_counts = count_PE_reads(open_bam, chrom, three, five, strand, both_strands=both_strands, count_junctions=count_junctions)
-                
-                data_dict[bam]['reads in transcript'].append(tx_counts[bam])
-                data_dict[bam]['reads in intron'].append(intron_counts)
+            # Regions as counted by count_PE_reads
+            tx_regions.append((chrom, start-1, end, strand))
+            if strand == '+':
+                intron_regions.append((chrom, five-1, three, strand))
+            else:
+                intron_regions.append((chrom, three-1, five, strand))
+    
+    # Count reads in transcripts and introns
+    library_direction = 'unstranded' if both_strands else 'forward'
+    tx_counts = count_reads_in_regions(bam_list, pd.DataFrame(tx_regions, columns=['chromosome','start','end','strand']),
+                                       library_direction=library_direction, threads=threads)
+    intron_counts = count_reads_in_regions(bam_list, pd.DataFrame(intron_regions, columns=['chromosome','start','end','strand']),
+                                           library_direction=library_direction, spanning_junctions=count_junctions, 
+                                           threads=threads)
+    for n, bam in enumerate(bam_list):
+        data_dict[bam]['reads in transcript'] = list(tx_counts.values[:,n])
+        data_dict[bam]['reads in intron'] = list(intron_counts.values[:,n])
                 
     df = pd.DataFrame(columns=column_dict.keys(), index=range(len(column_dict['transcript'])))
     for col, info in column_dict.iteritems():
@@ -444,24 +923,28 @@ def PE_intron_retention_from_annotation(bam_list, organism, both_strands=False,
         
     return df
 
-def PE_fragment_size(bam_file):
+def PE_fragment_size(bam_file, organism=None):
     '''Calculates average and standard deviation of insert fragment sizes from paired end data. Necessary for GEO deposition
     
     Parameters
     ----------
     bam_file : str
             bam file from Bowtie or STAR from paired end data
+    organism : GT.Organism, default `None`
+            Organism used to find chromosome 1 in the bam header (see Organism.bam_contigs)
     
     Output
     ------
     Prints the average and standard deviation of the library fragment size'''
     
-    bam = pysam.Samfile(bam_file)
+    # mate() moves the file position, so walk the region with its own iterator on a private file
+    bam = pysam.AlignmentFile(bam_file)
     sizes = []
-    try:
-        reads = bam.fetch('chr1',1000,20000)
-    except ValueError:
-        reads = bam.fetch('I',1000,20000)
+    if organism is not None:
+        chrom = organism.bam_contigs(bam_file).get(organism.aliases.get_id('chr1'), bam.references[0])
+    else:
+        chrom = GT.ContigAliases(bam.references).resolve('chr1', bam.references[0])
+    reads = bam.fetch(chrom,1000,20000, multiple_iterators=True)
     for read in reads:
         if read.is_paired:
             try:
@@ -477,6 +960,7 @@ def PE_fragment_size(bam_file):
                             sizes.append(size)
             except ValueError:
                 pass
+    bam.close()
     print "Average fragment size: "+str(np.mean(sizes))
     print "Standard deviation: "+str(np.std(sizes))
 
@@ -8,19 +8,58 @@ import numpy as np
 import pandas as pd
 from collections import OrderedDict
 import csv
+import itertools
+import json
+import mmap
+import string
+import struct
+import zlib
+script_path = os.path.dirname(os.path.realpath(__file__)).split('GeneTools')[0]
+sys.path.append(script_path)
+import GeneTools as GT
+
+# Translation table for complementing - IUPAC codes, U and soft masked (lowercase) bases.
+# Anything else (gaps etc.) is left as is.
+_COMPLEMENT = string.maketrans('ACGTUNRYSWKMBDHVacgtunryswkmbdhv', 'TGCAANYRSWMKVHDBtgcaanyrswmkvhdb')
+_COMPLEMENT_CODES = np.frombuffer(_COMPLEMENT, dtype=np.uint8)
 
 def complement(seq):
-    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A','N':'N', 'Y':'R', 'R':'Y'} 
-    bases = list(seq) 
-    bases = [complement[base] for base in bases] 
-    return ''.join(bases)
+    '''Complement of a sequence (str or numpy uint8 array of ASCII codes)'''
+    if isinstance(seq, np.ndarray):
+        return _COMPLEMENT_CODES[seq]
+    if isinstance(seq, unicode):
+        seq = seq.encode('ascii')
+    return str(seq).translate(_COMPLEMENT)
 
 def reverse_complement(s):
-        return complement(s[::-1])
+    '''Reverse complement of a sequence (str or numpy uint8 array of ASCII codes)'''
+    if isinstance(s, np.ndarray):
+        return _COMPLEMENT_CODES[s[::-1]]
+    return complement(s)[::-1]
+
+def reverse_complement_batch(seqs):
+    '''Reverse complement many sequences in one call.
+    
+    Parameters
+    ----------
+    seqs : list of str or numpy uint8 array
+        Sequences. If a 2D array of ASCII codes (e.g. equal length windows), each row is reverse complemented.
+    
+    Returns
+    -------
+    rc_seqs : list of str or numpy uint8 array (same shape as seqs)
+    '''
+    if isinstance(seqs, np.ndarray):
+        return _COMPLEMENT_CODES[seqs[...,::-1]]
+    if len(seqs) == 0:
+        return []
+    # Joining on newline then reversing the whole block keeps each sequence separate
+    joined = '\n'.join([x.encode('ascii') if isinstance(x, unicode) else str(x) for x in seqs])
+    return joined.translate(_COMPLEMENT)[::-1].split('\n')[::-1]
 
 #Transcript dictionary: keys are transcript, values are [start, end, strand, chromosome, CDS start, CDS end]
-def write_transcript_fasta(transcript_dict, fasta_dict, prefix='transcripts', sense=True, spliced=False):
-    seq_dict = {}
+def iter_transcript_records(transcript_dict, fasta_dict, sense=True, spliced=False):
+    '''Generator of (transcript, sequence) records - see write_transcript_fasta'''
     for transcript, values in transcript_dict.iteritems():
         start = values[0]
         end = values[1]
@@ -35,29 +74,60 @@ def write_transcript_fasta(transcript_dict, fasta_dict, prefix='transcripts', se
                 seq = reverse_complement(seq)
 
         elif spliced is True:
-            seq = ''
-            for n in range(len(CDS_start_list)):
-                if strand == '+':
-                    seq = seq+fasta_dict[chrom][CDS_start_list[n]-1:CDS_end_list[n]]
-                elif strand == '-':
-                    new_seq = fasta_dict[chrom][CDS_start_list[n]-1:CDS_end_list[n]]
-                    new_seq = reverse_complement(new_seq)
-                    seq = seq+new_seq
+            parts = [fasta_dict[chrom][CDS_start_list[n]-1:CDS_end_list[n]] for n in range(len(CDS_start_list))]
+            if strand == '-':
+                parts = reverse_complement_batch(parts)
+            seq = ''.join(parts)
         
         if sense is False:
             seq = reverse_complement(seq)
-            
-        seq_dict[transcript] = seq
-        
-    with open('{}.fa'.format(prefix), 'w') as fout:
-        for transcript, seq in seq_dict.iteritems():
-            fout.write('>'+transcript+'\n')
-            fout.write(seq+'\n')
+        yield transcript, seq
+
+def write_transcript_fasta(transcript_dict, fasta_dict, prefix='transcripts', sense=True, spliced=False, 
+                           stream=False, line_width=None, bgzip=False):
+    '''Write transcript (or spliced CDS if spliced is True) sequences to prefix.fa
     
-    return seq_dict
-            
-def write_intergenic_fasta(transcript_dict, fasta_dict, bps_us=0, bps_ds=0, all_intergenic=True, prefix='intergenic_transcripts'):
+    Parameters
+    ----------
+    transcript_dict : dict
+        Generated by build_transcript_dict
+    fasta_dict : dict or GenomeStore
+        Genome sequences
+    prefix : str, default 'transcripts'
+        Output file prefix
+    sense : bool, default `True`
+        If False, write the antisense sequences
+    spliced : bool, default `False`
+        Join CDS sequences instead of taking the whole transcript
+    stream : bool, default `False`
+        Write records as they are made and return the file name instead of a dictionary of all sequences
+        (memory use does not grow with the number of transcripts)
+    line_width : int, default `None`
+        Wrap sequence lines (e.g. 60). If `None`, each sequence is on one line.
+    bgzip : bool, default `False`
+        Write bgzip compressed fasta (prefix.fa.gz) with .fai and .gzi indexes
+    
+    Returns
+    -------
+    seq_dict : dict, or output file name if stream is True
+    '''
+    records = iter_transcript_records(transcript_dict, fasta_dict, sense=sense, spliced=spliced)
+    return _write_records(records, prefix, stream, line_width, bgzip)
+
+def _write_records(records, prefix, stream, line_width, bgzip):
+    out_name = '{}.fa'.format(prefix)
+    if bgzip:
+        out_name = out_name+'.gz'
+    if stream:
+        return write_fasta(records, out_name, line_width=line_width, bgzip=bgzip)
     seq_dict = {}
+    for name, seq in records:
+        seq_dict[name] = seq
+    write_fasta(seq_dict.iteritems(), out_name, line_width=line_width, bgzip=bgzip)
+    return seq_dict
+
+def iter_intergenic_records(transcript_dict, fasta_dict, bps_us=0, bps_ds=0, all_intergenic=True):
+    '''Generator of (name, sequence) records - see write_intergenic_fasta'''
     if all_intergenic is False:
         for transcript, values in transcript_dict.iteritems():
             start = values[0]
@@ -72,8 +142,8 @@ def write_intergenic_fasta(transcript_dict, fasta_dict, bps_us=0, bps_ds=0, all_
                     seq_us_sense = fasta_dict[chrom][end:end+bps_us]
                     seq_us_sense = reverse_complement(seq_us_sense)
                 seq_us_antisense = reverse_complement(seq_us_sense)
-                seq_dict[transcript+'_us_sense'] = seq_us_sense
-                seq_dict[transcript+'_us_antisense'] = seq_us_antisense
+                yield transcript+'_us_sense', seq_us_sense
+                yield transcript+'_us_antisense', seq_us_antisense
             
             if bps_ds > 0:
                 if strand == '+':
@@ -82,41 +152,49 @@ def write_intergenic_fasta(transcript_dict, fasta_dict, bps_us=0, bps_ds=0, all_
                     seq_ds_sense = fasta_dict[chrom][start-bps_ds:start]
                     seq_ds_sense = reverse_complement(seq_ds_sense)
                 seq_ds_antisense = reverse_complement(seq_ds_sense)
-                seq_dict[transcript+'_ds_sense'] = seq_ds_sense
-                seq_dict[transcript+'_ds_antisense'] = seq_ds_antisense
+                yield transcript+'_ds_sense', seq_ds_sense
+                yield transcript+'_ds_antisense', seq_ds_antisense
     
     elif all_intergenic is True:
         chroms = fasta_dict.keys()
         for chrom in chroms:
             chrom_transcripts = dict((k, transcript_dict[k]) for k in transcript_dict if transcript_dict[k][3] == chrom)
+            if len(chrom_transcripts) == 0:
+                continue
             chr_txs_df = pd.DataFrame.from_dict(chrom_transcripts, orient='index')
             chr_txs_df.sort_values([0], inplace=True)
             sorted_transcripts = chr_txs_df.index.tolist()
 
             n = 0
+            names = []
+            plus_seqs = []
             for n in range(len(sorted_transcripts)-1):
                 transcript = sorted_transcripts[n]
                 next_transcript = sorted_transcripts[n+1]
                 transcript_end = chr_txs_df[1][transcript]
                 next_start = chr_txs_df[0][next_transcript]
                 if next_start > transcript_end:
-                    seq_plus = fasta_dict[chrom][transcript_end:next_start]
-                    seq_dict[transcript+'_'+next_transcript+'_plus'] = seq_plus
-                    seq_dict[transcript+'_'+next_transcript+'_minus'] = reverse_complement(seq_plus)
+                    names.append(transcript+'_'+next_transcript)
+                    plus_seqs.append(fasta_dict[chrom][transcript_end:next_start])
                 else:
                     print 'Overlapping transcripts:'
                     print transcript
                     print next_transcript
-                    
-    with open('{}.fa'.format(prefix), 'w') as fout:
-        for transcript, seq in seq_dict.iteritems():
-            fout.write('>'+transcript+'\n')
-            fout.write(seq+'\n')
-    
-    return seq_dict
-        
-def write_intron_fasta(transcript_dict, fasta_dict, prefix='introns', sense=True):
-    seq_dict = {}
+            
+            for name, seq_plus, seq_minus in zip(names, plus_seqs, reverse_complement_batch(plus_seqs)):
+                yield name+'_plus', seq_plus
+                yield name+'_minus', seq_minus
+            
+def write_intergenic_fasta(transcript_dict, fasta_dict, bps_us=0, bps_ds=0, all_intergenic=True, prefix='intergenic_transcripts',
+                           stream=False, line_width=None, bgzip=False):
+    '''Write intergenic sequences to prefix.fa - either bps_us/bps_ds upstream/downstream of each transcript
+    or all sequence between adjacent transcripts (all_intergenic). stream, line_width and bgzip are as in 
+    write_transcript_fasta.'''
+    records = iter_intergenic_records(transcript_dict, fasta_dict, bps_us=bps_us, bps_ds=bps_ds, all_intergenic=all_intergenic)
+    return _write_records(records, prefix, stream, line_width, bgzip)
+
+def iter_intron_records(transcript_dict, fasta_dict, sense=True):
+    '''Generator of (name, sequence) records - see write_intron_fasta'''
     for transcript, values in transcript_dict.iteritems():
         start = values[0]
         end = values[1]
@@ -136,25 +214,133 @@ def write_intron_fasta(transcript_dict, fasta_dict, prefix='introns', sense=True
             if sense is False:
                 seq = reverse_complement(seq)
             
-            seq_dict[transcript+'_'+str(n)] = seq
-        
-    with open('{}.fa'.format(prefix), 'w') as fout:
-        for transcript, seq in seq_dict.iteritems():
-            fout.write('>'+transcript+'\n')
-            fout.write(seq+'\n')
-    return seq_dict
+            yield transcript+'_'+str(n), seq
         
+def write_intron_fasta(transcript_dict, fasta_dict, prefix='introns', sense=True, stream=False, line_width=None, bgzip=False):
+    '''Write intron sequences (between CDS) to prefix.fa. stream, line_width and bgzip are as in 
+    write_transcript_fasta.'''
+    records = iter_intron_records(transcript_dict, fasta_dict, sense=sense)
+    return _write_records(records, prefix, stream, line_width, bgzip)
+
+##################################################
+## Streaming fasta writer (plain or bgzip)      ##
+##################################################
+
+_BGZF_BLOCK_SIZE = 0xff00
+_BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00'
+             '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+class BgzfWriter(object):
+    '''Minimal writer for BGZF (blocked gzip) files, readable with gzip and indexable by samtools/htslib.
+    Keeps the block offsets needed for a .gzi index.'''
+    def __init__(self, file_name, level=6):
+        self._f = open(file_name, 'wb')
+        self._level = level
+        self._buffer = []
+        self._buffer_len = 0
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+        self.blocks = []
+    
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_len += len(data)
+        if self._buffer_len >= _BGZF_BLOCK_SIZE:
+            data = ''.join(self._buffer)
+            n_full = len(data)//_BGZF_BLOCK_SIZE
+            for n in range(n_full):
+                self._write_block(data[n*_BGZF_BLOCK_SIZE:(n+1)*_BGZF_BLOCK_SIZE])
+            rest = data[n_full*_BGZF_BLOCK_SIZE:]
+            self._buffer = [rest]
+            self._buffer_len = len(rest)
+    
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data)+compressor.flush()
+        block_size = len(cdata)+26
+        header = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'+struct.pack('<H', block_size-1)
+        footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+        self.blocks.append((self.compressed_offset, self.uncompressed_offset))
+        self._f.write(header+cdata+footer)
+        self.compressed_offset += block_size
+        self.uncompressed_offset += len(data)
+    
+    def close(self):
+        data = ''.join(self._buffer)
+        if len(data) > 0:
+            self._write_block(data)
+        self._buffer = []
+        self._f.write(_BGZF_EOF)
+        self._f.close()
+    
+    def write_gzi(self, gzi_name):
+        # First block (0, 0) is implicit in the .gzi format
+        blocks = self.blocks[1:]
+        with open(gzi_name, 'wb') as fout:
+            fout.write(struct.pack('<Q', len(blocks)))
+            for coffset, uoffset in blocks:
+                fout.write(struct.pack('<QQ', coffset, uoffset))
+
+def write_fasta(records, out_name, line_width=None, bgzip=False, index=None, buffer_size=1<<20):
+    '''Stream (name, sequence) records to a fasta file. Records are written as they come, so memory use
+    is one record (plus the write buffer) regardless of how many there are.
+    
+    Parameters
+    ----------
+    records : iterable
+        (name, sequence) tuples, e.g. from iter_transcript_records or a dictionary's iteritems()
+    out_name : str
+        Output file name
+    line_width : int, default `None`
+        Wrap sequence lines at this many bases. If `None`, each sequence is on one line.
+    bgzip : bool, default `False`
+        Write a bgzip compressed file with .gzi index
+    index : bool, default `None`
+        Write a samtools style .fai index. Defaults to True for bgzip output, False otherwise.
+    buffer_size : int, default 1 Mb
+        Size of the write buffer
+    
+    Returns
+    -------
+    out_name : str
+    '''
+    if index is None:
+        index = bgzip
+    if bgzip:
+        fout = BgzfWriter(out_name)
+    else:
+        fout = open(out_name, 'w', buffer_size)
+    
+    fai = []
+    offset = 0
+    for name, seq in records:
+        if isinstance(seq, unicode):
+            seq = seq.encode('ascii')
+        header = '>'+name+'\n'
+        if line_width is None or len(seq) <= line_width:
+            lines = seq+'\n'
+            line_bases = len(seq)
+        else:
+            lines = '\n'.join([seq[n:n+line_width] for n in range(0, len(seq), line_width)])+'\n'
+            line_bases = line_width
+        fout.write(header+lines)
+        if index:
+            fai.append((name.split()[0], len(seq), offset+len(header), line_bases, line_bases+1))
+        offset += len(header)+len(lines)
+    fout.close()
+    
+    if index:
+        with open(out_name+'.fai', 'w') as f:
+            for entry in fai:
+                f.write('\t'.join([str(x) for x in entry])+'\n')
+    if bgzip:
+        fout.write_gzi(out_name+'.gzi')
+    return out_name
     
 def read_fasta(fasta_file):
     cds_dict = {}
-    nts = ['A','T','C','G','N']
-    with open(fasta_file, 'r') as fin:
-        for line in fin:
-            if line.startswith('>'):
-                cds_dict[line.strip()] = ''
-                cds = line.strip()
-            elif line[0] in nts:
-                cds_dict[cds] = cds_dict[cds]+line.strip()
+    for header, seq in iter_fasta(fasta_file):
+        cds_dict['>'+header] = seq
     return cds_dict
 
 
@@ -178,4 +364,640 @@ def write_new_fasta(split_dict, fasta_file):
     with open(new_name, 'w') as fout:
         for cds, seq in split_dict.iteritems():
             fout.write(cds+'\n')
-            fout.write(seq+'\n')
\ No newline at end of file
+            fout.write(seq+'\n')
+
+###############################################
+## Streaming fasta parser and samtools index ##
+###############################################
+
+def iter_fasta(fasta_file, index=None):
+    '''Stream (header, sequence) pairs from a fasta file in a single pass. Sequence lines are collected
+    and joined once per contig, so memory and time are linear in contig size.
+    
+    Parameters
+    ----------
+    fasta_file : str
+        Fasta file (e.g. genome fasta downloaded from fungidb)
+    index : list, default `None`
+        If provided, a samtools style .fai entry is appended for each contig:
+        (name, length, offset, line bases, line width). Line bases and width are `None` if the
+        contig has lines of different lengths (cannot be indexed).
+    
+    Yields
+    ------
+    header : str
+        Header line without the leading >
+    seq : str
+        Contig sequence
+    '''
+    header = None
+    chunks = []
+    offset = 0
+    with open(fasta_file, 'rb') as f:
+        for line in f:
+            line_len = len(line)
+            if line.startswith('>'):
+                if header is not None:
+                    seq = ''.join(chunks)
+                    if index is not None:
+                        index.append(_fai_entry(header, seq, seq_offset, widths))
+                    yield header, seq
+                header = line[1:].strip()
+                chunks = []
+                widths = []
+                seq_offset = offset+line_len
+            elif header is not None:
+                bases = line.rstrip('\r\n')
+                chunks.append(bases.strip())
+                widths.append((len(bases), line_len))
+            offset += line_len
+    if header is not None:
+        seq = ''.join(chunks)
+        if index is not None:
+            index.append(_fai_entry(header, seq, seq_offset, widths))
+        yield header, seq
+
+def _fai_entry(header, seq, seq_offset, widths):
+    name = header.split()[0] if header else header
+    if len(widths) == 0:
+        return (name, 0, seq_offset, 0, 0)
+    line_bases, line_width = widths[0]
+    for bases, width in widths[1:-1]:
+        if bases != line_bases or width != line_width:
+            return (name, len(seq), seq_offset, None, None)
+    if len(widths) > 1 and widths[-1][0] > line_bases:
+        return (name, len(seq), seq_offset, None, None)
+    return (name, len(seq), seq_offset, line_bases, line_width)
+
+def write_fasta_index(fasta_file, index):
+    '''Write .fai entries collected by iter_fasta. Returns the index file name, or `None` if
+    a contig has uneven line lengths (same restriction as samtools faidx).'''
+    if len([x for x in index if x[3] is None]) > 0:
+        print "Uneven line lengths in "+fasta_file+", cannot create .fai index"
+        return None
+    fai = fasta_file+'.fai'
+    with open(fai, 'w') as fout:
+        for entry in index:
+            fout.write('\t'.join([str(x) for x in entry])+'\n')
+    return fai
+
+def _fasta_index_stale(fasta_file):
+    # The .fai index is missing or older than the fasta file
+    fai = fasta_file+'.fai'
+    return not os.path.exists(fai) or os.path.getmtime(fai) < os.path.getmtime(fasta_file)
+
+def read_fasta_index(fasta_file):
+    '''Read (building first if missing or out of date) the samtools style .fai index for a fasta file
+    
+    Returns
+    -------
+    index : OrderedDict
+        Keys are contig names, values are (length, offset, line bases, line width)
+    '''
+    fai = fasta_file+'.fai'
+    if _fasta_index_stale(fasta_file):
+        entries = []
+        for header, seq in iter_fasta(fasta_file, index=entries):
+            pass
+        if write_fasta_index(fasta_file, entries) is None:
+            raise ValueError('Cannot index '+fasta_file)
+    
+    index = OrderedDict()
+    with open(fai) as f:
+        for line in f:
+            data = line.rstrip('\n').split('\t')
+            index[data[0]] = tuple([int(x) for x in data[1:5]])
+    return index
+
+def fetch_fasta_region(fasta_file, chrom, start, end, index=None):
+    '''Retrieve chrom[start:end] (0 based, end exclusive) from a fasta file by seeking with the .fai index
+    instead of parsing the file.
+    
+    Parameters
+    ----------
+    fasta_file : str
+        Fasta file - the .fai index is created the first time if it does not exist
+    chrom : str
+        Contig name (first word of the header line)
+    start : int
+        Start of the region
+    end : int
+        End of the region
+    index : OrderedDict, default `None`
+        Output of read_fasta_index - provide when fetching many regions to avoid re-reading the index
+    
+    Returns
+    -------
+    seq : str
+        The sequence of the region
+    '''
+    if index is None:
+        index = read_fasta_index(fasta_file)
+    length, offset, line_bases, line_width = index[chrom]
+    start = max(start, 0)
+    end = min(end, length)
+    if end <= start:
+        return ''
+    
+    first = offset + (start//line_bases)*line_width + start%line_bases
+    last = offset + ((end-1)//line_bases)*line_width + (end-1)%line_bases
+    with open(fasta_file, 'rb') as f:
+        f.seek(first)
+        block = f.read(last-first+1)
+    return block.replace('\n','').replace('\r','')
+
+def read_fasta_dict(fasta_file, write_index=True):
+    '''Read all contigs in a fasta file into a dictionary with a single streaming pass. Also writes a
+    samtools style .fai index next to the fasta file if it is missing or older than the fasta file.
+    
+    Parameters
+    ----------
+    fasta_file : str
+        Fasta file
+    write_index : bool, default `True`
+        Write the .fai index if missing or out of date
+    
+    Returns
+    -------
+    fa_dict : OrderedDict
+        Header lines (without >) are keys and sequences are values
+    '''
+    entries = None
+    if write_index and _fasta_index_stale(fasta_file):
+        entries = []
+    fa_dict = OrderedDict()
+    for header, seq in iter_fasta(fasta_file, index=entries):
+        fa_dict[header] = seq
+    if entries is not None:
+        try:
+            write_fasta_index(fasta_file, entries)
+        except IOError:
+            pass
+    return fa_dict
+
+####################################################
+## Packed (2 bit) genome store for random access  ##
+####################################################
+
+PACKED_GENOME_EXT = '.gt2bit'
+_PACKED_MAGIC = 'GT2B'
+_PACKED_VERSION = 1
+
+# A, C, G, T are stored as 2 bit codes - anything else (N, IUPAC codes) is recorded as a run in the exception table
+_BASE_CODES = np.zeros(256, dtype=np.uint8)+255
+for _n, _base in enumerate('ACGT'):
+    _BASE_CODES[ord(_base)] = _n
+    _BASE_CODES[ord(_base.lower())] = _n
+_CODE_BASES = np.array([ord(x) for x in 'ACGT'], dtype=np.uint8)
+
+def _runs(positions, values=None):
+    '''Collapse sorted positions (and optionally their values) into runs of consecutive positions
+    with the same value. Returns run starts, run ends and run values.'''
+    if len(positions) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.uint8)
+    breaks = np.diff(positions) != 1
+    if values is not None:
+        breaks = breaks | (np.diff(values) != 0)
+    first = np.concatenate([[0], np.flatnonzero(breaks)+1])
+    last = np.concatenate([first[1:], [len(positions)]])-1
+    starts = positions[first].astype(np.int64)
+    ends = positions[last].astype(np.int64)+1
+    if values is not None:
+        values = values[first].astype(np.uint8)
+    else:
+        values = np.zeros(len(starts), dtype=np.uint8)
+    return starts, ends, values
+
+def _pack_sequence(seq):
+    '''Convert a sequence to packed 2 bit codes plus exception (non-ACGT) and soft mask (lowercase) runs'''
+    if type(seq) == unicode:
+        seq = seq.encode('ascii')
+    arr = np.frombuffer(seq, dtype=np.uint8)
+    codes = _BASE_CODES[arr]
+    
+    exc_pos = np.flatnonzero(codes == 255)
+    upper = arr[exc_pos] & 0xDF
+    exc_starts, exc_ends, exc_chars = _runs(exc_pos, upper)
+    codes[exc_pos] = 0
+    
+    mask_pos = np.flatnonzero((arr >= ord('a')) & (arr <= ord('z')))
+    mask_starts, mask_ends, _ = _runs(mask_pos)
+    
+    pad = (-len(codes)) % 4
+    if pad:
+        codes = np.concatenate([codes, np.zeros(pad, dtype=np.uint8)])
+    codes = codes.reshape(-1, 4)
+    packed = (codes[:,0] << 6) | (codes[:,1] << 4) | (codes[:,2] << 2) | codes[:,3]
+    return packed.astype(np.uint8), (exc_starts, exc_ends, exc_chars), (mask_starts, mask_ends)
+
+def _iter_contigs(source):
+    '''Yield (contig, sequence) from a dictionary, a json dictionary or a fasta file'''
+    if isinstance(source, dict):
+        for contig, seq in source.iteritems():
+            yield contig, seq
+    elif source.endswith('.json'):
+        with open(source) as f:
+            fa_dict = json.load(f)
+        for contig, seq in fa_dict.iteritems():
+            yield contig, seq
+    else:
+        for contig, seq in iter_fasta(source):
+            yield contig, seq
+
+def packed_genome_name(fasta_file):
+    '''Name of the packed genome that sits next to a fasta or json genome file'''
+    return os.path.splitext(fasta_file)[0]+PACKED_GENOME_EXT
+
+def make_packed_genome(source, out_name=None):
+    '''Convert a genome to the packed 2 bit format read by GenomeStore. Contigs are written one at a time,
+    so only one contig is held in memory while converting from a fasta file.
+    
+    Parameters
+    ----------
+    source : str or dict
+        Fasta file, json dictionary of chromosome sequences (e.g. H99_fa.json) or the dictionary itself
+    out_name : str, default `None`
+        Name of the packed genome. If `None`, the source name with the .gt2bit extension.
+    
+    Returns
+    -------
+    out_name : str
+        Name of the packed genome file
+    '''
+    if out_name is None:
+        if isinstance(source, dict):
+            raise ValueError('Must provide out_name when packing a dictionary')
+        out_name = packed_genome_name(source)
+    
+    index = []
+    tmp_name = out_name+'.tmp{0}'.format(os.getpid())
+    with open(tmp_name, 'wb') as fout:
+        fout.write(struct.pack('<4sI', _PACKED_MAGIC, _PACKED_VERSION))
+        for contig, seq in _iter_contigs(source):
+            packed, exceptions, mask = _pack_sequence(seq)
+            entry = {'name':contig, 'length':len(seq), 'n_exc':len(exceptions[0]), 'n_mask':len(mask[0])}
+            entry['seq_offset'] = fout.tell()
+            fout.write(packed.tostring())
+            entry['exc_offset'] = fout.tell()
+            for arr in exceptions:
+                fout.write(arr.tostring())
+            entry['mask_offset'] = fout.tell()
+            for arr in mask:
+                fout.write(arr.tostring())
+            index.append(entry)
+        index_offset = fout.tell()
+        fout.write(json.dumps(index))
+        fout.write(struct.pack('<Q', index_offset))
+    os.rename(tmp_name, out_name)
+    return out_name
+
+class PackedContig(object):
+    '''Read-only view of one contig in a GenomeStore. Supports len() and string style slicing
+    (e.g. contig[start:end]), decoding only the requested bases.'''
+    def __init__(self, buf, entry):
+        self.name = entry['name']
+        self.length = entry['length']
+        n_bytes = (self.length+3)//4
+        self._packed = np.frombuffer(buf, dtype=np.uint8, count=n_bytes, offset=entry['seq_offset'])
+        
+        n = entry['n_exc']
+        offset = entry['exc_offset']
+        self._exc_starts = np.frombuffer(buf, dtype=np.int64, count=n, offset=offset)
+        self._exc_ends = np.frombuffer(buf, dtype=np.int64, count=n, offset=offset+8*n)
+        self._exc_chars = np.frombuffer(buf, dtype=np.uint8, count=n, offset=offset+16*n)
+        
+        n = entry['n_mask']
+        offset = entry['mask_offset']
+        self._mask_starts = np.frombuffer(buf, dtype=np.int64, count=n, offset=offset)
+        self._mask_ends = np.frombuffer(buf, dtype=np.int64, count=n, offset=offset+8*n)
+    
+    def __len__(self):
+        return self.length
+    
+    def __repr__(self):
+        return '<PackedContig {0}: {1} bp>'.format(self.name, self.length)
+    
+    def to_array(self, start=0, end=None):
+        '''Decode bases start to end (0 based, end exclusive) as a numpy uint8 array of ASCII codes'''
+        if end is None or end > self.length:
+            end = self.length
+        start = max(start, 0)
+        if end <= start:
+            return np.zeros(0, dtype=np.uint8)
+        
+        first = start//4
+        packed = self._packed[first:(end+3)//4]
+        codes = np.empty((len(packed), 4), dtype=np.uint8)
+        codes[:,0] = packed >> 6
+        codes[:,1] = (packed >> 4) & 3
+        codes[:,2] = (packed >> 2) & 3
+        codes[:,3] = packed & 3
+        seq = _CODE_BASES[codes.ravel()[start-first*4:end-first*4]]
+        
+        # Restore N and other ambiguous bases
+        a = np.searchsorted(self._exc_ends, start, side='right')
+        b = np.searchsorted(self._exc_starts, end, side='left')
+        for n in range(a, b):
+            seq[max(self._exc_starts[n],start)-start:min(self._exc_ends[n],end)-start] = self._exc_chars[n]
+        
+        # Restore soft masking
+        a = np.searchsorted(self._mask_ends, start, side='right')
+        b = np.searchsorted(self._mask_starts, end, side='left')
+        for n in range(a, b):
+            seq[max(self._mask_starts[n],start)-start:min(self._mask_ends[n],end)-start] |= 0x20
+        return seq
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.length)
+            if step != 1:
+                return self.to_array(0, self.length).tostring()[key]
+            return self.to_array(start, end).tostring()
+        if key < 0:
+            key += self.length
+        if key < 0 or key >= self.length:
+            raise IndexError('contig index out of range')
+        return self.to_array(key, key+1).tostring()
+    
+    def __str__(self):
+        return self.to_array(0, self.length).tostring()
+
+class GenomeStore(object):
+    '''Memory mapped genome in the packed 2 bit format (see make_packed_genome). Behaves like the
+    fasta dictionaries used elsewhere (genome[chrom][start:end]) without reading the whole file,
+    and every process that opens the same file shares one page cached copy.
+    
+    Parameters
+    ----------
+    packed_file : str
+        Packed genome file (.gt2bit) created by make_packed_genome
+    
+    Examples
+    -------
+    >>> genome = GenomeStore('/home/jordan/GENOMES/H99_fa.gt2bit')
+    >>> genome['chr1'][611500:611510]
+        'GTAAGTTCAT'
+    '''
+    def __init__(self, packed_file):
+        self.packed_file = packed_file
+        self._open()
+    
+    def _open(self):
+        with open(self.packed_file, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack('<4sI', self._mmap[:8])
+        if magic != _PACKED_MAGIC or version != _PACKED_VERSION:
+            raise ValueError(self.packed_file+' is not a packed genome file')
+        index_offset = struct.unpack('<Q', self._mmap[-8:])[0]
+        self._index = OrderedDict((x['name'], x) for x in json.loads(self._mmap[index_offset:-8]))
+        self._contigs = {}
+    
+    def __getstate__(self):
+        # Only the file name is pickled - worker processes re-map the file and share the page cache
+        return {'packed_file':self.packed_file}
+    
+    def __setstate__(self, state):
+        self.packed_file = state['packed_file']
+        self._open()
+    
+    def __getitem__(self, contig):
+        if contig not in self._contigs:
+            self._contigs[contig] = PackedContig(self._mmap, self._index[contig])
+        return self._contigs[contig]
+    
+    def __contains__(self, contig):
+        return contig in self._index
+    
+    def __iter__(self):
+        return iter(self._index)
+    
+    def __len__(self):
+        return len(self._index)
+    
+    def __repr__(self):
+        return '<GenomeStore {0}: {1} contigs>'.format(self.packed_file, len(self))
+    
+    def get(self, contig, default=None):
+        if contig in self._index:
+            return self[contig]
+        return default
+    
+    def keys(self):
+        return self._index.keys()
+    
+    def iterkeys(self):
+        return iter(self._index)
+    
+    def items(self):
+        return [(contig, self[contig]) for contig in self._index]
+    
+    def iteritems(self):
+        for contig in self._index:
+            yield contig, self[contig]
+    
+    def values(self):
+        return [self[contig] for contig in self._index]
+    
+    def lengths(self):
+        '''Dictionary of contig lengths - read from the index, no sequence is decoded'''
+        return OrderedDict((k, v['length']) for k, v in self._index.iteritems())
+    
+    def close(self):
+        self._contigs = {}
+        self._mmap.close()
+
+def read_genome_dict(fasta_file):
+    '''Load a whole genome into a dictionary from a json dictionary or fasta file'''
+    if fasta_file.endswith('.json'):
+        with open(fasta_file) as f:
+            return json.load(f)
+    return read_fasta_dict(fasta_file)
+
+def genome_contigs(fasta_file):
+    '''Contig names of a genome without reading the sequences - from the packed genome header if there is an 
+    up to date one, otherwise from the .fai index (built first if missing or out of date).
+    
+    Parameters
+    ----------
+    fasta_file : str or dict
+        Fasta file, json dictionary of chromosome sequences or packed genome (.gt2bit)
+    
+    Returns
+    -------
+    contigs : list
+        Contig names in file order
+    '''
+    if isinstance(fasta_file, (dict, GenomeStore)):
+        return list(fasta_file.keys())
+    packed_file = fasta_file
+    if not fasta_file.endswith(PACKED_GENOME_EXT):
+        packed_file = packed_genome_name(fasta_file)
+        if not os.path.exists(packed_file) or os.path.getmtime(packed_file) < os.path.getmtime(fasta_file):
+            packed_file = None
+    if packed_file is not None:
+        genome = GenomeStore(packed_file)
+        contigs = genome.keys()
+        genome.close()
+        return contigs
+    if fasta_file.endswith('.json'):
+        return list(read_genome_dict(fasta_file).keys())
+    try:
+        return read_fasta_index(fasta_file).keys()
+    except (IOError, ValueError):
+        # Uneven line lengths or no write access - one streaming pass instead
+        return [header for header, seq in iter_fasta(fasta_file)]
+
+def load_genome(fasta_file, packed=True):
+    '''Open a genome for random access (genome[chrom][start:end]). By default, uses the packed
+    genome next to the fasta or json file, creating it the first time (or when the source file is newer).
+    Falls back to loading the whole genome into a dictionary if the packed genome cannot be written.
+    
+    Parameters
+    ----------
+    fasta_file : str or dict
+        Fasta file, json dictionary of chromosome sequences or packed genome (.gt2bit).
+        Dictionaries and GenomeStore objects are returned unchanged.
+    packed : bool, default `True`
+        Use (and create if necessary) the packed genome. If False, loads the whole genome into a dictionary.
+    
+    Returns
+    -------
+    genome : GenomeStore or dict
+        Chromosome names are keys, sequences (or PackedContig views) are values
+    '''
+    if isinstance(fasta_file, (dict, GenomeStore)):
+        return fasta_file
+    if fasta_file.endswith(PACKED_GENOME_EXT):
+        return GenomeStore(fasta_file)
+    
+    if packed:
+        packed_file = packed_genome_name(fasta_file)
+        try:
+            if not os.path.exists(packed_file) or os.path.getmtime(packed_file) < os.path.getmtime(fasta_file):
+                make_packed_genome(fasta_file, packed_file)
+            return GenomeStore(packed_file)
+        except (IOError, OSError):
+            pass
+    return read_genome_dict(fasta_file)
+
+#############################################
+## Base, dinucleotide and k-mer composition ##
+#############################################
+
+def kmer_names(k):
+    '''All k-mers in the column order used by sequence_composition (A, C, G, T lexicographic)'''
+    return [''.join(x) for x in itertools.product('ACGT', repeat=k)]
+
+def _contig_codes(seq, start=0, end=None):
+    '''2 bit codes (A=0, C=1, G=2, T=3, anything else 255) for part of a contig (str or PackedContig)'''
+    if hasattr(seq, 'to_array'):
+        arr = seq.to_array(start, end)
+    else:
+        if isinstance(seq, unicode):
+            seq = seq.encode('ascii')
+        arr = np.frombuffer(seq, dtype=np.uint8)[start:end]
+    return _BASE_CODES[arr]
+
+def _kmer_index(codes, k):
+    '''Index of the k-mer starting at each position and whether it contains only A, C, G and T'''
+    n = len(codes)-k+1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+    bad = codes > 3
+    bad_sum = np.zeros(len(codes)+1, dtype=np.int64)
+    bad_sum[1:] = np.cumsum(bad)
+    valid = (bad_sum[k:]-bad_sum[:-k]) == 0
+    clean = np.where(bad, 0, codes).astype(np.uint32)
+    index = np.zeros(n, dtype=np.uint32)
+    for j in range(k):
+        index = (index << 2) | clean[j:j+n]
+    return index, valid
+
+def sequence_composition(fasta_dict, k=1, window=None, frequencies=False, chunk_size=1<<24):
+    '''Count bases, dinucleotides or k-mers across a genome, per chromosome or in windows. Each contig is
+    processed in a single pass over numpy arrays (in chunks of chunk_size bases to limit memory).
+    Counting is case insensitive and k-mers containing N or other ambiguous bases are skipped.
+    
+    Parameters
+    ----------
+    fasta_dict : dict, GenomeStore or str
+        Genome sequences or a file that can be opened with load_genome (.json, fasta or .gt2bit)
+    k : int, default 1
+        k-mer length (1-8)
+    window : int, default `None`
+        If provided, count in windows of this size. Windows are the same as the tiles in make_tile_df
+        (index is chrom-1, chrom-2...) so the two dataframes can be joined on index.
+        K-mers are assigned to the window containing their first base.
+    frequencies : bool, default `False`
+        Return frequencies (each row sums to 1) instead of counts
+    chunk_size : int, default 16 Mb
+        Number of bases decoded at once
+    
+    Returns
+    -------
+    comp_df : pandas.DataFrame
+        One row per chromosome (or window) and one column per k-mer, plus GC_content (fraction of A/C/G/T bases
+        that are G or C). Windowed output also has chrom, start and end (end exclusive) columns.
+    '''
+    if k < 1 or k > 8:
+        raise ValueError('k must be between 1 and 8')
+    if isinstance(fasta_dict, basestring):
+        fasta_dict = load_genome(fasta_dict)
+    n_kmers = 4**k
+    chroms = sorted(fasta_dict.keys())
+    lengths = [len(fasta_dict[chrom]) for chrom in chroms]
+    
+    if window is None:
+        n_rows = [1]*len(chroms)
+    else:
+        tiles = GT.Tiles.fixed(zip(chroms, lengths), window)
+        n_rows = tiles.tiles_per_contig().tolist()
+        if sum(n_rows)*n_kmers > 1<<27:
+            raise ValueError('Too many windows x k-mers - use a larger window or smaller k')
+    
+    counts = []
+    base_counts = []
+    for chrom, length, rows in zip(chroms, lengths, n_rows):
+        contig = fasta_dict[chrom]
+        chrom_counts = np.zeros(rows*n_kmers, dtype=np.int64)
+        chrom_bases = np.zeros(rows*4, dtype=np.int64)
+        for start in range(0, length, chunk_size):
+            codes = _contig_codes(contig, start, min(start+chunk_size+k-1, length))
+            index, valid = _kmer_index(codes, k)
+            bases = codes[:chunk_size]
+            base_valid = bases < 4
+            if window is not None:
+                row = np.minimum((start+np.arange(len(index)))//window, rows-1)
+                index = row*n_kmers+index
+                base_row = np.minimum((start+np.arange(len(bases)))//window, rows-1)
+                bases = base_row*4+bases
+            chrom_counts += np.bincount(index[valid], minlength=rows*n_kmers)
+            chrom_bases += np.bincount(bases[base_valid], minlength=rows*4)
+        counts.append(chrom_counts.reshape(rows, n_kmers))
+        base_counts.append(chrom_bases.reshape(rows, 4))
+    
+    if len(counts) > 0:
+        counts = np.concatenate(counts)
+        base_counts = np.concatenate(base_counts)
+    else:
+        counts = np.zeros((0, n_kmers), dtype=np.int64)
+        base_counts = np.zeros((0, 4), dtype=np.int64)
+    
+    if window is None:
+        comp_df = pd.DataFrame(counts, index=chroms, columns=kmer_names(k))
+    else:
+        comp_df = pd.DataFrame(counts, index=tiles.names(first=1), columns=kmer_names(k))
+        comp_df.insert(0, 'end', tiles.ends)
+        comp_df.insert(0, 'start', tiles.starts)
+        comp_df.insert(0, 'chrom', tiles.chromosomes)
+    
+    if frequencies:
+        totals = counts.sum(axis=1).astype(float)
+        totals[totals == 0] = np.nan
+        comp_df.loc[:,kmer_names(k)] = counts/totals[:,np.newaxis]
+    
+    acgt = base_counts.sum(axis=1).astype(float)
+    acgt[acgt == 0] = np.nan
+    comp_df.loc[:,'GC_content'] = (base_counts[:,1]+base_counts[:,2])/acgt
+    return comp_df
@@ -0,0 +1,455 @@
+import numpy as np
+import pandas as pd
+
+#####################################################
+## Sorted array index for genomic interval queries ##
+#####################################################
+
+class _SortedIntervals(object):
+    '''Intervals on one chromosome (and strand) sorted by start, with the running maximum of the ends.
+    All intervals that can overlap a position lie between two binary searches: starts before the query end
+    and running max end after the query start.'''
+    def __init__(self, starts, ends, rows):
+        order = np.argsort(starts, kind='mergesort')
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.rows = rows[order]
+        if len(self.ends) > 0:
+            self.max_end = np.maximum.accumulate(self.ends)
+        else:
+            self.max_end = self.ends
+
+    def _bounds(self, start, end, contained):
+        # contained: interval start < query start and interval end > query end (strict)
+        if contained == 'strict':
+            hi = np.searchsorted(self.starts, start, side='left')
+            lo = np.searchsorted(self.max_end, end, side='right')
+        elif contained == 'inclusive':
+            hi = np.searchsorted(self.starts, start, side='right')
+            lo = np.searchsorted(self.max_end, end, side='left')
+        else:
+            hi = np.searchsorted(self.starts, end, side='left')
+            lo = np.searchsorted(self.max_end, start, side='right')
+        return lo, hi
+
+    def _filter(self, ix, start, end, contained):
+        if contained == 'strict':
+            return ix[self.ends[ix] > end]
+        elif contained == 'inclusive':
+            return ix[self.ends[ix] >= end]
+        return ix[self.ends[ix] > start]
+
+    def query(self, start, end, contained=None):
+        lo, hi = self._bounds(start, end, contained)
+        if hi <= lo:
+            return np.zeros(0, dtype=np.int64)
+        ix = self._filter(np.arange(lo, hi), start, end, contained)
+        return self.rows[ix]
+
+    def query_batch(self, starts, ends, contained=None):
+        lo, hi = self._bounds(starts, ends, contained)
+        n = np.maximum(hi-lo, 0)
+        query_ix = np.repeat(np.arange(len(starts)), n)
+        offsets = np.zeros(len(n)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(n)
+        ix = np.repeat(lo, n) + np.arange(offsets[-1]) - np.repeat(offsets[:-1], n)
+        if contained == 'strict':
+            keep = self.ends[ix] > ends[query_ix]
+        elif contained == 'inclusive':
+            keep = self.ends[ix] >= ends[query_ix]
+        else:
+            keep = self.ends[ix] > starts[query_ix]
+        return query_ix[keep], self.rows[ix[keep]]
+
+class IntervalIndex(object):
+    '''Index of genomic intervals for fast overlap and containment queries. Intervals are grouped by
+    chromosome and strand and each group is kept as sorted numpy arrays, so a query costs two binary
+    searches plus the candidates between them rather than a scan of every interval.
+
+    Coordinates are compared as given - overlap means interval start < query end and interval end > query start.
+
+    Parameters
+    ----------
+    chromosomes : array-like
+        Chromosome of each interval
+    starts : array-like
+        Interval starts
+    ends : array-like
+        Interval ends
+    strands : array-like, default `None`
+        Strand of each interval. If `None`, queries ignore strand.
+    names : array-like, default `None`
+        Name of each interval (e.g. transcript), returned by the names method
+
+    Examples
+    --------
+    >>> index = IntervalIndex(['chr1','chr1'], [100, 500], [1000, 900], strands=['+','+'], names=['A','B'])
+    >>> index.names(index.containing('chr1', 600, 700, strand='+'))
+        ['A', 'B']
+    '''
+    def __init__(self, chromosomes, starts, ends, strands=None, names=None):
+        chromosomes = np.asarray(chromosomes, dtype=object)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        self.stranded = strands is not None
+        if self.stranded:
+            strands = np.asarray(strands, dtype=object)
+        else:
+            strands = np.array(['']*len(chromosomes), dtype=object)
+        self._names = np.asarray(names, dtype=object) if names is not None else None
+        self._length = len(starts)
+
+        self._groups = {}
+        if len(chromosomes) > 0:
+            groups = pd.DataFrame({'chromosome':chromosomes, 'strand':strands}).groupby(['chromosome','strand'], sort=False).indices
+            for key, rows in groups.iteritems():
+                rows = np.asarray(rows, dtype=np.int64)
+                self._groups[key] = _SortedIntervals(starts[rows], ends[rows], rows)
+
+    @classmethod
+    def from_df(cls, df, name_column=None, chrom_column='chromosome', stranded=True):
+        '''Build from a dataframe with chromosome, start, end and strand columns'''
+        names = df[name_column].values if name_column is not None else None
+        strands = df['strand'].values if stranded else None
+        return cls(df[chrom_column].values, df['start'].values, df['end'].values, strands=strands, names=names)
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return '<IntervalIndex: {0} intervals>'.format(self._length)
+
+    def _group_keys(self, chromosome, strand):
+        if not self.stranded:
+            return [(chromosome, '')]
+        if strand is None:
+            return [(chromosome, '+'), (chromosome, '-'), (chromosome, '.')]
+        return [(chromosome, strand)]
+
+    def _query(self, chromosome, start, end, strand, contained):
+        rows = [self._groups[key].query(start, end, contained=contained)
+                for key in self._group_keys(chromosome, strand) if key in self._groups]
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(rows))
+
+    def overlapping(self, chromosome, start, end, strand=None):
+        '''Rows (positions in the input arrays, in input order) of intervals overlapping start-end'''
+        return self._query(chromosome, start, end, strand, None)
+
+    def containing(self, chromosome, start, end, strand=None, strict=True):
+        '''Rows of intervals that contain start-end.
+        If strict, interval start < start and interval end > end, otherwise <= and >='''
+        return self._query(chromosome, start, end, strand, 'strict' if strict else 'inclusive')
+
+    def _query_batch(self, chromosomes, starts, ends, strands, contained):
+        chromosomes = np.asarray(chromosomes, dtype=object)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if strands is None or not self.stranded:
+            strands = np.array(['']*len(chromosomes), dtype=object)
+        else:
+            strands = np.asarray(strands, dtype=object)
+
+        query_rows = []
+        index_rows = []
+        if len(chromosomes) > 0:
+            groups = pd.DataFrame({'chromosome':chromosomes, 'strand':strands}).groupby(['chromosome','strand'], sort=False).indices
+            for (chromosome, strand), q_rows in groups.iteritems():
+                q_rows = np.asarray(q_rows, dtype=np.int64)
+                for key in self._group_keys(chromosome, strand):
+                    if key not in self._groups:
+                        continue
+                    q_ix, i_rows = self._groups[key].query_batch(starts[q_rows], ends[q_rows], contained=contained)
+                    query_rows.append(q_rows[q_ix])
+                    index_rows.append(i_rows)
+        if len(query_rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        query_rows = np.concatenate(query_rows)
+        index_rows = np.concatenate(index_rows)
+        order = np.lexsort((index_rows, query_rows))
+        return query_rows[order], index_rows[order]
+
+    def overlap_pairs(self, chromosomes, starts, ends, strands=None):
+        '''All overlaps for many queries at once.
+        Returns (query rows, index rows) arrays, sorted by query then index row'''
+        return self._query_batch(chromosomes, starts, ends, strands, None)
+
+    def containing_pairs(self, chromosomes, starts, ends, strands=None, strict=True):
+        '''All containing intervals for many queries at once (see containing).
+        Returns (query rows, index rows) arrays, sorted by query then index row'''
+        return self._query_batch(chromosomes, starts, ends, strands, 'strict' if strict else 'inclusive')
+
+    def names(self, rows):
+        '''Names of the intervals at rows'''
+        if self._names is None:
+            return list(rows)
+        return list(self._names[rows])
+
+class GroupedIntervals(object):
+    '''Intervals grouped by key (e.g. the CDS of each transcript) and stored in CSR form: the intervals of 
+    key n are starts[ptr[n]:ptr[n+1]] and ends[ptr[n]:ptr[n+1]], sorted by start. Looking up a key is a
+    dictionary lookup and a slice.
+
+    Parameters
+    ----------
+    keys : array-like
+        Key of each interval. Intervals with a missing (NaN) key are dropped.
+    starts : array-like
+        Interval starts
+    ends : array-like
+        Interval ends
+
+    Examples
+    --------
+    >>> cds = GroupedIntervals(['A','B','A'], [500, 10, 100], [600, 50, 200])
+    >>> cds.get('A')
+        (array([100, 500]), array([200, 600]))
+    >>> cds.span('A')
+        (100, 600)
+    '''
+    def __init__(self, keys, starts, ends):
+        keys = np.asarray(keys, dtype=object)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if len(keys) > 0:
+            codes, uniques = pd.factorize(keys)
+        else:
+            codes, uniques = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object)
+        keep = codes >= 0
+        codes = codes[keep]
+        order = np.lexsort((starts[keep], codes))
+        self.starts = starts[keep][order]
+        self.ends = ends[keep][order]
+        self.keys = list(uniques)
+        self._key_ix = dict((key, n) for n, key in enumerate(self.keys))
+        self.ptr = np.zeros(len(self.keys)+1, dtype=np.int64)
+        self.ptr[1:] = np.cumsum(np.bincount(codes, minlength=len(self.keys)))
+        if len(self.keys) > 0:
+            self._span_starts = self.starts[self.ptr[:-1]]
+            self._span_ends = np.maximum.reduceat(self.ends, self.ptr[:-1])
+        else:
+            self._span_starts = self._span_ends = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def from_df(cls, df, key_column='transcript'):
+        '''Build from a dataframe with key, start and end columns'''
+        return cls(df[key_column].values, df['start'].values, df['end'].values)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._key_ix
+
+    def __repr__(self):
+        return '<GroupedIntervals: {0} keys, {1} intervals>'.format(len(self.keys), len(self.starts))
+
+    def rows(self, key):
+        '''Slice of the starts and ends arrays for key'''
+        n = self._key_ix[key]
+        return slice(self.ptr[n], self.ptr[n+1])
+
+    def get(self, key):
+        '''(starts, ends) of the intervals for key, sorted by start'''
+        rows = self.rows(key)
+        return self.starts[rows], self.ends[rows]
+
+    def span(self, key):
+        '''(first start, last end) of the intervals for key'''
+        n = self._key_ix[key]
+        return self._span_starts[n], self._span_ends[n]
+
+    def spans(self, keys):
+        '''(first starts, last ends) arrays for many keys. Keys that are not in the index are -1.'''
+        ix = np.array([self._key_ix.get(key, -1) for key in keys], dtype=np.int64)
+        found = ix >= 0
+        starts = np.zeros(len(ix), dtype=np.int64)-1
+        ends = np.zeros(len(ix), dtype=np.int64)-1
+        starts[found] = self._span_starts[ix[found]]
+        ends[found] = self._span_ends[ix[found]]
+        return starts, ends
+
+#################################################
+## Tiling contigs into fixed or anchored bins  ##
+#################################################
+
+def _contig_lengths(lengths):
+    if isinstance(lengths, dict):
+        lengths = lengths.items()
+    contigs = [str(x[0]) for x in lengths]
+    return contigs, np.array([x[1] for x in lengths], dtype=np.int64)
+
+def bin_offsets(start, stop, bin_size, min_size=1):
+    '''Bins of bin_size from start while they fit before stop, then a last partial bin up to stop if it is at 
+    least min_size long. Returns (starts, ends) arrays, end exclusive.'''
+    n_full = max((stop-start)//bin_size, 0)
+    starts = start+np.arange(n_full, dtype=np.int64)*bin_size
+    ends = starts+bin_size
+    last = start+n_full*bin_size
+    if stop-last >= min_size and stop > last:
+        starts = np.append(starts, last)
+        ends = np.append(ends, stop)
+    return starts, ends
+
+class Tiles(object):
+    '''Tiles (bins) on a set of contigs kept as numpy arrays - contig id (position in contigs), start, end 
+    (end exclusive) and number (position of the tile within its contig). Build with fixed, sliding or anchored.
+
+    Examples
+    --------
+    >>> tiles = Tiles.fixed({'chr1':2500}, 1000)
+    >>> tiles.to_df()
+              chromosome  start   end
+        chr1-0      chr1      0  1000
+        chr1-1      chr1   1000  2000
+        chr1-2      chr1   2000  2500
+    '''
+    def __init__(self, contigs, contig_ids, starts, ends, numbers=None, anchor_names=None):
+        self.contigs = list(contigs)
+        self.anchor_names = anchor_names
+        self.contig_ids = np.asarray(contig_ids, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        if numbers is None:
+            counts = np.bincount(self.contig_ids, minlength=len(self.contigs))
+            first = np.zeros(len(self.contigs), dtype=np.int64)
+            first[1:] = np.cumsum(counts)[:-1]
+            order = np.argsort(self.contig_ids, kind='mergesort')
+            numbers = np.zeros(len(self.starts), dtype=np.int64)
+            numbers[order] = np.arange(len(order))-first[self.contig_ids[order]]
+        self.numbers = np.asarray(numbers, dtype=np.int64)
+
+    @classmethod
+    def sliding(cls, lengths, tile_size, step):
+        '''Tiles of tile_size every step bp from the start of each contig. Tiles start while a full tile 
+        would end before the contig end and the last tile is cut off at the contig end, so every contig has 
+        at least one tile.
+
+        Parameters
+        ----------
+        lengths : dict or list of (contig, length) pairs
+        tile_size : int
+        step : int
+        '''
+        contigs, lengths = _contig_lengths(lengths)
+        n_tiles = np.maximum(-(-(lengths-tile_size)//step), 0)+1
+        contig_ids = np.repeat(np.arange(len(contigs)), n_tiles)
+        first = np.zeros(len(contigs), dtype=np.int64)
+        first[1:] = np.cumsum(n_tiles)[:-1]
+        numbers = np.arange(n_tiles.sum())-np.repeat(first, n_tiles)
+        starts = numbers*step
+        ends = np.minimum(starts+tile_size, lengths[contig_ids])
+        return cls(contigs, contig_ids, starts, ends, numbers=numbers)
+
+    @classmethod
+    def fixed(cls, lengths, tile_size):
+        '''Adjacent tiles of tile_size from the start of each contig, the last one ending at the contig end
+        (same tiles as genome_tiles and make_tile_df)'''
+        return cls.sliding(lengths, tile_size, tile_size)
+
+    @classmethod
+    def anchored(cls, contigs, anchors, start, stop, bin_size, strands=None, min_size=1, names=None):
+        '''The same bins (see bin_offsets) placed around each anchor, e.g. a centromere midpoint or a telomere end.
+        Bins cover anchor+start to anchor+stop. For anchors on the - strand the offsets are mirrored
+        (anchor-stop to anchor-start). Tile numbers are the bin numbers, counted away from the anchor on both strands.
+
+        Parameters
+        ----------
+        contigs : array-like
+            Contig of each anchor
+        anchors : array-like
+            Anchor positions
+        start, stop : int
+            Offsets of the first bin start and the last bin end relative to the anchor
+        bin_size : int
+        strands : array-like, default `None`
+            Strand of each anchor
+        min_size : int, default 1
+            Minimum length of a last partial bin
+        names : array-like, default `None`
+            Name of each anchor - tiles are then named name-bin in to_df
+        '''
+        contigs = np.asarray(contigs, dtype=object)
+        anchors = np.asarray(anchors, dtype=np.int64)
+        offset_starts, offset_ends = bin_offsets(start, stop, bin_size, min_size=min_size)
+        n_bins = len(offset_starts)
+        unique = pd.unique(contigs)
+        contig_ids = pd.Index(unique).get_indexer(contigs)
+        anchor_ix = np.repeat(np.arange(len(anchors)), n_bins)
+        numbers = np.tile(np.arange(n_bins), len(anchors))
+        starts = anchors[anchor_ix]+offset_starts[numbers]
+        ends = anchors[anchor_ix]+offset_ends[numbers]
+        if strands is not None:
+            minus = np.asarray(strands, dtype=object)[anchor_ix] == '-'
+            starts = np.where(minus, anchors[anchor_ix]-offset_ends[numbers], starts)
+            ends = np.where(minus, anchors[anchor_ix]-offset_starts[numbers], ends)
+        if names is not None:
+            names = np.asarray(names, dtype=object)[anchor_ix]
+        return cls(unique, contig_ids[anchor_ix], starts, ends, numbers=numbers, anchor_names=names)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return '<Tiles: {0} tiles on {1} contigs>'.format(len(self.starts), len(self.contigs))
+
+    def tiles_per_contig(self):
+        '''Number of tiles on each contig (in contigs order)'''
+        return np.bincount(self.contig_ids, minlength=len(self.contigs))
+
+    @property
+    def chromosomes(self):
+        '''Contig name of each tile'''
+        return np.asarray(self.contigs, dtype=object)[self.contig_ids]
+
+    def names(self, first=0):
+        '''Tile names, contig-number (or anchor name-number for anchored tiles), numbered from first'''
+        prefix = self.anchor_names
+        if prefix is None:
+            prefix = self.chromosomes
+        return [str(name)+'-'+str(n) for name, n in zip(prefix, self.numbers+first)]
+
+    def to_df(self, first=0, chrom_column='chromosome'):
+        '''Dataframe of tiles indexed by name (see names) with chromosome, start and end columns'''
+        return pd.DataFrame({chrom_column:self.chromosomes, 'start':self.starts, 'end':self.ends}, 
+                            index=self.names(first=first), columns=[chrom_column,'start','end'])
+
+    def label(self, index, labels=None, endpoints=False):
+        '''Label each tile with the first interval (lowest row) in an IntervalIndex that overlaps it, e.g. features
+        from a gff3 file. Tiles that do not overlap anything get ''.
+
+        Parameters
+        ----------
+        index : IntervalIndex
+            Unstranded index of features
+        labels : array-like, default `None`
+            Label of each interval in index. If None, the index names are used.
+        endpoints : bool, default `False`
+            Only label a tile if its start or end is within the feature (start <= position < end) rather than 
+            if the tile and feature overlap
+
+        Returns
+        -------
+        tile_labels : numpy.ndarray
+        '''
+        chroms = self.chromosomes
+        if endpoints:
+            q1, i1 = index.overlap_pairs(chroms, self.starts, self.starts+1)
+            q2, i2 = index.overlap_pairs(chroms, self.ends, self.ends+1)
+            query_rows = np.concatenate([q1, q2])
+            index_rows = np.concatenate([i1, i2])
+        else:
+            query_rows, index_rows = index.overlap_pairs(chroms, self.starts, self.ends)
+        order = np.lexsort((index_rows, query_rows))
+        query_rows = query_rows[order]
+        index_rows = index_rows[order]
+        first = np.ones(len(query_rows), dtype=bool)
+        first[1:] = query_rows[1:] != query_rows[:-1]
+
+        if labels is None:
+            labels = index.names(np.arange(len(index)))
+        labels = np.asarray(labels, dtype=object)
+        tile_labels = np.array(['']*len(self), dtype=object)
+        tile_labels[query_rows[first]] = labels[index_rows[first]]
+        return tile_labels
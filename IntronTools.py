@@ -6,13 +6,16 @@ import numpy as np
 from scipy import stats
 import json
 import pickle
+from collections import OrderedDict
 
 script_path = os.path.dirname(os.path.realpath(__file__)).split('GeneTools')[0]
 sys.path.append(script_path)
 import GeneTools as GT
     
-class Intron:
-    '''Intron object containing information about the intron location and size
+class Intron(object):
+    '''Intron object containing information about the intron location and size.
+    Uses __slots__ and an integer contig id (see GT.feature_contig_id) to keep genome wide lists of introns small.
+    For batch operations on many introns use IntronSet.
     
     Parameters
     ----------
@@ -56,6 +59,8 @@ class Intron:
         Cryptococcus neoformans H99
     
     '''
+    __slots__ = ('contig_id', 'start', 'end', 'strand', 'organism')
+    
     def __init__(intron, chromosome_or_str, start=None, end=None, strand=None, str_format=None, organism='crypto'):
         if str_format is None:
             chromosome = chromosome_or_str
@@ -64,15 +69,35 @@ class Intron:
         else:
             chromosome, start, end, strand = intron_from_string(chromosome_or_str, str_format=str_format)
             
+        if type(organism) == str:
+            organism = GT.autoload_organism(organism)
+        # Contig ids belong to the organism - set it first
+        intron.organism = organism
+        
         intron.chromosome = chromosome
         intron.start = int(start)
         intron.end = int(end)
         intron.strand = strand
-        intron.length = abs(end-start)
-        
-        if type(organism) == str:
-            organism = GT.autoload_organism(organism)
-        intron.organism = organism
+    
+    @property
+    def chromosome(intron):
+        return GT.feature_contig_names(intron.organism)[intron.contig_id]
+    
+    @chromosome.setter
+    def chromosome(intron, chrom):
+        intron.contig_id = GT.feature_contig_id(chrom, intron.organism)
+    
+    @property
+    def length(intron):
+        return abs(intron.end-intron.start)
+    
+    def __getstate__(intron):
+        # Contig ids are only valid in this process - pickle the contig name
+        return (intron.chromosome, intron.start, intron.end, intron.strand, intron.organism)
+    
+    def __setstate__(intron, state):
+        chromosome, intron.start, intron.end, intron.strand, intron.organism = state
+        intron.chromosome = chromosome
             
     def transcripts(intron, as_string=False):
         ''' Find transcripts that may contain this intron (same strand and location)
@@ -88,21 +113,10 @@ class Intron:
             list of transcripts if as_string is False
             comma separated string of transcripts if as_string is True
         '''
-        ann_df = intron.organism.annotation
-        
-        if intron.organism.name == 'Schizosaccharomyces pombe':
-            transcripts = ann_df[ann_df['type'] == 'transcript']
-        else:
-            transcripts = ann_df[ann_df['type'] == 'mRNA']
-        matches = transcripts[(transcripts['chromosome'] == intron.chromosome) & (transcripts['strand'] == intron.strand)]
-        matches = matches[(matches['start'] < intron.start) & (matches['end'] > intron.end)]
+        tx_index = intron.organism.transcript_index
+        matches = tx_index.containing(intron.chromosome, intron.start, intron.end, strand=intron.strand)
         if len(matches) > 0:
-            if intron.organism.name == 'Schizosaccharomyces pombe':
-                tx_list = [x.lstrip('ID=transcript:').split(';')[0] for x in matches['ID']] 
-            else:
-                tx_list = [x.lstrip('ID=').split(';')[0] for x in matches['ID']]
-                if 'mRNA' in tx_list[0]:
-                    tx_list = [x.rstrip('_mRNA') for x in tx_list]
+            tx_list = tx_index.names(matches)
         else:
             tx_list = None
         if as_string:
@@ -122,7 +136,7 @@ class Intron:
             If True, intron is annotated
             If False, intron is not annotated
         '''
-        intron_df = build_intron_df(intron.organism.gff3, transcript_list=intron.transcripts())
+        intron_df = intron.organism.intron_df(transcript_list=intron.transcripts())
         if intron.start in list(intron_df['start']) and intron.end in list(intron_df['end']):
             ann = True
         else:
@@ -139,7 +153,7 @@ class Intron:
             I.e. the first intron will be 0 etc.
         '''
         
-        intron_df = build_intron_df(intron.organism.gff3, transcript_list=intron.transcripts())
+        intron_df = intron.organism.intron_df(transcript_list=intron.transcripts())
         
         starts = list(intron_df['start']).append(intron.start)
         starts = sorted(list(set(starts)))
@@ -156,7 +170,7 @@ class Intron:
             If True, intron is the first intron
         '''
         
-        intron_df = build_intron_df(intron.organism.gff3, transcript_list=intron.transcripts())
+        intron_df = intron.organism.intron_df(transcript_list=intron.transcripts())
         
         starts = list(intron_df['start'])
         starts.append(intron.start)
@@ -175,7 +189,7 @@ class Intron:
         ann : bool
             If True, intron is the last intron
         '''
-        intron_df = build_intron_df(intron.organism.gff3, transcript_list=intron.transcripts())
+        intron_df = intron.organism.intron_df(transcript_list=intron.transcripts())
         
         starts = list(intron_df['start'])
         starts.append(intron.start)
@@ -194,7 +208,7 @@ class Intron:
         ann : bool
             If True, intron is the only intron
         '''
-        intron_df = build_intron_df(intron.organism.gff3, transcript_list=intron.transcripts())
+        intron_df = intron.organism.intron_df(transcript_list=intron.transcripts())
         
         starts = list(intron_df['start'])
         starts.append(intron.start)
@@ -258,11 +272,7 @@ class Intron:
         '''
         
         fa_dict = intron.organism.sequence
-        
-        seq = fa_dict[intron.chromosome][intron.start+seq_range[0]-1:intron.end+seq_range[1]]
-        if intron.strand == '-':
-            seq = reverse_complement(seq)
-        return seq
+        return GT.seq_simple(intron.chromosome, intron.start+seq_range[0]-1, intron.end+seq_range[1]-1, intron.strand, fa_dict)
     
     def score5p(intron, PSSM_txt_file, position=(-2,6), quiet=True):
         ''' Score the 5 prime end of the intron
@@ -383,60 +393,16 @@ class Intron:
         py_content : float
             fraction pyrimidine between the branch and the 3 prime splice site
         '''
-        if branch_db.endswith('pickle') or branch_db.endswith('.db'):
-            branch_db = pd.read_pickle(branch_db)
-        elif branch_db.endswith('csv'):
-            branch_db = pd.read_csv(branch_db, index_col=0)
-        else:
-            print "Unrecognized branch database file type"
+        branch_db, branches = _read_branch_db(branch_db, guess=guess)
+        if branch_db is None:
             return None
-
-        seq_freq = []
-        for seq in set(branch_db['sequence']):
-            seq_freq.append((seq, len(branch_db[branch_db['sequence'] == seq])))
-
-        seq_freq = sorted(seq_freq, key=lambda x: x[1])
-        seq_freq.reverse()
-        branches = [x[0] for x in seq_freq if x[1] > 5]
         
-        intron_seq = intron.sequence()
         intron_br = branch_db[(branch_db['start'] == intron.start) & 
                               (branch_db['chromosome'] == intron.chromosome) &
                               (branch_db['end'] == intron.end) &
                               (branch_db['strand'] == intron.strand)]
-
-        if len(intron_br) == 1:
-            branch = intron_br['branch']
-            br_seq = intron_br['sequence']
-            if intron.strand == '+':
-                br_dist = intron_br['end']-branch
-            elif intron.strand == '-':
-                br_dist = branch-intron_br['start']
-        else:
-            branch = None
-            br_dist = np.NaN
-            br_seq = None
-            for br in branches:
-                ix = intron_seq.rfind(br)
-                if ix > 5:
-                    if intron.strand == '+':
-                        branch = intron.start+ix
-                    elif intron.strand == '-':
-                        branch = intron.end-ix
-                    br_seq = br
-                    br_dist = len(intron_seq)-ix
-                    break
-        if branch is not None:
-            py_count = 0
-            br_3p_seq = intron_seq[len(intron_seq)-br_dist:]
-            for n, base in enumerate(br_3p_seq):
-                if base == 'C' or base == 'T':
-                    py_count += 1
-            py_content = py_count/float(n+1)
-
-        else:
-            py_content = np.NaN
-        return branch, br_seq, br_dist, py_content
+        known = intron_br.iloc[0] if len(intron_br) == 1 else None
+        return _locate_branch(intron.start, intron.end, intron.strand, intron.sequence(), known, branches)
     
     
     ################################
@@ -552,93 +518,64 @@ class Intron:
             Pandas series where the index is the name of the bam files and the value is the read count or RPM
             Can be treated like a dictionary, but easier to perform math or populate a DataFrame
         '''
-        counts = pd.Series(index=bams)
-        for bam in bams:
-            read_count = 0
-            reads = pysam.Samfile(bam).fetch(intron.chromosome, intron.start-200, intron.end+200)
-            for read in reads:
-                # Filter for reads with junctions (can be 3 or 5 entries in cigartuples)
-                if len(read.cigartuples) >= 3 and read.cigartuples[1][0] == 3:
-                    junction_start = read.reference_start + read.cigartuples[0][1]+1
-                    junction_end = junction_start + read.cigartuples[1][1]-1
-                    
-                    # Make sure the junctions match the intron
-                    if intron.start == junction_start and intron.end == junction_end:
-                        if library_direction == 'reverse':
-                            if read.is_reverse and intron.strand == '+':
-                                read_count += 1
-                            elif not read.is_reverse and intron.strand == '-':
-                                read_count += 1
-                        else:
-                            if not read.is_reverse and intron.strand == '+':
-                                read_count += 1
-                            elif read.is_reverse and intron.strand == '-':
-                                read_count += 1
-                    
-                    # Check if there is a second junction in the read that might match the intron
-                    elif len(read.cigartuples) == 5:
-                        junction_start2 = junction_end + read.cigartuples[2][1]
-                        junction_end2 = junction_start2 + read.cigartuples[3][1]
-                        if intron.start == junction_start2 and intron.end == junction_end2:
-                            if library_direction == 'reverse':
-                                if read.is_reverse and intron.strand == '+':
-                                    read_count += 1
-                                elif not read.is_reverse and intron.strand == '-':
-                                    read_count += 1
-                            else:
-                                if not read.is_reverse and intron.strand == '+':
-                                    read_count += 1
-                                elif read.is_reverse and intron.strand == '-':
-                                    read_count += 1
-            counts[bam] = read_count
+        counts = junction_read_counter(bams, intron.chromosome, intron.start, intron.end, intron.strand, library_direction)
         return counts              
             
 ###############################################
 ## Functions for populating intron instances ##
 ###############################################
 
-def build_intron_df(gff3, transcript_list=None):
-    if 'pombe' in gff3: pombe = True
-    else: pombe = False   
+def build_intron_df(gff3, transcript_list=None, ann_df=None):
+    '''Table of introns in each transcript. Uses the intron features in the gff3 if there are any, 
+    otherwise introns are the gaps between consecutive exons of each transcript (exon end+1 to next exon start-1),
+    found for all transcripts at once by sorting exons by transcript and start.
     
-    ann_df = GT.read_gff3(gff3)
+    Parameters
+    ----------
+    gff3 : str
+        gff3 file
+    transcript_list : list, default `None`
+        Only return introns in these transcripts
+    ann_df : pandas.DataFrame, default `None`
+        Annotation already read with read_gff3 (e.g. organism.annotation) - gff3 is not read again
+    
+    Returns
+    -------
+    intron_df : pandas.DataFrame
+        chromosome, start, end, strand and transcript of each intron
+    '''
+    if ann_df is None:
+        ann_df = GT.read_gff3(gff3)
     if 'intron' in list(ann_df['type']):
         print "Introns in gff3"
         intron_df = ann_df[ann_df['type'] == 'intron']
-        intron_df = intron_df[['chromosome','start','end','strand','ID']]
-        intron_df.loc[:,'transcript'] = intron_df['ID'].str.split('Parent=').str[1].str.split(';').str[0]
-        if 'cerev' in gff3:
-            intron_df.loc[:,'transcript'] = intron_df.loc['transcript'].str.split('_mRNA').str[0]
+        intron_df.loc[:,'transcript'] = GT.normalize_transcript_ids(intron_df['Parent']).values
+        intron_df = intron_df[['chromosome','start','end','strand','ID','transcript']]
         if transcript_list is not None:
-            intron_df = intron_df['transcript'].isin(transcript_list)
+            intron_df = intron_df[intron_df['transcript'].isin(transcript_list)]
     
     elif 'exon' in list(ann_df['type']):
-        exon_df = ann_df[['chromosome','start','type','end','strand','ID']]
-        exon_df = exon_df[exon_df['type'] == 'exon']
-        exon_df.loc[:,'transcript'] = exon_df['ID'].str.split('Parent=').str[1].str.split(';').str[0]
-        if pombe:
-            exon_df.loc[:,'transcript'] = exon_df['transcript'].str.split('transcript:').str[1]
+        exon_df = ann_df[ann_df['type'] == 'exon']
+        exon_df = pd.DataFrame({'chromosome':exon_df['chromosome'].values, 'start':exon_df['start'].values, 
+                                'end':exon_df['end'].values, 'strand':exon_df['strand'].values,
+                                'transcript':GT.normalize_transcript_ids(exon_df['Parent']).values})
+        exon_df = exon_df[exon_df['transcript'].notnull()]
         if transcript_list is not None:
             exon_df = exon_df[exon_df['transcript'].isin(transcript_list)]
-        intron_df = pd.DataFrame(columns = exon_df.columns)
-        df_dict = {'chromosome':[],'transcript':[],'start':[],'end':[],'strand':[]}
-        for tx in set(exon_df['transcript']):
-            tx_df = exon_df[exon_df['transcript'] == tx]
-            tx_df = tx_df.sort_values('start').reset_index(drop=True)
-            for n in tx_df.index[:-1]:
-                try:
-                    df_dict['transcript'].append(tx)
-                    df_dict['chromosome'].append(tx_df.loc[n,'chromosome'])
-                    df_dict['strand'].append(tx_df.loc[n,'strand'])
-                    df_dict['start'].append(tx_df.loc[n,'end']+1)
-                    df_dict['end'].append(tx_df.loc[n+1,'start']-1)
-                except KeyError:
-                    pass
-        for col, data in df_dict.iteritems():
-            intron_df.loc[:,col] = data
-    
-    intron_df['start'] = intron_df['start'].apply(int)
-    intron_df['end'] = intron_df['end'].apply(int)
+        exon_df = exon_df.sort_values(['transcript','start'])
+        
+        # Each exon followed by another exon of the same transcript gives an intron
+        transcripts = exon_df['transcript'].values
+        same = transcripts[1:] == transcripts[:-1]
+        intron_df = pd.DataFrame({'chromosome':exon_df['chromosome'].values[:-1][same], 
+                                  'start':exon_df['end'].values[:-1][same]+1,
+                                  'end':exon_df['start'].values[1:][same]-1,
+                                  'strand':exon_df['strand'].values[:-1][same],
+                                  'transcript':transcripts[:-1][same]},
+                                 columns=['chromosome','start','end','strand','transcript'])
+    
+    intron_df['start'] = intron_df['start'].astype(int)
+    intron_df['end'] = intron_df['end'].astype(int)
     return intron_df
     
 def intron_from_string(intron_str, str_format="JUM"):
@@ -654,7 +591,8 @@ def intron_from_string(intron_str, str_format="JUM"):
         end = int(intron_str.split(':')[-1].split(',')[0].split('-')[1])
     return chromosome, start, end, strand
 
-def introns_from_gff3(organism, transcript_list=None, by_transcript=False, sort=True, pickle_name=None):
+def introns_from_gff3(organism, transcript_list=None, by_transcript=False, sort=True, pickle_name=None, catalogue_name=None,
+                      as_set=False):
     '''Function to build a list of intron objects in the genome
     
     Parameters
@@ -668,23 +606,35 @@ def introns_from_gff3(organism, transcript_list=None, by_transcript=False, sort=
     sort : bool, default `True`
         Sort introns first by chromosome then by start position. 
         If False will be in order of occurence in gff3
+    pickle_name : str, default `None`
+        Pickle the introns to this file (the organism is pickled by name and file names only)
+    catalogue_name : str, default `None`
+        Also save the introns as an IntronCatalogue (.npz) - much smaller and faster to load than a pickle
+    as_set : bool, default `False`
+        Return an IntronSet (arrays rather than Intron objects - use for genome wide intron tables).
+        by_transcript is ignored.
                 
     Returns
     --------
     introns : list of intron objects if by_transcript is False
               dict of intron objects with transcripts as keys if by_transcript is True
+              IntronSet if as_set is True
                     '''
     if type(organism) == str:
         organism = GT.autoload_organism(organism)
  
-    intron_df = build_intron_df(organism.gff3, transcript_list=transcript_list)
+    intron_df = organism.intron_df(transcript_list=transcript_list)
     
     #first group introns to remove redundancy
     intron_df = intron_df.sort_values('transcript')
     intron_df = intron_df.drop_duplicates(subset=['chromosome','start','end'])
     
     #then go through all introns and create instances
-    if not by_transcript:
+    if as_set:
+        if sort:
+            intron_df = intron_df.sort_values(['chromosome','start'])
+        introns = IntronSet.from_df(intron_df, organism=organism)
+    elif not by_transcript:
         introns = []
         for ix, r in intron_df.iterrows():
             introns.append(Intron(r['chromosome'],r['start'],r['end'],r['strand'], organism=organism))
@@ -702,36 +652,345 @@ def introns_from_gff3(organism, transcript_list=None, by_transcript=False, sort=
     if pickle_name is not None:
         with open(pickle_name, 'w') as fout:
             pickle.dump(introns, fout)
+    if catalogue_name is not None:
+        IntronCatalogue.from_organism(organism, transcript_list=transcript_list).save(catalogue_name)
     return introns
 
+########################################################
+## Columnar intron catalogue and batch intron scoring ##
+########################################################
+
+_PSSM_ROWS = np.zeros(256, dtype=np.uint8)+255
+for _base, _row in (('A',0), ('C',1), ('T',2), ('G',3)):
+    _PSSM_ROWS[ord(_base)] = _row
+    _PSSM_ROWS[ord(_base.lower())] = _row
+
+def pssm_scores(seqs, PSSM):
+    '''Score many splice site sequences at once with a PSSM (rows A, C, T, G as made by build_consensus_matrix).
+    Same scores as Intron.score5p and score3p. Sequences with other bases or shorter than the PSSM score NaN.'''
+    PSSM = np.asarray(PSSM)
+    length = PSSM.shape[1]
+    seqs = np.asarray(seqs, dtype=object)
+    scores = np.zeros(len(seqs))+np.NaN
+    full = np.array([len(seq) == length for seq in seqs], dtype=bool)
+    if full.any():
+        rows = _PSSM_ROWS[np.frombuffer(str(''.join(seqs[full])), dtype=np.uint8).reshape(-1, length)]
+        valid = (rows < 4).all(axis=1)
+        rows = np.where(rows < 4, rows, 0)
+        full_scores = PSSM[rows, np.arange(length)].sum(axis=1)
+        scores[np.where(full)[0][valid]] = full_scores[valid]
+    return scores
+
+def splice_site_windows(starts, ends, strands, site='5prime', position=(-2,6)):
+    '''0 based, end exclusive windows around the 5 prime or 3 prime splice sites of introns 
+    (the same bases scored by Intron.score5p and Intron.score3p). Returns (starts, ends) arrays.'''
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    minus = np.asarray(strands, dtype=object) == '-'
+    if site == '5prime':
+        w_starts = np.where(minus, ends-position[1], starts-1+position[0])
+        w_ends = np.where(minus, ends-position[0], starts-1+position[1])
+    else:
+        w_starts = np.where(minus, starts-1-position[1], ends+position[0])
+        w_ends = np.where(minus, starts-1-position[0], ends+position[1])
+    return w_starts, w_ends
+
+def _read_branch_db(branch_db, guess=True):
+    # Branch table and the common branch sequences (seen more than 5 times) used to guess branches
+    if branch_db.endswith('pickle') or branch_db.endswith('.db'):
+        branch_db = pd.read_pickle(branch_db)
+    elif branch_db.endswith('csv'):
+        branch_db = pd.read_csv(branch_db, index_col=0)
+    else:
+        print "Unrecognized branch database file type"
+        return None, None
+    
+    branches = []
+    if guess:
+        seq_freq = branch_db['sequence'].value_counts()
+        seq_freq = seq_freq[seq_freq > 5]
+        branches = sorted(seq_freq.index, key=lambda seq: seq_freq[seq], reverse=True)
+    return branch_db, branches
+
+def _locate_branch(start, end, strand, intron_seq, known, branches):
+    # known is the branch_db row for the intron or None
+    if known is not None:
+        branch = int(known['branch'])
+        br_seq = known['sequence']
+        if strand == '+':
+            br_dist = int(known['end'])-branch
+        elif strand == '-':
+            br_dist = branch-int(known['start'])
+    else:
+        branch = None
+        br_dist = np.NaN
+        br_seq = None
+        for br in branches:
+            ix = intron_seq.rfind(br)
+            if ix > 5:
+                if strand == '+':
+                    branch = start+ix
+                elif strand == '-':
+                    branch = end-ix
+                br_seq = br
+                br_dist = len(intron_seq)-ix
+                break
+    if branch is not None and br_dist > 0:
+        br_3p_seq = intron_seq[len(intron_seq)-br_dist:]
+        py_content = (br_3p_seq.count('C')+br_3p_seq.count('T'))/float(len(br_3p_seq))
+    else:
+        py_content = np.NaN
+    return branch, br_seq, br_dist, py_content
+
+class IntronSet(GT.FeatureSet):
+    '''Introns stored as arrays (see GT.FeatureSet) with the sequence, scoring and counting methods of Intron
+    applied to every intron at once. set[n] is an Intron.
+    
+    Examples
+    --------
+    >>> introns = introns_from_gff3(crypto, as_set=True)
+    >>> scores = introns.score5p('crypto_5prime_PSSM.txt')
+    >>> counts = introns.count_junction_reads(['WT.bam','mut.bam'])
+    '''
+    @classmethod
+    def from_df(cls, intron_df, organism=None):
+        '''Set from a dataframe with chromosome, start, end and strand columns (one row per intron)'''
+        contig_ids, contigs = pd.factorize(np.asarray(intron_df['chromosome'], dtype=object).astype(str), sort=True)
+        return cls(contigs, contig_ids, intron_df['start'].values, intron_df['end'].values, 
+                   np.asarray(intron_df['strand'], dtype=object).astype(str), organism=organism)
+    
+    @classmethod
+    def from_introns(cls, introns):
+        '''Set from a list of Intron objects'''
+        organism = introns[0].organism if len(introns) > 0 else None
+        return cls.from_df(pd.DataFrame({'chromosome':[intron.chromosome for intron in introns], 
+                                         'start':[intron.start for intron in introns], 
+                                         'end':[intron.end for intron in introns],
+                                         'strand':[intron.strand for intron in introns]}), organism=organism)
+    
+    def record(self, n):
+        return Intron(self.contigs[self.contig_ids[n]], int(self.starts[n]), int(self.ends[n]), self.strands[n], 
+                      organism=self.organism)
+    
+    def introns(self):
+        '''List of Intron objects for every row'''
+        return list(self)
+    
+    def sequence(self, seq_range=(-2,2)):
+        '''Sequence of every intron (see Intron.sequence), retrieved in one batch'''
+        return self._fetch(self.starts+seq_range[0]-1, self.ends+seq_range[1])
+    
+    def _score(self, PSSM_txt_file, site, position):
+        starts, ends = splice_site_windows(self.starts, self.ends, self.strands.astype(str), site=site, position=position)
+        return pssm_scores(self._fetch(starts, ends), np.loadtxt(PSSM_txt_file)[:,:position[1]-position[0]])
+    
+    def score5p(self, PSSM_txt_file, position=(-2,6)):
+        '''5 prime splice site scores (see Intron.score5p). Sites with bases other than A, C, G and T are NaN.'''
+        return self._score(PSSM_txt_file, '5prime', position)
+    
+    def score3p(self, PSSM_txt_file, position=(-6,2)):
+        '''3 prime splice site scores (see Intron.score3p). Sites with bases other than A, C, G and T are NaN.'''
+        return self._score(PSSM_txt_file, '3prime', position)
+    
+    def percent_py(self, fraction=0.3):
+        '''Percent pyrimidine in the last fraction of each intron (see Intron.percent_py)'''
+        percent_py = np.zeros(len(self))+np.NaN
+        for n, seq in enumerate(self.sequence()):
+            tail = seq[len(seq)-int(len(seq)*fraction):]
+            if len(tail) > 0:
+                percent_py[n] = (tail.count('T')+tail.count('C'))/float(len(tail))*100
+        return percent_py
+    
+    def count_5pss_reads(self, bams, rpm=False, library_direction='reverse'):
+        '''Reads spanning each 5 prime splice site (see Intron.count_5pss_reads). Returns a DataFrame of introns x bams.'''
+        counts = self._count(bams, self.starts, self.starts, library_direction=library_direction, max_cigar_ops=3)
+        if rpm:
+            counts = counts.mul([GT.count_aligned_reads(bam) for bam in counts.columns], axis=1)
+        return counts
+    
+    def count_3pss_reads(self, bams, rpm=False, library_direction='reverse'):
+        '''Reads spanning each 3 prime splice site (see Intron.count_3pss_reads). Returns a DataFrame of introns x bams.'''
+        counts = self._count(bams, self.ends, self.ends, library_direction=library_direction, max_cigar_ops=3)
+        if rpm:
+            counts = counts.mul([GT.count_aligned_reads(bam) for bam in counts.columns], axis=1)
+        return counts
+    
+    def count_intronic_reads(self, bams, rpkm=False, library_direction='reverse'):
+        '''Reads within each intron (see Intron.count_intronic_reads). Returns a DataFrame of introns x bams.'''
+        counts = self._count(bams, self.starts-1, self.ends+1, library_direction=library_direction)
+        if rpkm:
+            counts = self._rpkm(counts, self.ends-self.starts)
+        return counts
+    
+    def count_junction_reads(self, bams, library_direction='reverse'):
+        '''Reads with junctions that match each intron (see Intron.count_junction_reads). 
+        Returns a DataFrame of introns x bams.'''
+        if type(bams) == str or isinstance(bams, pysam.AlignmentFile):
+            bams = [bams]
+        counts = pd.DataFrame(index=self.labels())
+        for bam in bams:
+            index = GT.junction_index(bam, library_direction=library_direction)
+            counts[GT.bam_name(bam)] = index.counts(self.chromosomes, self.starts, self.ends, self.strands).astype(float)
+        return counts
+
+INTRON_CATALOGUE_VERSION = 1
+
+class IntronCatalogue(IntronSet):
+    '''Introns stored as columns (numpy arrays) rather than as Intron objects: contig id, start, end, strand,
+    the transcripts containing each intron and optional precomputed 5'/3' splice site scores, percent
+    pyrimidine and branch information. Catalogues are saved as .npz files that do not contain the genome
+    or annotation - only the organism name and file names, which are used to find the organism again on loading.
+    Intron objects are only created when a row is accessed (catalogue[n] or iterating). 
+    All IntronSet methods are available.
+    
+    Parameters
+    ----------
+    contigs : list
+        Contig names - contig_ids index into this list
+    contig_ids, starts, ends, strands : array-like
+        One entry per intron
+    transcripts : array-like, default `None`
+        Comma separated transcripts containing each intron
+    organism : GT.Organism, default `None`
+    columns : dict, default `None`
+        Other per intron columns (e.g. score5, score3, percent_py, branch, branch_seq, branch_dist, branch_py)
+    
+    Examples
+    --------
+    >>> catalogue = IntronCatalogue.from_organism(crypto, PSSM5='crypto_5prime_PSSM.txt', PSSM3='crypto_3prime_PSSM.txt')
+    >>> catalogue.save('crypto_introns.npz')
+    >>> catalogue = IntronCatalogue.load('crypto_introns.npz')
+    >>> catalogue[0].sequence()
+    '''
+    def __init__(self, contigs, contig_ids, starts, ends, strands, transcripts=None, organism=None, columns=None):
+        IntronSet.__init__(self, contigs, contig_ids, starts, ends, strands, organism=organism)
+        if transcripts is None:
+            transcripts = ['']*len(self.starts)
+        self.transcripts = np.asarray(transcripts, dtype=str)
+        self.columns = OrderedDict()
+        if columns is not None:
+            for name, values in columns.iteritems():
+                self.columns[name] = np.asarray(values)
+    
+    @classmethod
+    def from_intron_df(cls, intron_df, organism=None):
+        '''Catalogue from an intron table (e.g. build_intron_df) with chromosome, start, end, strand and 
+        transcript columns. Introns found in several transcripts are listed once.'''
+        intron_df = pd.DataFrame({'chromosome':np.asarray(intron_df['chromosome'], dtype=object).astype(str), 
+                                  'start':intron_df['start'].values, 'end':intron_df['end'].values,
+                                  'strand':np.asarray(intron_df['strand'], dtype=object).astype(str),
+                                  'transcript':intron_df['transcript'].values})
+        intron_df = intron_df.sort_values(['chromosome','start','end','strand','transcript'])
+        grouped = intron_df.groupby(['chromosome','start','end','strand'], sort=False)
+        first = grouped.head(1)
+        transcripts = grouped['transcript'].apply(lambda x: ','.join(pd.unique(x.astype(str))))
+        contig_ids, contigs = pd.factorize(first['chromosome'].values, sort=True)
+        return cls(contigs, contig_ids, first['start'].values, first['end'].values, first['strand'].values,
+                   transcripts=transcripts.values, organism=organism)
+    
+    @classmethod
+    def from_organism(cls, organism, transcript_list=None, PSSM5=None, PSSM3=None, branch_db=None):
+        '''Catalogue of the introns in the organism annotation, optionally scored (see score and add_branches)'''
+        if type(organism) == str:
+            organism = GT.autoload_organism(organism)
+        catalogue = cls.from_intron_df(organism.intron_df(transcript_list=transcript_list), organism=organism)
+        if PSSM5 is not None or PSSM3 is not None:
+            catalogue.score(PSSM5=PSSM5, PSSM3=PSSM3)
+        if branch_db is not None:
+            catalogue.add_branches(branch_db)
+        return catalogue
+    
+    def __repr__(self):
+        return '<IntronCatalogue: {0} introns on {1} contigs>'.format(len(self), len(self.contigs))
+    
+    def take(self, ix):
+        return self.__class__(self.contigs, self.contig_ids[ix], self.starts[ix], self.ends[ix], self.strands[ix],
+                              transcripts=self.transcripts[ix], organism=self.organism, 
+                              columns=OrderedDict((name, values[ix]) for name, values in self.columns.iteritems()))
+    
+    def to_df(self):
+        '''Dataframe with chromosome, start, end, strand, transcripts and any other columns'''
+        df = pd.DataFrame({'chromosome':self.chromosomes, 'start':self.starts, 'end':self.ends, 
+                           'strand':self.strands.astype(str), 'transcripts':self.transcripts.astype(str)},
+                          columns=['chromosome','start','end','strand','transcripts'])
+        for name, values in self.columns.iteritems():
+            df.loc[:,name] = values
+        return df
+    
+    def score(self, PSSM5=None, PSSM3=None, position5=(-2,6), position3=(-6,2), fraction=0.3):
+        '''Add score5 and score3 (see Intron.score5p and Intron.score3p) and percent_py (Intron.percent_py) columns.
+        PSSM5 and PSSM3 are text files written by build_consensus_matrix.'''
+        if PSSM5 is not None:
+            self.columns['score5'] = self.score5p(PSSM5, position=position5)
+        if PSSM3 is not None:
+            self.columns['score3'] = self.score3p(PSSM3, position=position3)
+        self.columns['percent_py'] = self.percent_py(fraction=fraction)
+    
+    def add_branches(self, branch_db, guess=True):
+        '''Add branch, branch_seq, branch_dist and branch_py columns (see Intron.branch). 
+        Missing branches are -1, '' and NaN.'''
+        branch_db, branches = _read_branch_db(branch_db, guess=guess)
+        if branch_db is None:
+            return None
+        keys = zip(branch_db['chromosome'].astype(str), branch_db['start'], branch_db['end'], branch_db['strand'])
+        counts = pd.Series(keys).value_counts()
+        known = dict((key, row) for key, (ix, row) in zip(keys, branch_db.iterrows()) if counts[key] == 1)
+        
+        branch = np.zeros(len(self), dtype=np.int64)-1
+        branch_seq = np.zeros(len(self), dtype='S16')
+        branch_dist = np.zeros(len(self))+np.NaN
+        branch_py = np.zeros(len(self))+np.NaN
+        for n, (chrom, start, end, strand, seq) in enumerate(zip(self.chromosomes, self.starts, self.ends, 
+                                                                 self.strands.astype(str), self.sequence())):
+            row = known.get((chrom, start, end, strand))
+            b, b_seq, b_dist, b_py = _locate_branch(start, end, strand, seq, row, branches)
+            if b is not None:
+                branch[n] = b
+                branch_seq[n] = b_seq
+                branch_dist[n] = b_dist
+                branch_py[n] = b_py
+        self.columns['branch'] = branch
+        self.columns['branch_seq'] = branch_seq
+        self.columns['branch_dist'] = branch_dist
+        self.columns['branch_py'] = branch_py
+    
+    def save(self, npz_name):
+        '''Save as a .npz file (arrays only - no genome, annotation or pickled objects)'''
+        arrays = {'version':np.array([INTRON_CATALOGUE_VERSION]), 'contigs':np.array(self.contigs, dtype=str),
+                  'contig_ids':self.contig_ids, 'starts':self.starts, 'ends':self.ends, 'strands':self.strands,
+                  'transcripts':self.transcripts, 'column_names':np.array(self.columns.keys(), dtype=str)}
+        for name, values in self.columns.iteritems():
+            arrays['column_'+name] = values
+        if self.organism is not None:
+            arrays['organism'] = np.array([self.organism.name, self.organism.fasta_file, self.organism.gff3], dtype=str)
+        np.savez(npz_name, **arrays)
+        return npz_name
+    
+    @classmethod
+    def load(cls, npz_name, organism=None):
+        '''Load a catalogue written by save. If organism is None, the organism recorded in the file is loaded
+        (shared with get_organism).'''
+        arrays = np.load(npz_name)
+        if organism is None and 'organism' in arrays.files:
+            name, fasta_file, gff3 = [str(x) for x in arrays['organism']]
+            organism = GT.get_organism(name, fasta_file, gff3)
+        columns = OrderedDict((str(name), arrays['column_'+str(name)]) for name in arrays['column_names'])
+        return cls(arrays['contigs'], arrays['contig_ids'], arrays['starts'], arrays['ends'], arrays['strands'],
+                   transcripts=arrays['transcripts'], organism=organism, columns=columns)
+
 ##########################################
 ## Functions for working with sequences ##
 ##########################################
     
-def complement(seq):
-    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A','N':'N', 'Y':'R', 'R':'Y'} 
-    bases = list(seq) 
-    bases = [complement[base] for base in bases] 
-    return ''.join(bases)
-
-def reverse_complement(s):
-        return complement(s[::-1])
-
 def gc_content(fa_dict):
-    base_dict = {0:"A", 1:"C", 2:"T", 3:"G"}
-    tally = np.zeros([1,4])[0]
-    for chrom, seq in fa_dict.iteritems():
-        for n in range(len(tally)):
-            tally[n] += seq.count(base_dict[n])
+    '''Genome wide base frequencies in the order A, C, T, G'''
+    tally = GT.sequence_composition(fa_dict, k=1)[['A','C','T','G']].sum().values.astype(float)
     total = float(sum(tally))   
     nucleotide_prob = tally/total
     return nucleotide_prob
 
 def build_consensus_matrix(organism, gff3, fa, out_name, seq_type='intron', position=('5prime',-2,6)):
-    if fa.endswith('.json'):
-        with open(fa) as f: fa_dict = json.load(f)
-    else:
-        fa_dict = make_fasta_json(fasta_file)
+    fa_dict = GT.load_genome(fa)
     
     all_transcripts = GT.populate_transcript_df(gff3)
     
@@ -762,11 +1021,18 @@ def build_consensus_matrix(organism, gff3, fa, out_name, seq_type='intron', posi
             sequences.append(seq)
             
     print "Calculating base composition..."
+    n_skipped = 0
     for seq in sequences:
         if position[0] == '5prime':
             seq = seq[:position[2]-position[1]]
         elif position[0] == '3prime':
             seq = seq[position[1]-position[2]:]
+        
+        # Soft masked or ambiguous bases
+        seq = seq.upper()
+        if len(set(seq).difference('ACGT')) > 0:
+            n_skipped += 1
+            continue
 
         for a, base in enumerate(seq):
             PSSM[base_dict[base],a] += 1
@@ -774,7 +1040,7 @@ def build_consensus_matrix(organism, gff3, fa, out_name, seq_type='intron', posi
     for a in range(PSSM.shape[0]):
         for b in range(PSSM.shape[1]):
             if PSSM[a,b] == 0: PSSM[a,b] += 1
-            PSSM[a,b] = np.log2((PSSM[a,b]/float(len(sequences)))/nuc_prob[a])
+            PSSM[a,b] = np.log2((PSSM[a,b]/float(len(sequences)-n_skipped))/nuc_prob[a])
     
     float_formatter = lambda x: "%.1f" % x
     np.set_printoptions(formatter={'float_kind':float_formatter})
@@ -788,27 +1054,10 @@ def build_consensus_matrix(organism, gff3, fa, out_name, seq_type='intron', posi
 ##################################
             
 def span_read_counter(bams, chromosome, coordinate, strand, rpm, library_direction):
-    if type(bams) == str:
-        bams = [bams]
-    counts = pd.Series(index=bams)
-    for bam in bams:
-        ob = pysam.Samfile(bam)
-        read_iter = ob.fetch(chromosome, coordinate-200, coordinate+200)
-        read_count = 0
-        for read in read_iter:
-            if len(read.cigartuples) < 3:
-                if read.reference_start < coordinate and read.reference_end > coordinate:
-                    if library_direction == 'reverse':
-                        if strand == '+' and read.is_reverse:
-                            read_count += 1
-                        elif strand == '-' and not read.is_reverse:
-                            read_count += 1
-                    else:
-                        if strand == '+' and not read.is_reverse:
-                            read_count += 1
-                        elif strand == '-' and read.is_reverse:
-                            read_count += 1
-        counts[bam] = read_count
+    '''Count unspliced reads (fewer than 3 CIGAR operations) that span coordinate (see count_reads_in_regions)'''
+    regions = pd.DataFrame({'chromosome':[chromosome], 'start':[coordinate], 'end':[coordinate], 'strand':[strand]})
+    counts = GT.count_reads_in_regions(bams, regions, library_direction=library_direction, max_cigar_ops=3).iloc[0]
+    counts = counts.astype(float)
         
     if rpm:
         for bam in counts.keys():
@@ -816,67 +1065,34 @@ def span_read_counter(bams, chromosome, coordinate, strand, rpm, library_directi
             counts[bam] = counts[bam]*scale
     return counts
 
-def simple_read_counter(bams, chromosome, start, end, strand, rpkm=False, library_direction='reverse'):
-    if type(bams) == str:
-        bams = [bams]
-    counts = pd.Series(index=bams)
-    for bam in bams:
-        ob = pysam.Samfile(bam)
-        read_iter = ob.fetch(chromosome, start-200, end+200)
-        read_count = 0
-        for read in read_iter:
-            if read.reference_end >= start and read.reference_start <= end:
-                if library_direction == 'reverse':
-                    if strand == '+' and read.is_reverse:
-                        read_count += 1
-                    elif strand == '-' and not read.is_reverse:
-                        read_count += 1
-                elif library_direction == 'forward':
-                    if strand == '+' and not read.is_reverse:
-                        read_count += 1
-                    elif strand == '-' and read.is_reverse:
-                        read_count += 1
-                elif library_direction == 'unstranded':
-                    read_count += 1
-                else:
-                    raise ValueError('Unknown library direction')
-        counts[bam] = read_count
+def simple_read_counter(bams, chromosome, start, end, strand, rpkm=False, library_direction='reverse', threads=1):
+    '''Count reads that overlap start to end, including reads ending at start or starting at end 
+    (see count_reads_in_regions)'''
+    regions = pd.DataFrame({'chromosome':[chromosome], 'start':[start-1], 'end':[end+1], 'strand':[strand]})
+    counts = GT.count_reads_in_regions(bams, regions, library_direction=library_direction, threads=threads).iloc[0]
+    counts = counts.astype(float)
     if rpkm:
         for bam in counts.keys():
             total = GT.count_aligned_reads(bam)
-            counts[bam] = (counts[bam]/total)/((end-start)/1000)
+            counts[bam] = (counts[bam]/total)/((end-start)/1000.)
     return counts        
         
+def junction_read_counter(bams, chromosome, start, end, strand, library_direction='reverse'):
+    '''Count the reads with junctions that match the intron from start to end (see Intron.count_junction_reads).
+    Uses the junction table of each bam file (see junction_index), which is built the first time the bam is used.'''
+    if type(bams) == str or isinstance(bams, pysam.AlignmentFile):
+        bams = [bams]
+    counts = pd.Series(index=[GT.bam_name(bam) for bam in bams])
+    for bam in bams:
+        counts[GT.bam_name(bam)] = GT.junction_index(bam, library_direction=library_direction).count(chromosome, start, end, strand)
+    return counts
+
 def single_bam_counter(args):
     bam, chromosome, start, end, strand, library_direction = args
-    ob = pysam.Samfile(bam)
-    read_iter = ob.fetch(chromosome, start-200, end+200)
-    read_count = 0
-    for read in read_iter:
-        if read.reference_end >= start and read.reference_start <= end:
-            if library_direction == 'reverse':
-                if strand == '+' and read.is_reverse:
-                    read_count += 1
-                elif strand == '-' and not read.is_reverse:
-                    read_count += 1
-            elif library_direction == 'forward':
-                if strand == '+' and not read.is_reverse:
-                    read_count += 1
-                elif strand == '-' and read.is_reverse:
-                    read_count += 1
-            elif library_direction == 'unstranded':
-                read_count += 1
-            else:
-                raise ValueError('Unknown library direction')
+    read_count = int(simple_read_counter(bam, chromosome, start, end, strand, library_direction=library_direction).iloc[0])
     return bam, read_count
 
 def pool_read_counter(bams, chromosome, start, end, strand, rpkm=False, library_direction='reverse', threads=10):
-    args = []
-    for bam in bams:
-        args.append((bam, chromosome, start, end, strand, library_direction))
-    p = Pool(threads)
-    counts = p.map(single_bam_counter, args)
-    print counts
-
-
-    
\ No newline at end of file
+    '''simple_read_counter with the bam files counted in a process pool'''
+    return simple_read_counter(bams, chromosome, start, end, strand, rpkm=rpkm, library_direction=library_direction, 
+                               threads=threads)
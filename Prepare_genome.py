@@ -0,0 +1,37 @@
+'''Usage: python Prepare_genome.py fasta gff3 name <--key short_name> <--aliases alias1 alias2> <--organism_flag pombe> <--centromeres file> <--bowtie_index prefix> <--genome_dir directory> <--threads n>
+Arguments in <> are optional
+Builds the packed genome, contig sizes, annotation cache, intron table and splice site PSSMs for an organism
+and registers them in the genome manifest used by autoload_organism and find_organism_files'''
+
+import sys
+import os
+import warnings; warnings.simplefilter('ignore')
+import argparse
+script_path = os.path.dirname(os.path.realpath(__file__)).split('GeneTools')[0]
+sys.path.append(script_path)
+import GeneTools as GT
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("fasta", help="Genome fasta file")
+    parser.add_argument("gff3", help="gff3 file for the organism")
+    parser.add_argument("name", help="Organism name, e.g. 'Cryptococcus neoformans H99'")
+    parser.add_argument("--key", default=None, help="Short name for output files and the manifest (default: fasta file name)")
+    parser.add_argument("--aliases", default=None, nargs='+', help="Other names that should find this organism")
+    parser.add_argument("--organism_flag", default=None, help="organism argument for build_transcript_dict (pombe for S. pombe gff3)")
+    parser.add_argument("--centromeres", default=None, help="json or gff3 file with centromere locations")
+    parser.add_argument("--bowtie_index", default=None, help="Bowtie index prefix to record in the manifest")
+    parser.add_argument("--genome_dir", default=None, help="Output directory (default: $GENETOOLS_GENOMES or GENOMES/)")
+    parser.add_argument("--threads", default=1, type=int, help="Number of processors")
+    args = parser.parse_args()
+
+    entry = GT.prepare_genome(args.name, args.fasta, args.gff3, key=args.key, aliases=args.aliases,
+                              organism_flag=args.organism_flag, centromeres=args.centromeres,
+                              bowtie_index=args.bowtie_index, genome_dir=args.genome_dir, threads=args.threads)
+
+    print "\nFiles for "+args.name+":"
+    for k in sorted(entry):
+        print k+': '+str(entry[k])
+
+if __name__ == "__main__":
+    main()
@@ -954,7 +954,12 @@ def map_to_chromosomes(csv, organism, fig_name="chrom_map"):
     if len(df.columns) <= 1:
 	df = pd.read_csv(csv, sep='\t', index_col=0)
     
-    if organism == 'crypto': 
+    entry = GT.find_genome_manifest_entry(organism)
+    if entry is not None and 'centromeres' in entry:
+        fa_json = entry['packed_genome']
+        gff3 = entry['gff3']
+        cen_dict = entry['centromeres']
+    elif organism == 'crypto': 
         fa_json = script_path+'GENOMES/H99_fa.json'
         gff3 = script_path+'GENOMES/CNA3_all_transcripts.gff3'
         cen_dict = script_path+'GENOMES/H99_centromeres.json'
@@ -966,8 +971,7 @@ def map_to_chromosomes(csv, organism, fig_name="chrom_map"):
     #    fa_json = script_path+'GENOMES/S288C_genome.fa'
     #    gff3 = script_path+'GENOMES/saccharomyces_cerevisiae_R64-2-1_20150113.gff3'
         
-    with open(fa_json) as f:
-        fa_dict = json.load(f)
+    fa_dict = GT.load_genome(fa_json)
         
     with open(cen_dict) as f:
         cen_dict = json.load(f)
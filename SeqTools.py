@@ -7,9 +7,17 @@ import pandas as pd
 from collections import OrderedDict
 import csv
 import json
+import hashlib
+script_path = os.path.dirname(os.path.realpath(__file__)).split('GeneTools')[0]
+sys.path.append(script_path)
+import GeneTools as GT
 
 def find_organism_files(organism):
     ''' usage: organism, gff3, fa_dict, bowtie_index = find_organism_files(organism)'''
+    entry = GT.find_genome_manifest_entry(organism)
+    if entry is not None:
+        return entry['organism_flag'], entry['gff3'], GT.load_genome(entry['packed_genome']), entry['bowtie_index']
+    
     if 'crypto' in organism:
         gff3 = '/home/jordan/GENOMES/CNA3_FINAL_CALLGENES_1_gobs.gff3'
         fa = '/home/jordan/GENOMES/H99_fa.json'
@@ -26,37 +34,43 @@ def find_organism_files(organism):
         bowtie_index = '/home/jordan/GENOMES/S288C/S288C'
         organism = None
         
-    with open(fa) as f:
-        fa_dict = json.load(f)
+    fa_dict = GT.load_genome(fa)
         
     return organism, gff3, fa_dict, bowtie_index
 
-def build_transcript_dict(gff3_file, organism=None):
+def build_transcript_dict(gff3_file, organism=None, cache=True):
     '''Creates a dictionary from gff3 file where keys are transcript names and values are [start, end, strand, chromosome, CDS_starts(list), CDS_ends(list]
     Note: change organism to 'pombe' if using pombe. Otherwise no need to indicate
     Additional note: See the tx_info function for retrieving gene information
     
+    The parsed annotation is saved next to the gff3 file (gff3_file.<organism>.gt_cache) as numpy arrays
+    and reused on later calls until the gff3 file changes.
+    
     Parameters
     ----------
     gff3_file : str
               gff3 for your organism - tested on H99 C. neoformans, S288C S. cerevisiae, S. pombe and C. albicans
     organism : str, default `None`
               Change only if using pombe - then should be 'pombe'
+    cache : bool, default `True`
+              Read and write the compiled annotation cache. If False, always parse the gff3 file.
     
     Returns
     -------
     tx_dict : File (comma separated) with annotation appended to each row.
               '''
-    
+    if not cache:
+        return _parse_transcript_dict(gff3_file, organism=organism)
+    return _transcript_dict_from_arrays(load_transcript_arrays(gff3_file, organism=organism))
+
+def _parse_transcript_dict(gff3_file, organism=None):
     with open(gff3_file,"r") as gff3:
         transcript_dict = {}
         for line in gff3:
             columns = line.split('\t')
             
             if organism == 'pombe' and len(columns) > 1:
-                chr_rom = columns[0]
-                rom_lat = {'I':'chr1','II':'chr2','III':'chr3','MT':'MT'}
-                chrom = rom_lat[chr_rom]
+                chrom = GT.pombe_aliases.resolve(columns[0], columns[0])
                 transcript_types = ['transcript','pseudogene','rRNA','snoRNA','tRNA','snRNA']
                 if columns[2] in transcript_types:
                     if columns[8].split(':')[0].split('=')[1] == 'gene': continue
@@ -103,15 +117,206 @@ def build_transcript_dict(gff3_file, organism=None):
     transcript_dict = OrderedDict(sorted(transcript_dict.items()))
     return transcript_dict
 
+#################################################
+## Compiled annotation cache for gff3 files    ##
+#################################################
+
+GT_CACHE_VERSION = 1
+_transcript_array_names = ['names','start','end','strand','chromosome','cds_ptr','cds_start','cds_end']
+_transcript_arrays = {}
+
+def file_md5(file_name, chunk_size=1<<20):
+    '''md5 hex digest of a file, read in chunks'''
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def transcript_cache_name(gff3_file, organism=None):
+    return '{0}.{1}.gt_cache'.format(gff3_file, organism)
+
+def _transcript_arrays_from_dict(transcript_dict):
+    names = list(transcript_dict.keys())
+    values = [transcript_dict[tx] for tx in names]
+    n_cds = np.array([len(v[4]) for v in values], dtype=np.int64)
+    cds_ptr = np.zeros(len(values)+1, dtype=np.int64)
+    cds_ptr[1:] = np.cumsum(n_cds)
+    arrays = {'names':np.array(names, dtype=str),
+              'start':np.array([v[0] for v in values], dtype=np.int64),
+              'end':np.array([v[1] for v in values], dtype=np.int64),
+              'strand':np.array([v[2] for v in values], dtype=str),
+              'chromosome':np.array([v[3] for v in values], dtype=str),
+              'cds_ptr':cds_ptr,
+              'cds_start':np.array([x for v in values for x in v[4]], dtype=np.int64),
+              'cds_end':np.array([x for v in values for x in v[5]], dtype=np.int64)}
+    return arrays
+
+def _transcript_dict_from_arrays(arrays):
+    cds_start = arrays['cds_start'].tolist()
+    cds_end = arrays['cds_end'].tolist()
+    ptr = arrays['cds_ptr'].tolist()
+    transcript_dict = OrderedDict()
+    for n, (tx, start, end, strand, chrom) in enumerate(zip(arrays['names'].tolist(), arrays['start'].tolist(), 
+                                                           arrays['end'].tolist(), arrays['strand'].tolist(), 
+                                                           arrays['chromosome'].tolist())):
+        transcript_dict[tx] = [start, end, strand, chrom, cds_start[ptr[n]:ptr[n+1]], cds_end[ptr[n]:ptr[n+1]]]
+    return transcript_dict
+
+def _read_transcript_cache(cache_name, size, mtime, gff3_file):
+    try:
+        with open(cache_name, 'rb') as f:
+            npz = np.load(f)
+            arrays = {k:npz[k] for k in npz.files}
+    except (IOError, ValueError, KeyError):
+        return None
+    if 'version' not in arrays or int(arrays['version']) != GT_CACHE_VERSION:
+        return None
+    if int(arrays['size']) != size:
+        return None
+    if float(arrays['mtime']) != mtime:
+        # Touched but possibly unchanged (e.g. copied) - fall back on the hash and refresh the timestamp
+        md5 = str(arrays['md5'])
+        if md5 != file_md5(gff3_file):
+            return None
+        _write_transcript_cache(cache_name, {k:arrays[k] for k in _transcript_array_names}, size, mtime, md5)
+    return arrays
+
+def _write_transcript_cache(cache_name, arrays, size, mtime, md5):
+    tmp_name = '{0}.{1}.tmp'.format(cache_name, os.getpid())
+    try:
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, version=np.array(GT_CACHE_VERSION), size=np.array(size), mtime=np.array(mtime),
+                     md5=np.array(md5), **arrays)
+        os.rename(tmp_name, cache_name)
+    except (IOError, OSError):
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+def load_transcript_arrays(gff3_file, organism=None):
+    '''Columnar version of build_transcript_dict. Loaded from the compiled cache next to the gff3 file
+    (parsed and written the first time or whenever the gff3 file changes) and kept in memory for the rest
+    of the session.
+    
+    Parameters
+    ----------
+    gff3_file : str
+              gff3 for your organism
+    organism : str, default `None`
+              Change only if using pombe - then should be 'pombe'
+    
+    Returns
+    -------
+    arrays : dict of numpy arrays
+              names, start, end, strand, chromosome (one entry per transcript, sorted by name),
+              cds_start and cds_end (all CDS of transcript i are at cds_ptr[i]:cds_ptr[i+1])
+    '''
+    stat = os.stat(gff3_file)
+    size, mtime = stat.st_size, stat.st_mtime
+    key = (os.path.realpath(gff3_file), organism)
+    if key in _transcript_arrays and _transcript_arrays[key][0] == (size, mtime):
+        return _transcript_arrays[key][1]
+    
+    cache_name = transcript_cache_name(gff3_file, organism=organism)
+    arrays = _read_transcript_cache(cache_name, size, mtime, gff3_file)
+    if arrays is None:
+        arrays = _transcript_arrays_from_dict(_parse_transcript_dict(gff3_file, organism=organism))
+        _write_transcript_cache(cache_name, arrays, size, mtime, file_md5(gff3_file))
+    arrays = {k:arrays[k] for k in _transcript_array_names}
+    _transcript_arrays[key] = ((size, mtime), arrays)
+    return arrays
+
 
 def seq_simple(chrom, start, end, strand, fasta_dict):
     if type(fasta_dict) == str:
-        with open(fasta_dict, 'r') as f:
-            fasta_dict = json.load(f)
+        fasta_dict = GT.load_genome(fasta_dict)
     seq = fasta_dict[chrom][start:end+1]
     if strand == '-':
-        seq = SP.reverse_complement(seq)
+        seq = GT.reverse_complement(seq)
     return seq
+
+def _interval_columns(intervals):
+    if isinstance(intervals, pd.DataFrame):
+        chrom_col = 'chromosome' if 'chromosome' in intervals.columns else 'chrom'
+        chroms = intervals[chrom_col].values
+        starts = intervals['start'].values
+        ends = intervals['end'].values
+        if 'strand' in intervals.columns:
+            strands = intervals['strand'].values
+        else:
+            strands = np.array(['+']*len(intervals))
+    elif isinstance(intervals, np.ndarray) and intervals.dtype.names is not None:
+        names = intervals.dtype.names
+        chroms = intervals['chromosome' if 'chromosome' in names else 'chrom']
+        starts = intervals['start']
+        ends = intervals['end']
+        strands = intervals['strand'] if 'strand' in names else np.array(['+']*len(intervals))
+    else:
+        intervals = list(intervals)
+        if len(intervals) == 0:
+            return [np.zeros(0, dtype=object)]*2+[np.zeros(0, dtype=int)]*2
+        columns = zip(*intervals)
+        chroms, starts, ends = columns[:3]
+        strands = columns[3] if len(columns) > 3 else ['+']*len(starts)
+    return (np.asarray(chroms, dtype=object), np.asarray(strands, dtype=object),
+            np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64))
+
+def fetch_sequences(intervals, fasta_dict):
+    '''Retrieve the sequences of many intervals at once. Intervals are grouped by chromosome and 
+    gathered from one buffer per chromosome, then minus strand sequences are reverse complemented together.
+    
+    Parameters
+    ----------
+    intervals : pandas.DataFrame, numpy structured array or list of tuples
+            Columns/fields chromosome (or chrom), start, end and optionally strand (default '+').
+            Tuples are (chromosome, start, end) or (chromosome, start, end, strand).
+            Coordinates are 0 based and end exclusive (python slicing); intervals are clipped to the chromosome.
+    fasta_dict : dict, GenomeStore or str
+            Genome sequences or a file that can be opened with load_genome (.json, fasta or .gt2bit)
+    
+    Returns
+    -------
+    seqs : numpy.array
+            Sequences (str) in the same order as intervals
+    '''
+    if isinstance(fasta_dict, basestring):
+        fasta_dict = GT.load_genome(fasta_dict)
+    chroms, strands, starts, ends = _interval_columns(intervals)
+    seqs = np.empty(len(chroms), dtype=object)
+    
+    for chrom in pd.unique(chroms):
+        ix = np.where(chroms == chrom)[0]
+        contig = fasta_dict[chrom]
+        length = len(contig)
+        c_starts = np.clip(starts[ix], 0, length)
+        c_ends = np.clip(ends[ix], 0, length)
+        lengths = np.maximum(c_ends-c_starts, 0)
+        if lengths.sum() == 0:
+            seqs[ix] = ''
+            continue
+        
+        # One buffer covering all intervals on this chromosome
+        lo = int(c_starts[lengths > 0].min())
+        hi = int(c_ends[lengths > 0].max())
+        if hasattr(contig, 'to_array'):
+            buf = contig.to_array(lo, hi)
+        else:
+            if isinstance(contig, unicode):
+                contig = contig.encode('ascii')
+            buf = np.frombuffer(contig, dtype=np.uint8)[lo:hi]
+        
+        # Position of every base, walking backwards through minus strand intervals
+        offsets = np.zeros(len(ix)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        rel = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+        minus = np.repeat(strands[ix] == '-', lengths)
+        pos = np.where(minus, np.repeat(c_ends-1-lo, lengths)-rel, np.repeat(c_starts-lo, lengths)+rel)
+        codes = buf[pos]
+        codes[minus] = GT.complement(codes[minus])
+        
+        joined = codes.tostring()
+        seqs[ix] = [joined[offsets[n]:offsets[n+1]] for n in range(len(ix))]
+    return seqs
             
 def get_peak_sequence(input_file, fasta_file, gff3_file, window=1000):
     '''Makes a fasta file of peak sequences based on an input file.
@@ -124,7 +329,7 @@ def get_peak_sequence(input_file, fasta_file, gff3_file, window=1000):
     input_file : str
             CSV file - see above
     fasta_file : str
-            .json dictionary of chromosome sequences or fasta file (.json will load faster)
+            .json dictionary of chromosome sequences, fasta file or packed genome (.gt2bit)
     gff3_file : str
             gff3 file for your organism
     window : int, default 1000
@@ -135,16 +340,10 @@ def get_peak_sequence(input_file, fasta_file, gff3_file, window=1000):
     peak_fasta : fasta file with all peak sequences
     '''
     
-    tx_dict = SP.build_transcript_dict(gff3_file)
-    if type(fasta_file) == dict:
-        fa_dict = fasta_file
-    else:
-        if fasta_file.endswith('json'):
-            with open(fasta_file) as f:
-                fa_dict = json.load(f)
-        else:
-            fa_dict = SP.make_fasta_dict(fasta_file)
-    seq_list = []
+    tx_dict = build_transcript_dict(gff3_file)
+    fa_dict = GT.load_genome(fasta_file)
+    names = []
+    intervals = []
     no_tx_n = 1
     with open(input_file,'r') as csv_file:
         f = csv.reader(csv_file, dialect=csv.excel)
@@ -167,11 +366,12 @@ def get_peak_sequence(input_file, fasta_file, gff3_file, window=1000):
                         print tx+" not in GFF3 file"
                         strand = '+'
                         tx = chrom+':'+str(center)
-                    seq = seq_simple(chrom, start, end, strand, fa_dict)
-                    seq_list.append((tx,seq))
+                    names.append(tx)
+                    intervals.append((chrom, start, end+1, strand))
                         
                 except ValueError:
                     pass
+    seq_list = zip(names, fetch_sequences(intervals, fa_dict))
     with open('{0}_peak_sequences.fa'.format(input_file.split('/')[-1].split('.')[0]),'w') as fout:
         for tx, seq in seq_list:
             fout.write('>'+tx+'\n')
@@ -241,7 +441,7 @@ def get_peak_sequence3(input_file, fasta_file, gff3_file, gene_list,window=1000)
     input_file : str
             CSV file - see above
     fasta_file : str
-            .json dictionary of chromosome sequences or fasta file (.json will load faster)
+            .json dictionary of chromosome sequences, fasta file or packed genome (.gt2bit)
     gff3_file : str
             gff3 file for your organism
     gene_list: str
@@ -254,16 +454,10 @@ def get_peak_sequence3(input_file, fasta_file, gff3_file, gene_list,window=1000)
     peak_fasta : fasta file with all peak sequences
     '''
 
-    tx_dict = SP.build_transcript_dict(gff3_file)
-    if type(fasta_file) == dict:
-        fa_dict = fasta_file
-    else:
-        if fasta_file.endswith('json'):
-            with open(fasta_file) as f:
-                fa_dict = json.load(f)
-        else:
-            fa_dict = SP.make_fasta_dict(fasta_file)
-    seq_list = []
+    tx_dict = build_transcript_dict(gff3_file)
+    fa_dict = GT.load_genome(fasta_file)
+    names = []
+    intervals = []
     no_tx_n = 1
     with open(input_file,'r') as csv_file:
         f = csv.reader(csv_file, dialect=csv.excel)
@@ -286,11 +480,12 @@ def get_peak_sequence3(input_file, fasta_file, gff3_file, gene_list,window=1000)
                         print tx+" not in GFF3 file"
                         strand = '+'
                         tx = chrom+':'+str(center)
-                    seq = seq_simple(chrom, start, end, strand, fa_dict)
-                    seq_list.append((tx,seq))
+                    names.append(tx)
+                    intervals.append((chrom, start, end+1, strand))
 
                 except ValueError:
                     pass
+    seq_list = zip(names, fetch_sequences(intervals, fa_dict))
     genes_of_interest=gene_list.split("\n")
 
     with open('{0}_peak_sequences.fa'.format(input_file.split('/')[-1].split('.')[0]),'w') as fout:
@@ -1,6 +1,7 @@
 import warnings; warnings.simplefilter('ignore')
 from BedgraphTools import *
 from FastaTools import *
+from IntervalTools import *
 from SeqTools import *
 from CountingTools import *
 from Annotation_tools import *